@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_store.settings')
 
 application = get_asgi_application()
+
+if settings.PRELOAD_APP:  # Warm up once in the master of a pre-forking server (see product/startup.py)
+    from product.startup import preload
+    preload()
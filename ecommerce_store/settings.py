@@ -34,15 +34,46 @@ import os
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-from dotenv import load_dotenv
-load_dotenv()
+# Read .env only when there is one (production sets real environment variables), so other
+# processes skip importing python-dotenv.  Found where load_dotenv() looked: this directory and
+# its parents (BASE_DIR among them), then the working directory
+dotenv_path = next((directory / '.env' for directory in (*Path(__file__).resolve().parents, Path.cwd())
+                    if (directory / '.env').is_file()), None)
+if dotenv_path:
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path)
 # Stripe Keys
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')  # whsec_... for /products/webhooks/stripe/
+# 'product.payments.FakeGateway' runs checkout offline (local load tests, no Stripe calls)
+PAYMENT_GATEWAY = os.getenv('PAYMENT_GATEWAY', 'product.payments.StripeGateway')
+STRIPE_SESSION_CACHE_TTL = int(os.getenv('STRIPE_SESSION_CACHE_TTL', 300))  # Seconds to cache finished Checkout Sessions
+STRIPE_HTTP_POOL_SIZE = 10
+# Serve add_to_cart, update_cart, payment_success and create_checkout_session from
+# product/async_views.py; turn on when running under ASGI (ecommerce_store.asgi)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '0') == '1'
+# Import the views, compile the templates and freeze the heap when wsgi.py/asgi.py load, so a
+# pre-forking server (gunicorn --preload) starts workers that share that memory copy-on-write
+PRELOAD_APP = os.getenv('PRELOAD_APP', '0') == '1'
+# Seconds stock stays reserved for an unpaid Checkout Session.  Stripe's minimum session lifetime is
+# 30 minutes, so shorter values are raised to 31 (the reservation always lasts as long as the session)
+STOCK_RESERVATION_TTL = int(os.getenv('STOCK_RESERVATION_TTL', 31 * 60))
+STRIPE_MAX_NETWORK_RETRIES = 2
+
+
+# Product search: FTS5 index on SQLite, use 'product.search.ORMSearchBackend' for the plain icontains scan
+PRODUCT_SEARCH_BACKEND = os.getenv('PRODUCT_SEARCH_BACKEND', 'product.search.FTS5SearchBackend')
+
+# Products per catalog page and orders per order-history page (keyset paginated, see product/pagination.py)
+PRODUCT_PAGE_SIZE = int(os.getenv('PRODUCT_PAGE_SIZE', 24))
+ORDER_PAGE_SIZE = int(os.getenv('ORDER_PAGE_SIZE', 20))
 
 
 # Email Configuration (Using Gmail SMTP)
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Mail is queued in OutboundEmail and delivered by `manage.py send_queued_mail`;
+# set EMAIL_BACKEND=django.core.mail.backends.console.EmailBackend to print instead.
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
@@ -62,11 +93,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'product.middleware.PerformanceMiddleware',  # First, so its timings cover everything below
+    'product.middleware.AssetMiddleware',  # Static and media files, before sessions and auth
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'product.middleware.AnonymousCartMiddleware',  # Saves the logged-out visitor's cart cookie
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -75,7 +109,7 @@ ROOT_URLCONF = 'ecommerce_store.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'product.metrics.InstrumentedDjangoTemplates',  # DjangoTemplates + render timing
         'DIRS': [BASE_DIR / 'product/templates'],  # Add your templates directory here
         'APP_DIRS': True,
         'OPTIONS': {
@@ -96,14 +130,121 @@ WSGI_APPLICATION = 'ecommerce_store.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
+# DB_ENGINE=sqlite (default) or postgresql; the PostgreSQL connection comes from
+# DB_NAME, DB_USER, DB_PASSWORD, DB_HOST and DB_PORT.
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    # DB_POOL=1 uses psycopg's connection pool (needs `psycopg[pool]`); otherwise each
+    # worker keeps its connection open for DB_CONN_MAX_AGE seconds.  Django doesn't allow both.
+    DB_POOL = os.getenv('DB_POOL', '0') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'ecommerce_store'),
+            'USER': os.getenv('DB_USER', ''),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', ''),
+            'PORT': os.getenv('DB_PORT', ''),
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # Take the write lock when a transaction starts, so concurrent cart/stock
+                # updates wait their turn (up to `timeout` seconds) instead of failing
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+                # WAL lets reads carry on during a write; NORMAL sync is safe with WAL and
+                # skips an fsync per commit; mmap avoids read() copies for the hot pages
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    f"PRAGMA mmap_size={int(os.getenv('DB_MMAP_SIZE', 128 * 1024 * 1024))};"
+                ),
+            },
+            # A file (not in-memory) test database, so the concurrency tests can use threads
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# CACHE_BACKEND=locmem|file|redis; CACHE_LOCATION is the file path or redis:// URL.
+# Use file or redis with more than one worker process, so invalidation reaches all of them.
+
+# The stock backends, counting hits and misses for the request metrics
+CACHE_BACKENDS = {
+    'locmem': 'product.metrics.InstrumentedLocMemCache',
+    'file': 'product.metrics.InstrumentedFileBasedCache',
+    'redis': 'product.metrics.InstrumentedRedisCache',
+}
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': os.getenv('CACHE_LOCATION', str(BASE_DIR / '.cache') if CACHE_BACKEND == 'file' else ''),
+        'TIMEOUT': 300,
     }
 }
 
 
+# Sessions and users
+# SESSION_BACKEND=cached_db (default: read from the cache, written through to the
+# database), db, cache (lost on eviction) or signed_cookies (no server state, but the
+# client can read the session's contents).
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINES[os.getenv('SESSION_BACKEND', 'cached_db')]
+# Logged-in users are cached too (product/auth.py) and dropped whenever the User is saved.
+# ModelBackend stays listed so sessions created before the switch still resolve; failed logins
+# stop at CachedModelBackend, so the password is hashed once.
+AUTHENTICATION_BACKENDS = ['product.auth.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend']
+USER_CACHE_TIMEOUT = int(os.getenv('USER_CACHE_TIMEOUT', 15 * 60))
+
+
+# Observability
+# Every response carries a Server-Timing header; /metrics serves Prometheus histograms
+# (set METRICS_TOKEN to require `Authorization: Bearer <token>`).
+SERVER_TIMING = os.getenv('SERVER_TIMING', '1') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1.0))  # Logged at WARNING
+
+# LOG_LEVEL applies to the product app; DEBUG logs one line per request with its timings
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+    },
+    'loggers': {
+        'product': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -139,6 +280,20 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'  # collectstatic's output
+
+# Outside DEBUG, collectstatic writes content-hashed names plus .gz/.br variants (see product/assets.py)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+        else 'product.assets.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Serve STATIC_ROOT and MEDIA_ROOT from the app itself, with ETags and long-lived
+# Cache-Control on hashed files; turn off when a web server or CDN serves them
+SERVE_ASSETS = os.getenv('SERVE_ASSETS', str(not DEBUG)).lower() in ('1', 'true', 'yes')
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -20,12 +20,15 @@ from django.urls import path, include
 from django.shortcuts import redirect
 from django.conf import settings
 from django.conf.urls.static import static
-from product.views import home  # Import the home view
+from product.admin import sales_dashboard
+from product.views import home, prometheus_metrics  # Import the home view
 
 urlpatterns = [
+    path('admin/sales/', admin.site.admin_view(sales_dashboard), name='sales_dashboard'),  # Before the admin's catch-all
     path('admin/', admin.site.urls),
     path('', home, name='home'),  # Set the home view as the default '/'
     path('products/', include('product.urls')),  # Include product app URLs
+    path('metrics', prometheus_metrics, name='metrics'),  # Prometheus scrape target
     path('accounts/login/', auth_views.LoginView.as_view(template_name='registration/login.html'), name='login'),  # Custom login template
     path('accounts/logout/', auth_views.LogoutView.as_view(template_name='registration/logout.html'), name='logout'),  # Custom logout template
 ]
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce_store.settings')
 
 application = get_wsgi_application()
+
+if settings.PRELOAD_APP:  # Warm up once in the master of a pre-forking server (see product/startup.py)
+    from product.startup import preload
+    preload()
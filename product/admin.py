@@ -1,4 +1,113 @@
 from django.contrib import admin
-from .models import Product
+from django.shortcuts import render
 
-admin.site.register(Product)
\ No newline at end of file
+from .analytics import period, sales_report
+from .models import (
+    Category, CategoryDailySales, DailySales, Order, OrderItem, OutboundEmail, Product, ProductDailySales,
+    StockReservation, StripeEvent,
+)
+
+DASHBOARD_PERIODS = [7, 30, 90, 365]  # Days
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ['name', 'sku', 'category', 'price', 'stock', 'updated_at']
+    list_select_related = ['category']
+    list_filter = ['category']
+    search_fields = ['name', '=sku']
+    show_full_result_count = False  # Skip the unfiltered COUNT(*) on every filtered page
+
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    prepopulated_fields = {'slug': ['name']}
+
+
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    raw_id_fields = ['product']  # Not a <select> of every product
+    extra = 0
+
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'customer_name', 'email', 'total_amount', 'date']
+    list_select_related = ['user']
+    list_filter = [('date', admin.DateFieldListFilter)]  # Ranges on order_date_idx
+    search_fields = ['=id', 'email', '=stripe_session_id']
+    raw_id_fields = ['user']
+    inlines = [OrderItemInline]
+    show_full_result_count = False
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['session_id', 'product', 'user', 'quantity', 'status', 'expires_at']
+    list_select_related = ['product', 'user']
+    list_filter = ['status']
+    search_fields = ['=session_id']
+    raw_id_fields = ['product', 'user']
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['status', 'type']
+    search_fields = ['=event_id']
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'to', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['status']
+    search_fields = ['to', 'subject']
+
+
+class RollupAdmin(admin.ModelAdmin):
+    """ Read-only: the rollups are maintained by product.analytics """
+    date_hierarchy = 'date'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(DailySales)
+class DailySalesAdmin(RollupAdmin):
+    list_display = ['date', 'orders', 'units', 'revenue']
+
+
+@admin.register(ProductDailySales)
+class ProductDailySalesAdmin(RollupAdmin):
+    list_display = ['date', 'product', 'category', 'orders', 'units', 'revenue']
+    list_select_related = ['product', 'category']
+    list_filter = ['category']
+    raw_id_fields = ['product']
+
+
+@admin.register(CategoryDailySales)
+class CategoryDailySalesAdmin(RollupAdmin):
+    list_display = ['date', 'category', 'orders', 'units', 'revenue']
+    list_select_related = ['category']
+    list_filter = ['category']
+
+
+def sales_dashboard(request):
+    """ Revenue, top products and categories over the last ?days=, from the rollup tables only """
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 30
+    days = days if days in DASHBOARD_PERIODS else 30
+    start, end = period(days)
+    return render(request, 'admin/sales_dashboard.html', {
+        **admin.site.each_context(request),
+        'title': 'Sales dashboard',
+        'days': days,
+        'periods': DASHBOARD_PERIODS,
+        'start': start,
+        **sales_report(start, end),
+    })
@@ -0,0 +1,141 @@
+"""
+Daily sales rollups and the queries behind the admin sales dashboard.
+
+Three small tables hold per-day totals: ``DailySales`` for the whole store,
+``ProductDailySales`` per product and ``CategoryDailySales`` per category
+(orders, units and revenue each).  ``create_order_from_cart`` adds every new
+order to them inside its own transaction (``record_order``: one
+``INSERT ... ON CONFLICT DO UPDATE`` per table), so the rollups are exact, and
+reports read a few hundred pre-aggregated rows instead of scanning OrderItem.
+``manage.py backfill_sales_rollups`` rebuilds any date range from the order
+history.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import CategoryDailySales, DailySales, Order, OrderItem, ProductDailySales
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+TOTALS = ('orders', 'units', 'revenue')
+CENT = Decimal('0.01')
+# (model, key fields in row order, the unique key the totals are added under)
+ROLLUPS = {
+    'daily': (DailySales, ('date',), ('date',)),
+    'product': (ProductDailySales, ('date', 'product', 'category'), ('date', 'product')),
+    'category': (CategoryDailySales, ('date', 'category'), ('date', 'category')),
+}
+
+
+def add_sales(rollup, rows):
+    """ Add rows of (*key values, orders, units, revenue) to a rollup's running totals """
+    if not rows:
+        return
+    model, fields, unique = ROLLUPS[rollup]
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+
+    def column(name):
+        return quote(model._meta.get_field(name).column)
+
+    columns = [column(name) for name in fields + TOTALS]
+    totals = ', '.join(f"{quote(name)} = {table}.{quote(name)} + excluded.{quote(name)}" for name in TOTALS)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT ({', '.join(column(name) for name in unique)}) DO UPDATE SET {totals}",
+            rows,
+        )
+
+
+def record_order(order, items):
+    """ Add a new order and its OrderItems to the rollups, under each item's category snapshot """
+    day = timezone.localdate(order.date)
+    products = defaultdict(lambda: [0, Decimal('0')])  # (product_id, category_id) -> [units, revenue]
+    categories = defaultdict(lambda: [0, Decimal('0')])
+    for item in items:
+        for totals in (products[item.product_id, item.category_id], categories[item.category_id]):
+            totals[0] += item.quantity
+            totals[1] += item.line_total
+
+    lines = categories.values()
+    add_sales('daily', [(day, 1, sum(units for units, _ in lines), sum(revenue for _, revenue in lines))])
+    add_sales('product', [(day, product_id, category_id, 1, units, revenue)
+                          for (product_id, category_id), (units, revenue) in products.items()])
+    add_sales('category', [(day, category_id, 1, units, revenue)
+                           for category_id, (units, revenue) in categories.items()])
+
+
+def backfill(start, end):
+    """ Rebuild the rollups for the days in [start, end) from Order and OrderItem; returns the orders counted """
+    orders = Order.objects.filter(date__date__gte=start, date__date__lt=end)
+    # The category snapshotted at sale time, as record_order uses; items from before the snapshot
+    # existed fall back to the product's current category
+    items = (
+        OrderItem.objects.filter(order__in=orders).order_by()
+        .annotate(day=TruncDate('order__date'), sale_category=Coalesce('category', 'product__category'))
+    )
+    line_totals = {'units': Sum('quantity'), 'revenue': Sum(F('unit_price') * F('quantity'), output_field=MONEY)}
+
+    day_orders = dict(orders.annotate(day=TruncDate('date')).order_by().values('day')
+                      .annotate(count=Count('id')).values_list('day', 'count'))
+    day_lines = {row['day']: row for row in items.values('day').annotate(**line_totals)}
+    daily = [(day, count, day_lines.get(day, {}).get('units') or 0, day_lines.get(day, {}).get('revenue') or 0)
+             for day, count in day_orders.items()]
+    product = [
+        (row['day'], row['product_id'], row['sale_category'], row['orders'], row['units'], row['revenue'])
+        for row in items.values('day', 'product_id', 'sale_category')
+        .annotate(orders=Count('order_id', distinct=True), **line_totals)
+    ]
+    category = [
+        (row['day'], row['sale_category'], row['orders'], row['units'], row['revenue'])
+        for row in items.values('day', 'sale_category')
+        .annotate(orders=Count('order_id', distinct=True), **line_totals)
+    ]
+
+    with transaction.atomic():
+        for rollup, rows in (('daily', daily), ('product', product), ('category', category)):
+            model = ROLLUPS[rollup][0]
+            model.objects.filter(date__gte=start, date__lt=end).delete()
+            add_sales(rollup, rows)
+    return sum(day_orders.values())
+
+
+def period(days):
+    """ The [start, end) dates of the last `days` days, today included """
+    end = timezone.localdate() + timedelta(days=1)
+    return end - timedelta(days=days), end
+
+
+def sales_report(start, end, top=10):
+    """ Everything the dashboard shows for [start, end), read from the rollup tables only """
+    in_period = {'date__gte': start, 'date__lt': end}
+    # Named apart from the model fields, which annotations may not shadow
+    totals = {'order_count': Sum('orders'), 'unit_count': Sum('units'), 'revenue_total': Sum('revenue')}
+    summary = DailySales.objects.filter(**in_period).aggregate(
+        orders=Coalesce(Sum('orders'), 0),
+        units=Coalesce(Sum('units'), 0),
+        revenue=Coalesce(Sum('revenue'), Value(0), output_field=MONEY),
+    )
+    return {
+        'summary': summary,
+        'average_order': (summary['revenue'] / summary['orders']).quantize(CENT) if summary['orders'] else Decimal('0'),
+        'daily': list(DailySales.objects.filter(**in_period).order_by('-date')),
+        'products': list(
+            ProductDailySales.objects.filter(**in_period)
+            .values('product_id', 'product__name')
+            .annotate(**totals)
+            .order_by('-revenue_total', 'product_id')[:top]
+        ),
+        'categories': list(
+            CategoryDailySales.objects.filter(**in_period)
+            .values('category_id', 'category__name')
+            .annotate(**totals)
+            .order_by('-revenue_total', 'category_id')
+        ),
+    }
@@ -0,0 +1,129 @@
+"""
+Carts for visitors who aren't logged in.
+
+The lines live in a signed cookie (``{product_id: quantity}``) rather than in
+``CartItem`` rows, so browsing and filling a cart writes nothing to the
+database and the navbar badge is counted without a query.  Views change the
+cart through ``get_anonymous_cart(request)``; ``AnonymousCartMiddleware``
+writes the cookie back when it was modified.  On login the lines are merged
+into the user's ``CartItem`` rows in one batch (see ``product.signals``).
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+
+from .cart import MAX_CART_OPERATIONS, CartOperationError, Totals, apply_cart_operations, parse_operation
+from .models import CartItem, Product
+
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'product.anonymous_cart'
+COOKIE_MAX_AGE = 60 * 60 * 24 * 14
+MAX_LINES = 50  # Keeps the cookie well under the 4KB browser limit
+
+
+class AnonymousCart:
+    def __init__(self, quantities=None):
+        self.quantities = dict(quantities or {})  # product_id -> quantity, in the order they were added
+        self.modified = False
+
+    @classmethod
+    def from_cookie(cls, value):
+        """ The cart in a cookie value; a missing, tampered or expired cookie is an empty cart """
+        if not value:
+            return cls()
+        try:
+            data = signing.loads(value, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+            quantities = {int(product_id): int(quantity) for product_id, quantity in data.items()}
+        except (signing.BadSignature, AttributeError, TypeError, ValueError):
+            cart = cls()
+            cart.modified = True  # Clear the bad cookie
+            return cart
+        return cls({product_id: quantity for product_id, quantity in quantities.items() if quantity > 0})
+
+    @property
+    def item_count(self):
+        return sum(self.quantities.values())
+
+    def apply(self, operations):
+        """
+        The anonymous side of ``cart.apply_cart_operations``: the same
+        operations, except that there are no cart_item_ids to refer to.
+        Returns the product ids whose increase was skipped for lack of stock.
+        """
+        if not isinstance(operations, list) or len(operations) > MAX_CART_OPERATIONS:
+            raise CartOperationError(f"operations must be a list of at most {MAX_CART_OPERATIONS} items")
+        quantities = dict(self.quantities)
+        for (kind, ident), value, set_quantity in map(parse_operation, operations):
+            if kind == 'item':
+                raise CartOperationError(f"Cart item {ident} is not in your cart")
+            quantities[ident] = value if set_quantity else quantities.get(ident, 0) + value
+
+        wanted = [product_id for product_id, quantity in quantities.items()
+                  if quantity > self.quantities.get(product_id, 0)]
+        in_stock = set(Product.objects.filter(id__in=wanted, stock__gt=0).values_list('id', flat=True))
+        unavailable = set(wanted) - in_stock
+        for product_id in unavailable:
+            quantities[product_id] = self.quantities.get(product_id, 0)
+
+        quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+        if len(quantities) > MAX_LINES:
+            raise CartOperationError(f"A cart can hold at most {MAX_LINES} different products; log in for more")
+        if quantities != self.quantities:
+            self.quantities = quantities
+            self.modified = True
+        return sorted(unavailable)
+
+    def add(self, product_id, count=1):
+        """ Add a product the caller has already checked is in stock """
+        if product_id not in self.quantities and len(self.quantities) >= MAX_LINES:
+            raise CartOperationError(f"A cart can hold at most {MAX_LINES} different products; log in for more")
+        self.quantities[product_id] = self.quantities.get(product_id, 0) + count
+        self.modified = True
+
+    def clear(self):
+        if self.quantities:
+            self.quantities = {}
+            self.modified = True
+
+    def lines(self):
+        """ Unsaved CartItems with their products (one query), shaped like ``cart.cart_lines()`` """
+        products = Product.objects.in_bulk(list(self.quantities))
+        return [CartItem(product=products[product_id], quantity=quantity)
+                for product_id, quantity in self.quantities.items() if product_id in products]
+
+    @staticmethod
+    def totals(lines):
+        return Totals(sum(item.quantity for item in lines),
+                      sum((item.product.price * item.quantity for item in lines), Decimal('0.00')))
+
+    def merge_into(self, user):
+        """ Move the lines into the user's CartItem rows in one transaction, then empty this cart """
+        if self.quantities:
+            apply_cart_operations(user, [{'product_id': product_id, 'add': quantity}
+                                         for product_id, quantity in self.quantities.items()])
+            self.clear()
+
+    def save(self, response):
+        if not self.modified:
+            return
+        if self.quantities:
+            value = signing.dumps({str(product_id): quantity for product_id, quantity in self.quantities.items()},
+                                  salt=COOKIE_SALT, compress=True)
+            response.set_cookie(COOKIE_NAME, value, max_age=COOKIE_MAX_AGE, httponly=True, samesite='Lax',
+                                secure=settings.SESSION_COOKIE_SECURE)
+        else:
+            response.delete_cookie(COOKIE_NAME, samesite='Lax')
+        self.modified = False
+
+
+def get_anonymous_cart(request):
+    """ The request's cookie cart, read once per request """
+    cart = getattr(request, '_anonymous_cart', None)
+    if cart is None:
+        cart = request._anonymous_cart = AnonymousCart.from_cookie(request.COOKIES.get(COOKIE_NAME))
+    return cart
+
+
+def has_anonymous_cart(request):
+    return COOKIE_NAME in request.COOKIES
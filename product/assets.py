@@ -0,0 +1,153 @@
+"""
+Static and media files served by the application itself.
+
+``product.middleware.AssetMiddleware`` answers requests under STATIC_URL and MEDIA_URL before
+the session/auth middleware runs, so the WSGI/ASGI process can serve assets
+without a separate web server:
+
+* ``collectstatic`` with ``CompressedManifestStaticFilesStorage`` writes
+  content-hashed copies (``app.3f2a9c1b04de.css``) plus ``.gz`` and, when the
+  ``brotli`` package is installed, ``.br`` variants next to them.  The
+  middleware sends the smallest variant the client accepts.
+* Content-hashed files (hashed static names and the image renditions, see
+  ``product.images``) are sent with an immutable one-year Cache-Control.
+  Other media gets a short max-age and is revalidated.
+* Every file carries an ETag and Last-Modified, and conditional requests are
+  answered with 304 Not Modified without opening the file.
+
+Turn it on with SERVE_ASSETS (the default when DEBUG is off).
+"""
+import gzip
+import mimetypes
+import os
+import re
+from pathlib import Path
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseNotFound
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .images import RENDITIONS_DIR
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip variants are built
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=3600'
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')  # ManifestStaticFilesStorage's name.<hash>.ext
+RENDITION_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.\d+w\.[^./]+$')  # product.images' name.<hash>.<width>w.ext
+# Images and fonts are already compressed; these formats shrink a lot
+COMPRESSIBLE = {'.css', '.js', '.mjs', '.map', '.svg', '.json', '.txt', '.html', '.xml', '.ico', '.eot', '.ttf'}
+MIN_COMPRESS_SIZE = 256
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]  # Preferred first
+
+
+def compress_file(path):
+    """ Write .gz (and .br) copies of `path` when they are worth it; returns the suffixes written """
+    path = Path(path)
+    if path.suffix.lower() not in COMPRESSIBLE or path.stat().st_size < MIN_COMPRESS_SIZE:
+        return []
+    data = path.read_bytes()
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data)
+    written = []
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data) * 0.95:
+            Path(f'{path}{suffix}').write_bytes(compressed)
+            written.append(suffix)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ Content-hashed static files with precompressed variants, built during collectstatic """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in {*paths, *self.hashed_files.values()}:
+            if self.exists(name):
+                compress_file(self.path(name))
+
+
+def quality(params):
+    """ The q value among a coding's parameters (1 when absent, 0 when malformed) """
+    for param in params:
+        name, _, value = param.partition('=')
+        if name.strip() == 'q':
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+def accepted_encodings(request):
+    """ The content codings the client accepts: q > 0, with '*' and 'identity' as in RFC 9110 """
+    qualities = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, *params = (piece.strip().lower() for piece in part.split(';'))
+        if coding:
+            qualities[coding] = quality(params)
+    default = qualities.pop('*', None)
+    accepted = {coding for coding, q in qualities.items() if q > 0}
+    if default:  # '*' stands for every coding not named
+        accepted.update(encoding for encoding, _ in ENCODINGS if encoding not in qualities)
+    if 'identity' not in qualities and default != 0:
+        accepted.add('identity')  # Acceptable unless refused by name or by '*;q=0'
+    return accepted
+
+
+def serve_file(request, root, name, cache_control):
+    """ A FileResponse for `name` under `root`, honouring conditional GETs and Accept-Encoding """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        path = safe_join(root, name)
+    except (SuspiciousFileOperation, ValueError):
+        return HttpResponseNotFound()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return HttpResponseNotFound()
+    if not os.path.isfile(path):
+        return HttpResponseNotFound()
+
+    # Weak, because the same validator covers the identity and compressed representations
+    etag = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {'ETag': etag, 'Last-Modified': http_date(stat.st_mtime), 'Cache-Control': cache_control}
+    variants = [(encoding, f'{path}{suffix}') for encoding, suffix in ENCODINGS if os.path.exists(f'{path}{suffix}')]
+    if variants:
+        headers['Vary'] = 'Accept-Encoding'
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        accepted = accepted_encodings(request)
+        encoding, served = next(((encoding, served) for encoding, served in variants if encoding in accepted),
+                                (None, path))
+        if encoding is None and 'identity' not in accepted:
+            response = HttpResponse(status=406)  # Not Acceptable: no variant the client takes
+            response['Vary'] = 'Accept-Encoding'
+            return response
+        content_type, _ = mimetypes.guess_type(path)
+        response = FileResponse(open(served, 'rb'), content_type=content_type or 'application/octet-stream')
+        if encoding:
+            response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def static_cache_control(name):
+    return IMMUTABLE if HASHED_NAME_RE.search(name) else REVALIDATE
+
+
+def media_cache_control(name):
+    # Rendition file names carry a hash of their source image; the manifest beside them doesn't
+    return IMMUTABLE if name.startswith(f'{RENDITIONS_DIR}/') and RENDITION_NAME_RE.search(name) else REVALIDATE
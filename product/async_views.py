@@ -0,0 +1,131 @@
+"""
+Async versions of the cart API and the views that wait on Stripe.
+
+Under an ASGI server (``ecommerce_store.asgi``) these park on the event loop
+while Stripe answers instead of holding a worker thread, so one process keeps
+many checkouts in flight.  Reads use the async ORM; the transactional writes
+(cart summary refresh, stock reservation, order creation) still run in
+Django's sync thread via ``sync_to_async``, as there are no async
+transactions yet.  Templates render through ``sync_to_async`` too: the
+context processors query the database.  Set ASYNC_VIEWS=1 to route the
+URLs here; under WSGI keep the sync views.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.shortcuts import aget_object_or_404, redirect, render
+
+from .anonymous_cart import get_anonymous_cart
+from .cart import CartOperationError, aget_cart_summary, cart_lines
+from .inventory import OutOfStock, aadd_to_cart, hold_stock_for_session, reservation_ttl
+from .models import CartItem, Order, Product
+from .orders import create_order_from_cart
+from .payments import SessionNotFound, get_gateway
+from .views import render_out_of_stock, see_other
+
+logger = logging.getLogger(__name__)
+
+arender = sync_to_async(render)
+
+
+async def add_to_cart(request, product_id):
+    user = await request.auser()
+    product = await aget_object_or_404(Product, id=product_id)
+    if product.stock < 1:
+        return JsonResponse({"success": False, "error": f"{product.name} is out of stock"}, status=409)
+    if not user.is_authenticated:
+        cart = get_anonymous_cart(request)  # Cookie only, nothing to await
+        try:
+            cart.add(product.id)
+        except CartOperationError as e:
+            return JsonResponse({"success": False, "error": str(e)}, status=409)
+        return JsonResponse({"success": True, "cart_count": cart.item_count})
+    await aadd_to_cart(user, product)
+    return JsonResponse({"success": True, "cart_count": (await aget_cart_summary(user)).item_count})
+
+
+@login_required
+async def update_cart(request):
+    if request.method != "POST":
+        return JsonResponse({"success": False, "error": "Invalid request"}, status=400)
+
+    user = await request.auser()
+    cart_item_id = request.POST.get("cart_item_id")
+    new_quantity = int(request.POST.get("quantity", 1))
+    try:
+        cart_item = await CartItem.objects.select_related('product').aget(id=cart_item_id, user=user)
+    except CartItem.DoesNotExist:
+        logger.warning("cart_item_not_found item=%s user=%s", cart_item_id, user.pk)
+        return JsonResponse({"success": False, "error": "Item not found"}, status=400)
+
+    if new_quantity > 0:
+        cart_item.quantity = new_quantity
+        await cart_item.asave()
+    else:
+        await cart_item.adelete()  # Remove item if quantity is set to 0
+
+    total_amount = float((await aget_cart_summary(user)).total_amount)
+    item_total_price = float(cart_item.product.price * cart_item.quantity) if new_quantity > 0 else 0
+    logger.debug("cart_updated item=%s quantity=%s total=%s", cart_item_id, new_quantity, total_amount)
+    return JsonResponse({
+        "success": True,
+        "total_amount": total_amount,
+        "item_total_price": item_total_price,
+        "cart_item_id": cart_item.id,
+    })
+
+
+@login_required
+async def create_checkout_session(request):
+    user = await request.auser()
+    cart_items = [item async for item in cart_lines(user)]
+    if not cart_items:
+        return redirect('view_cart')
+
+    gateway = get_gateway()
+    session, created = await gateway.astart_checkout(
+        user,
+        cart_items,
+        success_url=request.build_absolute_uri('/products/success/') + '?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url=request.build_absolute_uri('/products/cancel/'),
+        expires_in=reservation_ttl(),
+    )
+    try:
+        await sync_to_async(hold_stock_for_session)(user, cart_items, session, created)
+    except OutOfStock as e:
+        await gateway.aforget_open_session(user.pk)
+        return await sync_to_async(render_out_of_stock)(request, cart_items, e)
+    return see_other(session.url)
+
+
+@login_required
+async def payment_success(request):
+    user = await request.auser()
+    session_id = request.GET.get('session_id')
+    logger.debug("payment_success session=%s user=%s", session_id, user.pk)
+    if not session_id:
+        return await arender(request, 'error.html', {'message': 'Session ID not found'})
+
+    # Normally the webhook worker has already created the order: a local read
+    order = await Order.objects.filter(stripe_session_id=session_id, user=user).afirst()
+    if order is None:
+        try:
+            session = await get_gateway().aget_session(session_id)
+        except SessionNotFound as e:
+            logger.warning("stripe_session_not_found session=%s error=%s", session_id, e)
+            return await arender(request, 'error.html', {'message': 'Invalid Stripe session'})
+        if not session.is_paid_by(user):
+            logger.info("payment_pending session=%s user=%s status=%s", session_id, user.pk, session.payment_status)
+            return await arender(request, 'payment_pending.html')
+        if not session.customer_email:
+            return await arender(request, 'error.html', {'message': 'Customer email not found in Stripe session'})
+
+        order, created = await sync_to_async(create_order_from_cart)(user, session_id, email=session.customer_email)
+        if order.user_id != user.id:
+            return await arender(request, 'error.html', {'message': 'Invalid Stripe session'})
+        if created:
+            logger.info("order_created order=%s user=%s session=%s", order.id, user.pk, session_id)
+
+    return await arender(request, 'success.html', {'order': order})
@@ -0,0 +1,65 @@
+"""
+Authentication backend that keeps the logged-in user out of the database.
+
+``AuthenticationMiddleware`` loads ``request.user`` lazily, at most once per
+request, but every request that touches it (every cart click) still costs a
+``SELECT`` on auth_user.  ``CachedModelBackend`` keeps users in the default
+cache for USER_CACHE_TIMEOUT seconds, so together with the cached_db session
+engine an authenticated JSON request reaches the view without a query.
+
+Saving or deleting a User drops its entry (see ``product.signals``), so a
+password change, deactivation or permission flag takes effect on the next
+request.  The session hash check still runs against the cached user, so
+changing a password logs out other sessions as before.
+
+The plain ``ModelBackend`` stays in AUTHENTICATION_BACKENDS only so sessions
+created before the switch still resolve.  It checks credentials exactly as
+this backend does, so a login this backend rejects ends the
+``authenticate()`` chain there instead of hashing the password a second time.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """ ModelBackend whose get_user() reads through the cache """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user = super().authenticate(request, username=username, password=password, **kwargs)
+        if user is None:
+            raise PermissionDenied  # Stops authenticate() before ModelBackend repeats the check
+        return user
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        user = await super().aauthenticate(request, username=username, password=password, **kwargs)
+        if user is None:
+            raise PermissionDenied
+        return user
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
+
+    async def aget_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = await cache.aget(key)
+        if user is None:
+            user = await super().aget_user(user_id)
+            if user is not None:
+                await cache.aset(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
@@ -0,0 +1,446 @@
+"""
+Synthetic data, a request-path benchmark and a start-up profile for the storefront.
+
+``manage.py seed_catalog`` fills the database with products, users, carts and
+orders; ``manage.py run_benchmarks`` drives the hot views and writes p50/p95/p99
+latency, queries per request and peak RSS as JSON so runs can be compared.
+Both write to the configured database, so point DB_NAME at a scratch copy.
+``manage.py profile_startup`` starts fresh interpreters under
+``python -X importtime`` and reports what a worker spends before its first
+request, and on which imports.
+"""
+import asyncio
+import http.cookiejar
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import StringIO
+
+import django
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from django.utils.text import slugify
+
+from .caching import bump_catalog_version
+from .models import CartItem, Category, Order, OrderItem, Product
+from .payments import get_gateway
+from .search import get_search_backend
+
+USERNAME_PREFIX = 'bench-user-'
+PASSWORD = 'benchmark'
+CATEGORIES = ['Electronics', 'Clothing', 'Home', 'Sports', 'Books', 'Toys', 'Garden', 'Beauty']
+ADJECTIVES = ['Classic', 'Wireless', 'Organic', 'Compact', 'Deluxe', 'Vintage', 'Smart', 'Rugged', 'Slim', 'Pro']
+NOUNS = ['Watch', 'Jacket', 'Lamp', 'Kettle', 'Backpack', 'Speaker', 'Novel', 'Sneaker', 'Blender', 'Tent']
+
+# Stock large enough that repeated checkouts never run a seeded product out
+SEED_STOCK = 1_000_000
+
+
+def seed(products=10_000, users=100, cart_lines=5, orders=10, batch_size=5000, random_seed=0):
+    """ Bulk-insert synthetic rows (added to whatever is already there); returns the counts created """
+    rng = random.Random(random_seed)
+
+    categories = [Category.objects.get_or_create(slug=slugify(name), defaults={'name': name})[0] for name in CATEGORIES]
+    first = Product.objects.count()
+    for start in range(0, products, batch_size):
+        Product.objects.bulk_create([
+            Product(
+                name=f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {first + index}',
+                description=' '.join(rng.choices(ADJECTIVES + NOUNS, k=12)).lower(),
+                category=rng.choice(categories),
+                price=Decimal(rng.randrange(100, 100_000)) / 100,
+                stock=SEED_STOCK,
+            )
+            for index in range(start, min(start + batch_size, products))
+        ])
+    product_ids = list(Product.objects.values_list('id', flat=True))
+
+    password = make_password(PASSWORD)  # Hashing is slow; every seeded user shares one hash
+    first = User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+    new_users = User.objects.bulk_create([
+        User(username=f'{USERNAME_PREFIX}{first + index}', password=password) for index in range(users)
+    ], batch_size=batch_size)
+    new_users = list(User.objects.filter(username__in=[user.username for user in new_users]))
+
+    with transaction.atomic():
+        CartItem.objects.bulk_create([
+            CartItem(user=user, product_id=product_id, quantity=rng.randint(1, 3))
+            for user in new_users
+            for product_id in rng.sample(product_ids, min(cart_lines, len(product_ids)))
+        ], batch_size=batch_size)
+        created_orders = seed_orders(new_users, product_ids, orders, rng, batch_size)
+
+    # bulk_create skips the model signals, so rebuild what they would have maintained
+    call_command('reconcile_cart_summaries', stdout=StringIO())
+    get_search_backend().rebuild()
+    bump_catalog_version()
+    return {'products': products, 'users': len(new_users), 'cart_items': len(new_users) * cart_lines,
+            'orders': created_orders}
+
+
+def seed_orders(users, product_ids, per_user, rng, batch_size):
+    prices = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'price'))
+    names = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'name'))
+    categories = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'category_id'))
+    plans = [
+        (user, [(product_id, rng.randint(1, 3)) for product_id in rng.sample(product_ids, min(3, len(product_ids)))])
+        for user in users
+        for _ in range(per_user)
+    ]
+    orders = Order.objects.bulk_create([
+        Order(user=user, customer_name=user.username, date=timezone.now(),
+              total_amount=sum(prices[product_id] * quantity for product_id, quantity in lines))
+        for user, lines in plans
+    ], batch_size=batch_size)
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_id=product_id, product_name=names[product_id],
+                  unit_price=prices[product_id], category_id=categories[product_id], quantity=quantity)
+        for order, (user, lines) in zip(orders, plans)
+        for product_id, quantity in lines
+    ], batch_size=batch_size)
+    return len(orders)
+
+
+class HttpClient:
+    """ The slice of django.test.Client the scenarios use, over real HTTP to a running server """
+
+    def __init__(self, base_url, sessionid=None):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+        host = urllib.parse.urlsplit(self.base_url).hostname
+        # Any well-formed token passes CSRF as long as the cookie and header agree
+        self.csrf_token = get_random_string(32)
+        self.set_cookie(host, 'csrftoken', self.csrf_token)
+        if sessionid:
+            self.set_cookie(host, 'sessionid', sessionid)
+
+    def set_cookie(self, host, name, value):
+        self.cookies.set_cookie(http.cookiejar.Cookie(
+            0, name, value, None, False, host, False, False, '/', True, False, None, False, None, None, {},
+        ))
+
+    def get(self, path, data=None):
+        query = f'?{urllib.parse.urlencode(data)}' if data else ''
+        return self.request(urllib.request.Request(self.base_url + path + query))
+
+    def post(self, path, data=None):
+        body = urllib.parse.urlencode(data or {}).encode()
+        return self.request(urllib.request.Request(self.base_url + path, data=body,
+                                                   headers={'X-CSRFToken': self.csrf_token}))
+
+    def request(self, request):
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return HttpResult(response.status)
+        except urllib.error.HTTPError as e:
+            return HttpResult(e.code)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # Measure the view itself, like the test client does
+
+
+class HttpResult:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+# Each scenario takes (client, rng, context) and makes one request
+def home(client, rng, context):
+    return client.get(reverse('home'))
+
+
+def product_list(client, rng, context):
+    return client.get(reverse('product_list'))
+
+
+def product_search(client, rng, context):
+    return client.get(reverse('product_list'), {'search': rng.choice(NOUNS).lower()})
+
+
+def product_filter(client, rng, context):
+    return client.get(reverse('product_list'), {
+        'category': rng.choice(CATEGORIES), 'min_price': 10, 'max_price': 500, 'sort': rng.choice(['price', '-price']),
+    })
+
+
+def add_to_cart(client, rng, context):
+    return client.post(reverse('add_to_cart', args=[rng.choice(context['product_ids'])]))
+
+
+def update_cart(client, rng, context):
+    return client.post(reverse('update_cart'), {'cart_item_id': client.cart_item_id, 'quantity': rng.randint(1, 5)})
+
+
+def view_cart(client, rng, context):
+    return client.get(reverse('view_cart'))
+
+
+def checkout(client, rng, context):
+    return client.post(reverse('create_checkout_session'))  # Where the checkout page's form posts
+
+
+def checkout_new_session(client, rng, context):
+    get_gateway().forget_open_session(client.user.pk)  # As if the cart changed: every request calls Stripe
+    return client.post(reverse('create_checkout_session'))
+
+
+def order_history(client, rng, context):
+    return client.get(reverse('order_history'))
+
+
+# name: (scenario, needs a logged-in client)
+SCENARIOS = {
+    'home': (home, False),
+    'product_list': (product_list, False),
+    'product_search': (product_search, False),
+    'product_filter': (product_filter, False),
+    'add_to_cart': (add_to_cart, True),
+    'update_cart': (update_cart, True),
+    'view_cart': (view_cart, True),
+    'checkout': (checkout, True),
+    'checkout_new_session': (checkout_new_session, True),
+    'order_history': (order_history, True),
+}
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest-rank percentile of an already sorted list """
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def peak_rss_kb():
+    import resource  # Unix-only, so seeding and comparing results still work on Windows
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if platform.system() == 'Darwin' else usage  # macOS reports bytes, Linux KiB
+
+
+def summarize(latencies, queries, errors):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'queries_mean': round(statistics.fmean(queries), 2) if queries else None,
+        'queries_max': max(queries) if queries else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def make_clients(users, base_url=None, asgi=False):
+    """ One client per user, logged in through a real session so it works over HTTP too """
+    cart_items = dict(CartItem.objects.filter(user__in=users).order_by('id').values_list('user_id', 'id'))
+    clients = []
+    for user in users:
+        client = AsyncClient() if asgi else Client()
+        client.force_login(user)
+        if base_url:
+            client = HttpClient(base_url, sessionid=client.cookies['sessionid'].value)
+        client.user = user
+        client.cart_item_id = cart_items.get(user.pk)  # Looked up now: scenarios can't query from the event loop
+        clients.append(client)
+    return clients
+
+
+def drive(scenario, clients, rng, context, count, concurrency, count_queries):
+    """ Make `count` requests, `concurrency` at a time on a thread pool; returns (latencies, queries, statuses) """
+    def one(index):
+        client = clients[index % len(clients)]
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = scenario(client, rng, context)
+            elapsed = time.perf_counter() - start
+        return elapsed, len(captured.captured_queries), response.status_code
+
+    if concurrency == 1:
+        results = [one(index) for index in range(count)]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(count)))
+    latencies, queries, statuses = zip(*results) if results else ((), (), ())
+    return list(latencies), list(queries) if count_queries else [], list(statuses)
+
+
+async def adrive(scenario, clients, rng, context, count, concurrency):
+    """ drive() for AsyncClient: `concurrency` requests in flight on this thread's event loop """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        async with slots:
+            start = time.perf_counter()
+            response = await scenario(clients[index % len(clients)], rng, context)
+            return time.perf_counter() - start, response.status_code
+
+    results = await asyncio.gather(*(one(index) for index in range(count)))
+    return [elapsed for elapsed, _ in results], [], [status for _, status in results]
+
+
+def run(scenarios=None, requests=200, warmup=10, users=10, base_url=None, asgi=False, concurrency=1,
+        random_seed=0):
+    """
+    Drive each scenario `requests` times and return the results document.
+
+    Without `base_url` requests go through Django's test client in this
+    process (the WSGI handler, or the ASGI one with `asgi`) and queries are
+    counted when requests run one at a time; with it they go over HTTP to a
+    running server.  `concurrency` requests are kept in flight: on a thread
+    pool for WSGI/HTTP, as coroutines on one event loop for ASGI.
+    """
+    rng = random.Random(random_seed)
+    shoppers = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id')[:users])
+    context = {'product_ids': list(Product.objects.values_list('id', flat=True)[:10_000])}
+    if not context['product_ids'] or not shoppers:
+        raise ValueError("Nothing to benchmark: run `manage.py seed_catalog` first")
+
+    if base_url:
+        anonymous = [HttpClient(base_url) for _ in range(concurrency)]
+    else:
+        anonymous = [AsyncClient() if asgi else Client() for _ in range(concurrency)]
+    clients = make_clients(shoppers, base_url, asgi)
+    count_queries = not base_url and not asgi and concurrency == 1
+    results = {}
+    for name in scenarios or SCENARIOS:
+        scenario, needs_login = SCENARIOS[name]
+        pool = clients if needs_login else anonymous
+        cache.clear()  # Every scenario starts cold, then warms up like a live site would
+        if asgi:
+            # async_to_sync, not asyncio.run: sync views and ORM calls then share this thread's connection
+            async_to_sync(adrive)(scenario, pool, rng, context, warmup, 1)
+            start = time.perf_counter()
+            latencies, queries, statuses = async_to_sync(adrive)(scenario, pool, rng, context, requests, concurrency)
+        else:
+            drive(scenario, pool, rng, context, warmup, 1, False)
+            start = time.perf_counter()
+            latencies, queries, statuses = drive(scenario, pool, rng, context, requests, concurrency, count_queries)
+        wall = time.perf_counter() - start
+        errors = sum(1 for status in statuses if status >= 400)
+        results[name] = summarize(latencies, queries, errors)
+        results[name]['throughput_rps'] = round(len(latencies) / wall, 1) if wall else None
+
+    return {
+        'meta': {
+            'timestamp': timezone.now().isoformat(),
+            'target': base_url or ('asgi-client' if asgi else 'test-client'),
+            'requests': requests,
+            'warmup': warmup,
+            'concurrency': concurrency,
+            'users': len(shoppers),
+            'products': Product.objects.count(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+        },
+        'scenarios': results,
+    }
+
+
+def compare(current, baseline, metric='p95_ms'):
+    """ Rows of (scenario, baseline, current, change %) for the scenarios both runs measured """
+    rows = []
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or before.get(metric) is None or result.get(metric) is None:
+            continue
+        change = (result[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+        rows.append((name, before[metric], result[metric], round(change, 1)))
+    return rows
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# What each start-up target runs in the fresh interpreter
+STARTUP_TARGETS = {
+    'setup': "import django; django.setup()",  # What every management command pays
+    'wsgi': "from ecommerce_store.wsgi import application",
+    # A worker ready to answer: the first request imports the URLconf and every view
+    'ready': "from ecommerce_store.wsgi import application\n"
+             "from django.urls import get_resolver; get_resolver().url_patterns",
+}
+STARTUP_PROBE = """
+import json, platform, time
+start = time.perf_counter()
+{target}
+seconds = time.perf_counter() - start
+import resource
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': seconds, 'rss_kb': rss // 1024 if platform.system() == 'Darwin' else rss}}))
+"""
+
+
+def parse_importtime(output):
+    """ [(module, self_us, cumulative_us, depth)] from `python -X importtime` stderr """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def import_costs(modules):
+    """ {top-level package: microseconds of its own import work}, most expensive first """
+    costs = {}
+    for name, self_us, _, _ in modules:
+        package = name.split('.')[0]
+        costs[package] = costs.get(package, 0) + self_us
+    return dict(sorted(costs.items(), key=lambda item: item[1], reverse=True))
+
+
+def profile_startup(target='ready', repeat=5, preload=False, settings_module='ecommerce_store.settings'):
+    """ Start `repeat` fresh interpreters on `target` and return the median timings and import profile """
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings_module, 'PRELOAD_APP': '1' if preload else '0'}
+    code = STARTUP_PROBE.format(target=STARTUP_TARGETS[target])
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                                 capture_output=True, text=True, check=True)
+        wall = time.perf_counter() - start
+        probe = json.loads(process.stdout.strip().splitlines()[-1])
+        runs.append((wall, probe['seconds'], probe['rss_kb'], parse_importtime(process.stderr)))
+
+    runs.sort(key=lambda run: run[0])
+    wall, seconds, rss_kb, modules = runs[len(runs) // 2]
+    return {
+        'target': target,
+        'preload': preload,
+        'runs': repeat,
+        'process_ms': round(wall * 1000, 1),  # Interpreter start to exit
+        'startup_ms': round(seconds * 1000, 1),  # Running the target alone
+        'import_ms': round(sum(self_us for _, self_us, _, _ in modules) / 1000, 1),
+        'modules': len(modules),
+        'rss_kb': rss_kb,
+        'packages_ms': {name: round(us / 1000, 1) for name, us in import_costs(modules).items()},
+    }
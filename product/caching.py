@@ -0,0 +1,77 @@
+"""
+Page and fragment caching for the storefront.
+
+Anonymous responses for the home page and catalog are cached whole, keyed by
+path, the normalized query string and a catalog version number that every
+Product save/delete bumps (see ``product.signals``), so one write invalidates
+every cached page at once without having to enumerate keys.  Logged-in users
+(and visitors with a cookie cart) always get a fresh page because it carries
+their cart badge; they still share the per-product card fragments
+(``{% cache %}`` keyed by id and updated_at).
+"""
+import hashlib
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+
+from .anonymous_cart import has_anonymous_cart
+
+CATALOG_VERSION_KEY = 'catalog:version'
+PAGE_CACHE_TIMEOUT = 10 * 60
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        # add() so two processes starting at once agree on a single version
+        if not cache.add(CATALOG_VERSION_KEY, version, None):
+            version = cache.get(CATALOG_VERSION_KEY, version)
+    return version
+
+
+def bump_catalog_version():
+    """ Invalidate every cached catalog page """
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:  # Not set yet (or evicted): any fresh value invalidates
+        cache.set(CATALOG_VERSION_KEY, int(time.time() * 1000), None)
+
+
+def page_cache_key(prefix, request):
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    digest = hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+    return f'page:{prefix}:{catalog_version()}:{digest}'
+
+
+def is_shared_request(request):
+    """ True when the response is the same for every visitor and may be cached """
+    # A visitor with a cookie cart sees their own badge count
+    return request.method in ('GET', 'HEAD') and not request.user.is_authenticated and not has_anonymous_cart(request)
+
+
+def cache_anonymous_page(prefix, timeout=PAGE_CACHE_TIMEOUT):
+    """ Cache a view's response for anonymous visitors (never for logged-in users) """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_shared_request(request):
+                return view(request, *args, **kwargs)
+
+            key = page_cache_key(prefix, request)
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.cookies:
+                    cache.set(key, response, timeout)
+                response['X-Page-Cache'] = 'MISS'
+            else:
+                response['X-Page-Cache'] = 'HIT'
+            # Cached pages read the CSRF token from the cookie, so make sure it's set
+            get_token(request)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,194 @@
+"""
+Per-user cart totals.
+
+``CartSummary`` holds the item count and total amount of each user's cart so
+the navbar badge and cart endpoints read one row (or the cache) instead of
+re-summing every ``CartItem``.  Anything that writes cart rows without going
+through ``CartItem.save``/``delete`` (``QuerySet.update``, bulk operations)
+must call ``refresh_cart_summary`` itself.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import CartItem, CartSummary, Product
+
+CACHE_KEY = 'cart-summary:{}'
+CACHE_TIMEOUT = 60 * 60
+MAX_CART_OPERATIONS = 100
+
+Totals = namedtuple('Totals', ['item_count', 'total_amount'])
+EMPTY = Totals(0, Decimal('0.00'))
+
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+
+# User ids whose summary refresh is deferred by batched_summary_refresh()
+_pending_refresh = ContextVar('pending_cart_summary_refresh', default=None)
+
+
+def cart_totals(user_id):
+    """ Aggregate a user's cart in the database (one query, no rows loaded) """
+    totals = CartItem.objects.filter(user_id=user_id).aggregate(
+        item_count=Coalesce(Sum('quantity'), 0),
+        total_amount=Coalesce(Sum(F('product__price') * F('quantity'), output_field=MONEY), Value(Decimal('0.00')),
+                              output_field=MONEY),
+    )
+    return Totals(totals['item_count'], totals['total_amount'])
+
+
+def cart_lines(user):
+    """ A user's cart rows with their product joined in the same query """
+    return CartItem.objects.filter(user=user).select_related('product').order_by('id')
+
+
+def refresh_cart_summary(user_id):
+    """ Recompute and store a user's cart totals; call after any cart write """
+    if user_id is None:
+        return EMPTY
+    pending = _pending_refresh.get()
+    if pending is not None:
+        pending.add(user_id)
+        return None
+    with transaction.atomic():
+        # Lock the summary row first so concurrent refreshes serialize and the
+        # last writer always aggregates the latest committed cart.
+        summary, _ = CartSummary.objects.select_for_update().get_or_create(user_id=user_id)
+        totals = cart_totals(user_id)
+        CartSummary.objects.filter(pk=summary.pk).update(**totals._asdict())
+        # Drop the cached copy now for reads inside this transaction, and again
+        # on commit in case another request re-cached the old row meanwhile.
+        key = CACHE_KEY.format(user_id)
+        cache.delete(key)
+        transaction.on_commit(lambda: cache.delete(key))
+    return totals
+
+
+@contextmanager
+def batched_summary_refresh():
+    """ Refresh each touched summary once on exit instead of once per cart row write """
+    if _pending_refresh.get() is not None:  # Already batching further up the stack
+        yield
+        return
+    pending = set()
+    token = _pending_refresh.set(pending)
+    try:
+        yield
+    finally:
+        _pending_refresh.reset(token)
+    for user_id in pending:
+        refresh_cart_summary(user_id)
+
+
+class CartOperationError(ValueError):
+    pass
+
+
+def parse_operation(operation):
+    """ Validate one `{cart_item_id|product_id, quantity|add}` operation; returns (key, value, set_quantity) """
+    if not isinstance(operation, dict):
+        raise CartOperationError("Each operation must be an object")
+    if ('cart_item_id' in operation) == ('product_id' in operation):
+        raise CartOperationError("Each operation needs exactly one of cart_item_id or product_id")
+    if ('quantity' in operation) == ('add' in operation) or ('add' in operation and 'product_id' not in operation):
+        raise CartOperationError("Each operation needs a quantity, or `add` with a product_id")
+    key = ('item', operation['cart_item_id']) if 'cart_item_id' in operation else ('product', operation['product_id'])
+    value = operation.get('quantity', operation.get('add'))
+    if not isinstance(key[1], int) or not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise CartOperationError("Ids and quantities must be non-negative integers")
+    return key, value, 'quantity' in operation
+
+
+def apply_cart_operations(user, operations):
+    """
+    Apply a batch of cart changes in one transaction.
+
+    `{"cart_item_id": 5, "quantity": 3}` sets a line's quantity (0 removes
+    it), `{"product_id": 7, "quantity": 2}` does the same by product
+    (creating the line), and `{"product_id": 7, "add": 1}` increments.
+    Operations run in order, so later ones win.  Raises CartOperationError
+    (and changes nothing) on a malformed batch or a cart_item_id that isn't
+    in the user's cart.  Increases for products that are out of stock (or
+    don't exist) are skipped and their ids returned.  The query count
+    doesn't depend on the batch size.
+
+    Returns (lines, totals, unavailable_product_ids).
+    """
+    if not isinstance(operations, list) or len(operations) > MAX_CART_OPERATIONS:
+        raise CartOperationError(f"operations must be a list of at most {MAX_CART_OPERATIONS} items")
+    parsed = [parse_operation(operation) for operation in operations]
+
+    with transaction.atomic(), batched_summary_refresh():
+        items = {item.id: item for item in CartItem.objects.select_for_update().filter(user=user)}
+        quantities = {item.product_id: item.quantity for item in items.values()}
+        for (kind, ident), value, set_quantity in parsed:
+            if kind == 'item':
+                if ident not in items:
+                    raise CartOperationError(f"Cart item {ident} is not in your cart")
+                quantities[items[ident].product_id] = value
+            else:
+                quantities[ident] = value if set_quantity else quantities.get(ident, 0) + value
+
+        existing = {item.product_id: item for item in items.values()}
+        wanted = [product_id for product_id, quantity in quantities.items()
+                  if quantity > 0 and quantity > getattr(existing.get(product_id), 'quantity', 0)]
+        in_stock = set(Product.objects.filter(id__in=wanted, stock__gt=0).values_list('id', flat=True))
+        unavailable = set(wanted) - in_stock
+
+        changed, removed, created = [], [], []
+        for product_id, quantity in quantities.items():
+            item = existing.get(product_id)
+            if product_id in unavailable:
+                continue
+            if item is None:
+                if quantity > 0:
+                    created.append(CartItem(user=user, product_id=product_id, quantity=quantity))
+            elif quantity == 0:
+                removed.append(item.id)
+            elif quantity != item.quantity:
+                item.quantity = quantity
+                changed.append(item)
+
+        if changed:
+            CartItem.objects.bulk_update(changed, ['quantity'])
+        if removed:
+            CartItem.objects.filter(id__in=removed).delete()
+        if created:
+            # A concurrent add_to_cart may have created the row meanwhile: the batch's quantity wins
+            CartItem.objects.bulk_create(created, update_conflicts=True, unique_fields=['user', 'product'],
+                                         update_fields=['quantity'])
+        refresh_cart_summary(user.pk)
+
+    lines = list(cart_lines(user))
+    return lines, get_cart_summary(user), sorted(unavailable)
+
+
+async def aget_cart_summary(user):
+    """ get_cart_summary() for async views """
+    if not user.is_authenticated:
+        return EMPTY
+    key = CACHE_KEY.format(user.pk)
+    totals = await cache.aget(key)
+    if totals is None:
+        row = await CartSummary.objects.filter(pk=user.pk).values_list('item_count', 'total_amount').afirst()
+        totals = Totals(*row) if row else EMPTY
+        await cache.aset(key, tuple(totals), CACHE_TIMEOUT)
+    return Totals(*totals)
+
+
+def get_cart_summary(user):
+    """ Cart totals for the badge: a cache hit, or a single primary-key lookup """
+    if not user.is_authenticated:
+        return EMPTY
+    key = CACHE_KEY.format(user.pk)
+    totals = cache.get(key)
+    if totals is None:
+        row = CartSummary.objects.filter(pk=user.pk).values_list('item_count', 'total_amount').first()
+        totals = Totals(*row) if row else EMPTY
+        cache.set(key, tuple(totals), CACHE_TIMEOUT)
+    return Totals(*totals)
@@ -0,0 +1,320 @@
+"""
+Bulk catalog import and export (``manage.py import_products`` / ``export_products``).
+
+Both stream CSV or JSONL one chunk at a time, so memory stays flat however
+large the file is.  Imports are keyed on ``Product.sku``: each chunk costs one
+lookup of the existing rows and one upsert (``bulk_create`` with
+``update_conflicts``) whatever its size, and image URLs in a chunk are
+downloaded on a thread pool.
+The bulk writes skip the model signals, so each chunk re-indexes the
+products it wrote for search, and cart summaries and the catalog version are
+brought up to date once at the end, as ``seed_catalog`` does.
+
+The ``stock`` column is the on-hand count.  ``Product.stock`` is what is
+still available to sell, since checkout takes reserved units off it (see
+``product.inventory``), so an import subtracts the units held by active
+reservations and an export adds them back.
+"""
+import csv
+import json
+import logging
+import posixpath
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from io import StringIO
+from itertools import islice
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils.text import slugify
+
+from .caching import bump_catalog_version
+from .models import Category, Product, StockReservation
+from .search import get_search_backend
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['sku', 'name', 'description', 'price', 'stock', 'category', 'image']
+UPDATE_FIELDS = ['name', 'description', 'price', 'stock', 'category', 'image', 'renditions', 'updated_at']
+FORMATS = ('csv', 'jsonl')
+DOWNLOAD_TIMEOUT = 20  # Seconds per image
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_REPORTED_ERRORS = 100
+
+
+class RowError(ValueError):
+    pass
+
+
+def detect_format(path, format=None):
+    """ The explicit format, else the file extension's """
+    if format:
+        return format
+    extension = posixpath.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    raise ValueError(f"Can't tell the format of {path!r}; pass --format ({'/'.join(FORMATS)})")
+
+
+def read_rows(stream, format):
+    """ Yield (line_number, row dict or RowError) from an open file, one line at a time """
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = RowError(f"invalid JSON: {e}")
+        yield line_number, row if isinstance(row, (dict, RowError)) else RowError("expected a JSON object")
+
+
+def parse_row(row):
+    """ Validate one input row into Product field values """
+    def text(name, max_length, required=True):
+        value = str(row.get(name) or '').strip()
+        if required and not value:
+            raise RowError(f"{name} is required")
+        if max_length and len(value) > max_length:
+            raise RowError(f"{name} is longer than {max_length} characters")
+        return value
+
+    try:
+        price = Decimal(str(row.get('price', ''))).quantize(Decimal('0.01'))
+        stock = int(row.get('stock') or 0)
+    except (InvalidOperation, TypeError, ValueError):
+        raise RowError("price must be a decimal and stock an integer")
+    if price < 0 or stock < 0:
+        raise RowError("price and stock can't be negative")
+    return {
+        'sku': text('sku', 64),
+        'name': text('name', 100),
+        'description': text('description', None, required=False),
+        'price': price,
+        'stock': stock,
+        'category': text('category', 50),
+        'image': text('image', None, required=False),
+    }
+
+
+def is_url(value):
+    return urllib.parse.urlsplit(value).scheme in ('http', 'https')
+
+
+def image_name(sku, url):
+    """ Where a downloaded image is stored; stable per SKU and URL file name, so re-imports reuse it """
+    basename = posixpath.basename(urllib.parse.urlsplit(url).path) or 'image'
+    stem, extension = posixpath.splitext(basename)
+    return f"products/{slugify(sku)}-{slugify(stem)}{extension.lower()}"
+
+
+def download_image(url, name):
+    if default_storage.exists(name):
+        return name
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        data = response.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise RowError(f"image larger than {MAX_IMAGE_BYTES} bytes")
+    return default_storage.save(name, ContentFile(data))
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = self.updated = self.unchanged = self.failed = self.images = 0
+        self.errors = []  # The first MAX_REPORTED_ERRORS (line, message)
+
+    def error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_number, message))
+
+    def summary(self):
+        return (f"{self.created} created, {self.updated} updated, {self.unchanged} unchanged, "
+                f"{self.failed} failed, {self.images} images attached")
+
+
+class CatalogImporter:
+    """
+    Create or update products from parsed rows, one chunk at a time.
+
+    With dry_run nothing is written or downloaded; `on_change` is called with
+    a one-line diff for every product that would be created or changed.
+    """
+
+    def __init__(self, chunk_size=1000, dry_run=False, image_workers=8, on_change=None):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.image_workers = image_workers
+        self.on_change = on_change or (lambda line: None)
+        self.categories = {}  # slug -> Category, for the whole run
+        self.report = ImportReport()
+        self.repriced = False
+
+    def run(self, rows):
+        with ThreadPoolExecutor(max_workers=self.image_workers) as pool:
+            self.pool = pool
+            rows = iter(rows)
+            while chunk := list(islice(rows, self.chunk_size)):
+                self.import_chunk(chunk)
+        if not self.dry_run and (self.report.created or self.report.updated):
+            self.finish()
+        return self.report
+
+    def import_chunk(self, chunk):
+        parsed = {}  # sku -> (line_number, values); a later row for the same SKU wins
+        for line_number, row in chunk:
+            try:
+                if isinstance(row, RowError):
+                    raise row
+                values = parse_row(row)
+            except RowError as e:
+                self.report.error(line_number, str(e))
+                continue
+            parsed[values['sku']] = (line_number, values)
+        if not parsed:
+            return
+
+        existing = Product.objects.select_related('category').in_bulk(list(parsed), field_name='sku')
+        held = dict(
+            StockReservation.objects.filter(product__in=existing.values(), status=StockReservation.ACTIVE)
+            .values('product_id').annotate(held=Sum('quantity')).values_list('product_id', 'held')
+        )
+        categories = self.resolve_categories({values['category'] for _, values in parsed.values()})
+
+        created, changed, downloads = [], [], []
+        for sku, (line_number, values) in parsed.items():
+            category = categories.get(slugify(values['category']) or 'uncategorized')
+            if category is None:  # bulk_create ignored it: the name is taken under another slug
+                self.report.error(line_number, f"category {values['category']!r} clashes with an existing category")
+                continue
+            values['category'] = category
+            product = existing.get(sku)
+            if product is None:
+                product = Product(**{**values, 'image': ''})
+                created.append(product)
+                self.on_change(f"+ {sku} {values['name']}")
+            else:
+                values['stock'] = max(values['stock'] - held.get(product.pk, 0), 0)  # On hand -> available
+                diff = self.diff(product, values)
+                if not diff:
+                    self.report.unchanged += 1
+                    continue
+                # A fresh instance (no pk) for the upsert below; images are attached after
+                product = Product(**{**values, 'image': product.image.name, 'renditions': product.renditions})
+                changed.append(product)
+                self.repriced |= 'price' in diff
+                self.on_change(f"~ {sku} " + ', '.join(f"{name}: {old} -> {new}" for name, (old, new) in diff.items()))
+
+            image = values['image']
+            if image and not is_url(image):
+                product.image = image  # Already in MEDIA_ROOT
+            elif image and product.image.name != image_name(sku, image):
+                downloads.append((line_number, product, image))
+
+        if self.dry_run:
+            self.report.created += len(created)
+            self.report.updated += len(changed)
+            return
+        self.download_images(downloads)
+        for product in changed:
+            if product.renditions.get('source') != product.image.name:
+                product.renditions = {}  # Made for the previous image; build_renditions makes the new ones
+        # One INSERT ... ON CONFLICT (sku) DO UPDATE for the whole chunk.  bulk_update()'s
+        # CASE WHEN per row makes each statement quadratic in the batch size.
+        Product.objects.bulk_create(created + changed, batch_size=self.chunk_size, update_conflicts=True,
+                                    unique_fields=['sku'], update_fields=UPDATE_FIELDS)
+        written = Product.objects.filter(sku__in=[product.sku for product in created + changed])
+        get_search_backend().index_products(written.values_list('id', flat=True))
+        self.report.created += len(created)
+        self.report.updated += len(changed)
+
+    def diff(self, product, values):
+        """ {field: (old, new)} for the fields the row changes """
+        current = {
+            'name': product.name, 'description': product.description, 'price': product.price,
+            'stock': product.stock, 'category': product.category,
+        }
+        diff = {name: (old, values[name]) for name, old in current.items() if old != values[name]}
+        if 'category' in diff and diff['category'][0].slug == values['category'].slug:
+            del diff['category']  # An unsaved stand-in for the same category during a dry run
+        image = values['image']
+        if image and not is_url(image) and image != product.image.name:
+            diff['image'] = (product.image.name, image)
+        elif image and is_url(image) and product.image.name != image_name(product.sku, image):
+            diff['image'] = (product.image.name, image)
+        return diff
+
+    def resolve_categories(self, names):
+        """ Categories for `names`, creating missing ones (unsaved stand-ins on a dry run) """
+        wanted = {slugify(name) or 'uncategorized': name for name in names}
+        missing = [slug for slug in wanted if slug not in self.categories]
+        if missing:
+            self.categories.update(Category.objects.in_bulk(missing, field_name='slug'))
+            new = [Category(slug=slug, name=wanted[slug]) for slug in missing if slug not in self.categories]
+            if new and not self.dry_run:
+                Category.objects.bulk_create(new, ignore_conflicts=True)
+                self.categories.update(Category.objects.in_bulk([category.slug for category in new], field_name='slug'))
+            else:
+                self.categories.update((category.slug, category) for category in new)
+        return self.categories
+
+    def download_images(self, downloads):
+        def fetch(job):
+            line_number, product, url = job
+            try:
+                return job, download_image(url, image_name(product.sku, url)), None
+            except (OSError, ValueError) as e:  # URLError is an OSError
+                return job, None, e
+
+        for (line_number, product, url), name, error in self.pool.map(fetch, downloads):
+            if error is not None:
+                # The product is still imported, just without its image
+                self.report.error(line_number, f"image {url}: {error}")
+                continue
+            product.image = name
+            self.report.images += 1
+
+    def finish(self):
+        if self.repriced:
+            call_command('reconcile_cart_summaries', stdout=StringIO())
+        bump_catalog_version()
+        report = self.report
+        logger.info("catalog_imported created=%d updated=%d unchanged=%d failed=%d images=%d",
+                    report.created, report.updated, report.unchanged, report.failed, report.images)
+
+
+def export_rows(queryset, chunk_size=2000):
+    """ Yield one dict per product, reading `chunk_size` rows at a time """
+    held = (
+        StockReservation.objects.filter(product=OuterRef('pk'), status=StockReservation.ACTIVE)
+        .values('product').annotate(total=Sum('quantity')).values('total')
+    )
+    queryset = queryset.annotate(on_hand=F('stock') + Coalesce(Subquery(held), 0))
+    columns = ('sku', 'name', 'description', 'price', 'on_hand', 'category__name', 'image')
+    for values in queryset.order_by('id').values_list(*columns).iterator(chunk_size=chunk_size):
+        yield dict(zip(FIELDS, values))
+
+
+def write_rows(rows, stream, format):
+    """ Write rows as they come; returns the count """
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+        for count, row in enumerate(rows, 1):
+            writer.writerow(row)
+        return count
+    for count, row in enumerate(rows, 1):
+        stream.write(json.dumps({**row, 'price': str(row['price'])}, ensure_ascii=False) + '\n')
+    return count
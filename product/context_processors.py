@@ -1,8 +1,8 @@
-from .models import CartItem
+from .anonymous_cart import get_anonymous_cart
+from .cart import get_cart_summary
 
 def cart_count(request):
-    """ Ensure cart count is available on all pages """
-    total_cart_quantity = 0
-    if request.user.is_authenticated:
-        total_cart_quantity = sum(item.quantity for item in CartItem.objects.filter(user=request.user))
-    return {"total_cart_quantity": total_cart_quantity}
+    """ Ensure cart count is available on all pages (read from CartSummary or the cart cookie, not the cart rows) """
+    if not request.user.is_authenticated:
+        return {"total_cart_quantity": get_anonymous_cart(request).item_count}
+    return {"total_cart_quantity": get_cart_summary(request.user).item_count}
@@ -0,0 +1,98 @@
+"""
+Facet counts for the catalog's filter sidebar.
+
+Category and price-bucket counts come from one grouped query: products
+matching the search are grouped by category, with a conditional count per
+price bucket.  Each facet ignores its own filter (the category counts honour
+the price range and vice versa), so every option shows how many results
+picking it would give.  Results are cached under the catalog version, like the
+cached pages, so a product write invalidates them all at once.
+"""
+import hashlib
+from collections import namedtuple
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils.text import slugify
+
+from .caching import PAGE_CACHE_TIMEOUT, catalog_version
+
+# (min_price, max_price); None is open-ended
+PRICE_BUCKETS = [(None, 25), (25, 50), (50, 100), (100, 250), (250, None)]
+CENT = Decimal('0.01')
+
+CategoryFacet = namedtuple('CategoryFacet', ['slug', 'name', 'count', 'selected'])
+PriceFacet = namedtuple('PriceFacet', ['min_price', 'max_price', 'label', 'count', 'selected', 'query'])
+
+
+def price_range(min_price, max_price):
+    """ The catalog's inclusive ?min_price=&max_price= filter """
+    condition = Q()
+    if min_price not in (None, ''):
+        condition &= Q(price__gte=min_price)
+    if max_price not in (None, ''):
+        condition &= Q(price__lte=max_price)
+    return condition
+
+
+def bucket_bounds(low, high):
+    """ The min_price/max_price strings that select exactly one bucket; buckets are [low, high) """
+    return str(low) if low is not None else '', str(high - CENT) if high is not None else ''
+
+
+def bucket_label(low, high):
+    if low is None:
+        return f'Under ${high}'
+    if high is None:
+        return f'${low} and up'
+    return f'${low} – ${high}'
+
+
+def count_facets(products, min_price, max_price):
+    """ Per category: matches within the price range, and matches per price bucket (one query) """
+    buckets = {f'bucket_{index}': Count('id', filter=price_range(*bucket_bounds(low, high)))
+               for index, (low, high) in enumerate(PRICE_BUCKETS)}
+    rows = (
+        products.order_by()
+        .values('category__slug', 'category__name')
+        .annotate(in_range=Count('id', filter=price_range(min_price, max_price)), **buckets)
+    )
+    return [
+        (row['category__slug'], row['category__name'], row['in_range'],
+         [row[f'bucket_{index}'] for index in range(len(PRICE_BUCKETS))])
+        for row in rows
+    ]
+
+
+def get_facets(products, filters, params):
+    """
+    The sidebar's facets for `products` (the search results before the
+    category and price filters), as {'categories': [...], 'price': [...]}.
+    `params` is the request's query string, used to build each price link.
+    """
+    raw = '\0'.join([filters['query'], filters['min_price'], filters['max_price']])
+    key = f'facets:{catalog_version()}:{hashlib.md5(raw.encode()).hexdigest()}'
+    rows = cache.get(key)
+    if rows is None:
+        rows = count_facets(products, filters['min_price'], filters['max_price'])
+        cache.set(key, rows, PAGE_CACHE_TIMEOUT)
+
+    selected = slugify(filters['category'])
+    categories = [CategoryFacet(slug, name, count, slug == selected)
+                  for slug, name, count, _ in rows if count or slug == selected]
+    if selected and not any(facet.selected for facet in categories):
+        categories.append(CategoryFacet(selected, filters['category'], 0, True))
+    categories.sort(key=lambda facet: facet.name.lower())
+
+    price = []
+    for index, (low, high) in enumerate(PRICE_BUCKETS):
+        count = sum(buckets[index] for slug, _, _, buckets in rows if not selected or slug == selected)
+        bounds = bucket_bounds(low, high)
+        chosen = (filters['min_price'], filters['max_price']) == bounds
+        query = params.copy()
+        query.pop('cursor', None)
+        # Clicking the chosen bucket clears the price filter
+        query['min_price'], query['max_price'] = ('', '') if chosen else bounds
+        price.append(PriceFacet(low, high, bucket_label(low, high), count, chosen, query.urlencode()))
+    return {'categories': categories, 'price': price}
@@ -0,0 +1,95 @@
+"""
+Webhook-driven order fulfilment.
+
+The ``stripe_webhook`` view only verifies and records events (``record_event``);
+the ``process_stripe_events`` worker then turns paid Checkout Sessions into
+orders with ``create_order_from_cart``, which also queues the confirmation
+email.  Stripe redelivers events, so both steps are idempotent: the event log
+is unique on the event id and orders are unique on the session id.
+"""
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import StripeEvent
+from .orders import create_order_from_cart
+
+# Events that mean a Checkout Session has been paid for
+FULFILMENT_EVENTS = {'checkout.session.completed', 'checkout.session.async_payment_succeeded'}
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 15
+RETRY_MAX_SECONDS = 60 * 60
+LEASE_SECONDS = 5 * 60
+
+
+class FulfilmentError(Exception):
+    pass
+
+
+def record_event(event):
+    """ Store a verified event once; returns (StripeEvent, created) """
+    status = StripeEvent.PENDING if event['type'] in FULFILMENT_EVENTS else StripeEvent.IGNORED
+    return StripeEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'type': event['type'], 'payload': event, 'status': status},
+    )
+
+
+def fulfil_checkout_session(session):
+    """ Create the order for a paid Checkout Session (a Stripe session object as a dict) """
+    if session.get('payment_status') != 'paid':
+        return None  # Delayed payment methods fulfil on async_payment_succeeded instead
+    try:
+        user = User.objects.get(pk=session.get('client_reference_id'))
+    except (User.DoesNotExist, ValueError, TypeError):
+        raise FulfilmentError(f"Checkout Session {session.get('id')} has no valid client_reference_id")
+    details = session.get('customer_details') or {}
+    email = details.get('email') or session.get('customer_email') or ''
+    order, _ = create_order_from_cart(user, session['id'], email=email, customer_name=details.get('name') or '')
+    return order
+
+
+def process_event(event):
+    fulfil_checkout_session(event.payload['data']['object'])
+
+
+def claim_batch(batch_size, now):
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(status=StripeEvent.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        StripeEvent.objects.filter(id__in=[event.id for event in events]).update(
+            next_attempt_at=now + timedelta(seconds=LEASE_SECONDS)
+        )
+    return events
+
+
+def process_pending_events(batch_size=BATCH_SIZE):
+    """ Fulfil one batch of due events; returns (processed, failed) counts """
+    processed = failed = 0
+    for event in claim_batch(batch_size, timezone.now()):
+        try:
+            process_event(event)
+        except Exception as error:
+            failed += 1
+            attempts = event.attempts + 1
+            delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+            StripeEvent.objects.filter(pk=event.pk).update(
+                attempts=F('attempts') + 1,
+                last_error=str(error),
+                status=StripeEvent.FAILED if attempts >= MAX_ATTEMPTS else StripeEvent.PENDING,
+                next_attempt_at=timezone.now() + timedelta(seconds=delay),
+            )
+        else:
+            processed += 1
+            StripeEvent.objects.filter(pk=event.pk).update(
+                attempts=F('attempts') + 1, status=StripeEvent.PROCESSED, processed_at=timezone.now(), last_error='',
+            )
+    return processed, failed
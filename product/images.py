@@ -0,0 +1,156 @@
+"""
+Responsive image renditions.
+
+Every product image (and any other media file, e.g. the carousel banners) is
+resized to a few widths and encoded as AVIF/WebP (whichever Pillow supports)
+plus JPEG.  File names carry a hash of the source bytes, so they can be
+served with far-future cache headers and never need invalidating.
+
+The rendition map looks like::
+
+    {"source": "products/iphone.jpg", "width": 1200, "height": 800,
+     "formats": {"webp": [[320, "renditions/iphone.3f2a9c1b7d04.320w.webp"], ...], "jpeg": [...]}}
+
+It is stored on ``Product.renditions`` for products and in
+``MEDIA_ROOT/renditions/manifest.json`` for other media, and turned into
+``<picture>``/``srcset`` markup by ``product.templatetags.responsive_images``.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+
+RENDITIONS_DIR = 'renditions'
+MANIFEST_NAME = 'manifest.json'
+PRODUCT_WIDTHS = (320, 640, 960)
+BANNER_WIDTHS = (640, 1280, 1792)
+
+# Preferred first: browsers take the first <source> they support
+FORMATS = {
+    'avif': {'mime': 'image/avif', 'feature': 'avif', 'options': {'quality': 60}},
+    'webp': {'mime': 'image/webp', 'feature': 'webp', 'options': {'quality': 80, 'method': 4}},
+    'jpeg': {'mime': 'image/jpeg', 'feature': None, 'options': {'quality': 82, 'optimize': True, 'progressive': True}},
+}
+
+
+def available_formats():
+    from PIL import features  # Pillow is imported on first use, not by every process that loads the app
+
+    return [name for name, spec in FORMATS.items() if spec['feature'] is None or features.check(spec['feature'])]
+
+
+def source_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def render_renditions(media_root, name, widths, formats):
+    """
+    Write the renditions of MEDIA_ROOT/`name` and return its rendition map.
+
+    Top-level and free of Django state so it can run in a worker process.
+    Renditions that already exist are left alone: their names are derived
+    from the source content, so an existing file is always up to date.
+    """
+    from PIL import Image, ImageOps
+
+    media_root = Path(media_root)
+    source_path = media_root / name
+    digest = source_hash(source_path)
+    stem = Path(name).stem
+    output_dir = media_root / RENDITIONS_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        original_width, original_height = image.size
+        # Never upscale; always emit at least one rendition no wider than the original
+        targets = sorted({min(width, original_width) for width in widths})
+        result = {'source': name, 'width': original_width, 'height': original_height, 'formats': {}}
+
+        for width in targets:
+            height = max(round(original_height * width / original_width), 1)
+            resized = None
+            for fmt in formats:
+                filename = f'{stem}.{digest}.{width}w.{"jpg" if fmt == "jpeg" else fmt}'
+                target = output_dir / filename
+                if not target.exists():
+                    if resized is None:
+                        resized = image.resize((width, height), Image.Resampling.LANCZOS)
+                    frame = resized.convert('RGB') if fmt == 'jpeg' and resized.mode != 'RGB' else resized
+                    temporary = target.with_name(f'.{filename}.{os.getpid()}.tmp')
+                    frame.save(temporary, format=fmt.upper(), **FORMATS[fmt]['options'])
+                    os.replace(temporary, target)  # Atomic, so concurrent builders never serve half a file
+                result['formats'].setdefault(fmt, []).append([width, f'{RENDITIONS_DIR}/{filename}'])
+    return result
+
+
+def _render_job(job):
+    media_root, key, name, widths, formats = job
+    try:
+        return key, render_renditions(media_root, name, widths, formats), None
+    except (OSError, ValueError) as error:
+        return key, None, f'{name}: {error}'
+
+
+def render_many(jobs, workers=None, widths=PRODUCT_WIDTHS, formats=None):
+    """
+    Render `jobs` (an iterable of (key, media name) pairs) in a process pool.
+
+    Yields (key, rendition map or None, error or None) as results complete.
+    """
+    formats = formats or available_formats()
+    media_root = str(settings.MEDIA_ROOT)
+    payloads = ((media_root, key, name, tuple(widths), tuple(formats)) for key, name in jobs)
+    if workers == 1:
+        yield from map(_render_job, payloads)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(_render_job, payloads, chunksize=8)
+
+
+def manifest_path():
+    return Path(settings.MEDIA_ROOT) / RENDITIONS_DIR / MANIFEST_NAME
+
+
+def write_manifest(entries):
+    """ Merge rendition maps for non-product media into the manifest """
+    path = manifest_path()
+    manifest = load_manifest_file(path)
+    manifest.update(entries)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix('.tmp')
+    temporary.write_text(json.dumps(manifest, sort_keys=True))
+    os.replace(temporary, path)
+
+
+def load_manifest_file(path):
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+_manifest_cache = {'mtime': None, 'data': {}}
+
+
+def get_manifest():
+    """ Manifest contents, re-read only when the file changes """
+    path = manifest_path()
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return {}
+    if _manifest_cache['mtime'] != mtime:
+        _manifest_cache.update(mtime=mtime, data=load_manifest_file(path))
+    return _manifest_cache['data']
+
+
+def build_srcset(renditions, fmt):
+    return ', '.join(f'{settings.MEDIA_URL}{name} {width}w' for width, name in renditions['formats'].get(fmt, []))
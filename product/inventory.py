@@ -0,0 +1,176 @@
+"""
+Stock and cart quantity updates that stay correct under concurrent requests.
+
+Every write here is a single conditional ``UPDATE ... SET x = x +/- n`` (an
+``F()`` expression) so the database serializes it; nothing reads a value into
+Python and writes it back.
+
+Checkout reserves stock by decrementing ``Product.stock`` up front and
+recording a ``StockReservation`` for the Checkout Session.  Payment commits
+the reservation; the ``release_expired_reservations`` sweeper hands stock
+from abandoned sessions back.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .cart import refresh_cart_summary
+from .models import CartItem, Product, StockReservation
+
+# Stripe requires a Checkout Session to live at least 30 minutes; one more covers clock skew
+DEFAULT_RESERVATION_TTL = 31 * 60
+# Extra time after the session expires, for a late webhook about a payment made just in time
+RELEASE_GRACE = timedelta(minutes=5)
+
+
+class OutOfStock(Exception):
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f"Not enough stock for {product.name}")
+
+
+def reservation_ttl():
+    return getattr(settings, 'STOCK_RESERVATION_TTL', DEFAULT_RESERVATION_TTL)
+
+
+def per_product(quantities):
+    """ CASE expression giving each product's quantity from a {product_id: quantity} dict """
+    return Case(*[When(pk=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def line_quantities(lines):
+    quantities = defaultdict(int)
+    for item in lines:
+        quantities[item.product_id] += item.quantity
+    return quantities
+
+
+def add_to_cart(user, product, quantity=1):
+    """ Atomically add `quantity` of `product` to the user's cart """
+    updated = CartItem.objects.filter(user=user, product=product).update(quantity=F('quantity') + quantity)
+    if not updated:
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(user=user, product=product, quantity=quantity)
+        except IntegrityError:
+            # Another request created the row first; increment it instead
+            CartItem.objects.filter(user=user, product=product).update(quantity=F('quantity') + quantity)
+        else:
+            return  # CartItem.save() already refreshed the summary
+    refresh_cart_summary(user.pk)  # update() bypasses the CartItem signals
+
+
+async def aadd_to_cart(user, product, quantity=1):
+    """ add_to_cart() for async views: the common increment runs on the async ORM """
+    updated = await CartItem.objects.filter(user=user, product=product).aupdate(quantity=F('quantity') + quantity)
+    if updated:
+        await sync_to_async(refresh_cart_summary)(user.pk)
+    else:
+        await sync_to_async(add_to_cart)(user, product, quantity)
+
+
+def reserve_stock(user, lines, session_id, expires_at):
+    """ Take stock for every cart line or for none of them; raises OutOfStock """
+    quantities = line_quantities(lines)
+    prices = {item.product_id: item.product.price for item in lines}
+    with transaction.atomic():
+        # One UPDATE for the whole cart, touching only products that have enough stock
+        taken = (
+            Product.objects.alias(wanted=per_product(quantities))
+            .filter(pk__in=quantities, stock__gte=F('wanted'))
+            .update(stock=F('stock') - per_product(quantities))
+        )
+        if taken == len(quantities):
+            StockReservation.objects.bulk_create([
+                StockReservation(product_id=product_id, user=user, session_id=session_id, quantity=quantity,
+                                 unit_price=prices[product_id], expires_at=expires_at + RELEASE_GRACE)
+                for product_id, quantity in quantities.items()
+            ])
+            return
+        transaction.set_rollback(True)
+
+    # At least one product ran short: name it
+    stock = dict(Product.objects.filter(pk__in=quantities).values_list('pk', 'stock'))
+    raise OutOfStock(next(
+        (item.product for item in lines if stock.get(item.product_id, 0) < quantities[item.product_id]),
+        lines[0].product,
+    ))
+
+
+def hold_stock_for_session(user, lines, session, created):
+    """
+    Reserve the cart's stock for a Checkout Session, once per session.
+
+    A newly created session replaces the user's earlier ones, so the stock
+    those were holding goes back first.  Raises OutOfStock.
+    """
+    if has_active_reservation(session.id):
+        return
+    if created:
+        release_reservations(StockReservation.objects.filter(user=user).exclude(session_id=session.id))
+    reserve_stock(user, lines, session.id, datetime.fromtimestamp(session.expires_at, tz=dt_timezone.utc))
+
+
+def has_active_reservation(session_id):
+    return StockReservation.objects.filter(
+        session_id=session_id, status=StockReservation.ACTIVE, expires_at__gt=timezone.now()
+    ).exists()
+
+
+def commit_reservation(session_id, lines):
+    """
+    Make the session's reserved stock permanent once it's paid.
+
+    If the reservation was already released (payment landed after the
+    sweeper ran), take the stock again now, never going below zero.
+    """
+    committed = StockReservation.objects.filter(session_id=session_id, status=StockReservation.ACTIVE).update(
+        status=StockReservation.COMMITTED
+    )
+    if committed or not lines:
+        return
+    quantities = line_quantities(lines)
+    Product.objects.filter(pk__in=quantities).update(stock=Greatest(F('stock') - per_product(quantities), 0))
+
+
+def release_reservations(reservations):
+    """ Return the stock held by `reservations` (a queryset); returns the number released """
+    with transaction.atomic():
+        held = list(
+            reservations.select_for_update(skip_locked=True)
+            .filter(status=StockReservation.ACTIVE)
+            .values('id', 'product_id', 'quantity')
+        )
+        if not held:
+            return 0
+        quantities = defaultdict(int)
+        for reservation in held:
+            quantities[reservation['product_id']] += reservation['quantity']
+        Product.objects.filter(pk__in=quantities).update(stock=F('stock') + per_product(quantities))
+        StockReservation.objects.filter(id__in=[reservation['id'] for reservation in held]).update(
+            status=StockReservation.RELEASED
+        )
+    return len(held)
+
+
+def release_expired_reservations(now=None, batch_size=1000):
+    """ Sweep expired active reservations in batches; returns the number released """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        batch = StockReservation.objects.filter(status=StockReservation.ACTIVE, expires_at__lte=now).order_by('id')
+        ids = list(batch.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return released
+        swept = release_reservations(StockReservation.objects.filter(id__in=ids))
+        if not swept:  # Everything left is locked by another sweeper
+            return released
+        released += swept
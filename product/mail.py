@@ -0,0 +1,118 @@
+"""
+Outbound email queue.
+
+Request handlers only call ``enqueue_email`` (a single INSERT, usually inside
+the transaction that made the email necessary).  The ``send_queued_mail``
+worker drains the ``OutboundEmail`` table with ``deliver_batch``, sending each
+batch over one SMTP connection and retrying failures with exponential backoff.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .metrics import timed
+from .models import OutboundEmail
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30  # 30s, 1m, 2m, 4m, ... between attempts
+RETRY_MAX_SECONDS = 60 * 60
+LEASE_SECONDS = 5 * 60  # How long a claimed message stays hidden from other workers
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_email(to, subject, body, from_email=''):
+    return OutboundEmail.objects.create(to=to, subject=subject, body=body, from_email=from_email or '')
+
+
+def send_order_confirmation(order):
+    """ Queue the confirmation email for a freshly materialized order """
+    order_details = "".join(
+        f"{item.quantity} x {item.product_name} - ${item.line_total}\n" for item in order.items.all()
+    )
+    subject = "Your Order Confirmation - E-CommercePY"
+    message = f"""
+    Thank you for your purchase!
+
+    Your Order Details:
+    {order_details}
+
+    Total Amount: ${order.total_amount}
+
+    We will notify you once your order is shipped.
+    """
+    return enqueue_email(order.email, subject, message, settings.EMAIL_HOST_USER)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def claim_batch(batch_size, now):
+    """ Lease up to `batch_size` due messages so concurrent workers never pick the same rows """
+    with transaction.atomic():
+        due = (
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboundEmail.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        messages = list(due)
+        OutboundEmail.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt_at=now + timedelta(seconds=LEASE_SECONDS)
+        )
+    return messages
+
+
+def record_failure(message, error):
+    """ Count a failed attempt and schedule the retry (or give up after MAX_ATTEMPTS) """
+    attempts = message.attempts + 1
+    OutboundEmail.objects.filter(pk=message.pk).update(
+        attempts=F('attempts') + 1,
+        last_error=str(error),
+        status=OutboundEmail.FAILED if attempts >= MAX_ATTEMPTS else OutboundEmail.PENDING,
+        next_attempt_at=timezone.now() + retry_delay(attempts),
+    )
+
+
+def deliver_batch(batch_size=BATCH_SIZE, connection=None):
+    """ Send one batch of due messages; returns (sent, failed) counts """
+    now = timezone.now()
+    messages = claim_batch(batch_size, now)
+    if not messages:
+        return 0, 0
+
+    sent = failed = 0
+    connection = connection or get_connection(fail_silently=False)
+    try:
+        try:
+            connection.open()  # One connection (one TLS handshake) for the whole batch
+        except Exception as error:
+            # Mail server unreachable: the whole batch backs off rather than staying leased
+            logger.warning("smtp_connect_failed messages=%d error=%s", len(messages), error)
+            for message in messages:
+                record_failure(message, error)
+            return 0, len(messages)
+        for message in messages:
+            email = EmailMessage(
+                message.subject, message.body, message.from_email or None, [message.to], connection=connection,
+            )
+            try:
+                with timed('smtp'):
+                    email.send()
+            except Exception as error:
+                failed += 1
+                record_failure(message, error)
+            else:
+                sent += 1
+                OutboundEmail.objects.filter(pk=message.pk).update(
+                    attempts=F('attempts') + 1, status=OutboundEmail.SENT, sent_at=timezone.now(), last_error='',
+                )
+    finally:
+        connection.close()
+    return sent, failed
@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from product.analytics import backfill
+from product.models import Order
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollups from the order history, one batch of days at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, help="First day (YYYY-MM-DD; default: the first order)")
+        parser.add_argument('--until', type=date.fromisoformat, help="Last day, inclusive (default: today)")
+        parser.add_argument('--days-per-batch', type=int, default=31)
+
+    def handle(self, *args, **options):
+        first_order = Order.objects.aggregate(first=Min('date'))['first']
+        since = options['since'] or (timezone.localdate(first_order) if first_order else timezone.localdate())
+        end = (options['until'] or timezone.localdate()) + timedelta(days=1)
+        if since >= end:
+            raise CommandError("--since must not be after --until")
+
+        total = 0
+        while since < end:
+            batch_end = min(since + timedelta(days=options['days_per_batch']), end)
+            total += backfill(since, batch_end)
+            self.stdout.write(f"{since} - {batch_end - timedelta(days=1)}: {total} orders so far")
+            since = batch_end
+        self.stdout.write(self.style.SUCCESS(f"Sales rollups rebuilt from {total} orders"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from product.recommendations import ORDER_CHUNK_SIZE, SETTLE_SECONDS, build_recommendations
+
+
+class Command(BaseCommand):
+    help = "Count product co-occurrence in orders placed since the last run and refresh the recommendation tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Discard the counts and rebuild from every order")
+        parser.add_argument('--chunk-size', type=int, default=ORDER_CHUNK_SIZE, help="Orders read per batch")
+        parser.add_argument('--settle-seconds', type=int, default=SETTLE_SECONDS,
+                            help="Leave orders younger than this for the next run")
+
+    def handle(self, *args, **options):
+        run = build_recommendations(full=options['full'], chunk_size=options['chunk_size'],
+                                    settle_seconds=options['settle_seconds'])
+        self.stdout.write(self.style.SUCCESS(f"{run.orders} orders counted, up to order {run.last_order_id}"))
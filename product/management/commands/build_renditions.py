@@ -0,0 +1,73 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from product.caching import bump_catalog_version
+from product.images import BANNER_WIDTHS, PRODUCT_WIDTHS, RENDITIONS_DIR, render_many, write_manifest
+from product.models import Product
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+
+class Command(BaseCommand):
+    help = "Generate resized AVIF/WebP/JPEG renditions for product images and other media, in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+        parser.add_argument('--force', action='store_true', help="Re-process products that already have renditions")
+        parser.add_argument('--media-dir', action='append', default=None,
+                            help="Directory under MEDIA_ROOT to process into the manifest (default: carousel)")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        self.build_products(options)
+        self.build_media(options['media_dir'] or ['carousel'], options['workers'])
+
+    def build_products(self, options):
+        products = Product.objects.exclude(image='').only('id', 'image', 'renditions').order_by('id')
+        jobs = (
+            (product.pk, product.image.name)
+            for product in products.iterator(chunk_size=options['batch_size'])
+            if options['force'] or product.renditions.get('source') != product.image.name
+        )
+
+        done = failed = 0
+        pending = []
+        for product_id, renditions, error in render_many(jobs, workers=options['workers'], widths=PRODUCT_WIDTHS):
+            if error:
+                failed += 1
+                self.stderr.write(error)
+                continue
+            pending.append(Product(pk=product_id, renditions=renditions, updated_at=timezone.now()))
+            if len(pending) >= options['batch_size']:
+                done += self.save(pending)
+        done += self.save(pending)
+        if done:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f"Products: {done} rendered, {failed} failed"))
+
+    def save(self, products):
+        Product.objects.bulk_update(products, ['renditions', 'updated_at'])
+        count = len(products)
+        products.clear()
+        return count
+
+    def build_media(self, directories, workers):
+        media_root = Path(settings.MEDIA_ROOT)
+        names = [
+            path.relative_to(media_root).as_posix()
+            for directory in directories
+            for path in sorted((media_root / directory).glob('*'))
+            if path.suffix.lower() in IMAGE_SUFFIXES and RENDITIONS_DIR not in path.parts
+        ]
+        entries = {}
+        for name, renditions, error in render_many(((name, name) for name in names), workers=workers, widths=BANNER_WIDTHS):
+            if error:
+                self.stderr.write(error)
+            else:
+                entries[name] = renditions
+        write_manifest(entries)
+        bump_catalog_version()  # The home page embeds the banner markup
+        self.stdout.write(self.style.SUCCESS(f"Media: {len(entries)} files rendered into the manifest"))
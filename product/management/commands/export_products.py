@@ -0,0 +1,38 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from product.catalog import FORMATS, detect_format, export_rows, write_rows
+from product.models import Product
+
+
+class Command(BaseCommand):
+    help = "Write the catalog as CSV or JSONL (streamed, so any size fits in memory)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help="File to write, or - for stdout")
+        parser.add_argument('--format', choices=FORMATS, help="Default: from the --output extension, else csv")
+        parser.add_argument('--category', help="Only this category (slug)")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Rows fetched per database round trip")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        try:
+            format = options['format'] or ('csv' if output == '-' else detect_format(output))
+        except ValueError as e:
+            raise CommandError(e)
+
+        products = Product.objects.all()
+        if options['category']:
+            products = products.filter(category__slug=options['category'])
+        rows = export_rows(products, options['chunk_size'])
+
+        if output == '-':
+            write_rows(rows, self.stdout, format)
+            return
+        try:
+            with open(output, 'w', newline='', encoding='utf-8') as stream:
+                count = write_rows(rows, stream, format)
+        except OSError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} products to {output}"))
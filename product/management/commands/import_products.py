@@ -0,0 +1,46 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from product.catalog import FORMATS, CatalogImporter, detect_format, read_rows
+
+
+class Command(BaseCommand):
+    help = "Create or update products from a CSV or JSONL file, keyed on SKU (streams files of any size)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV/JSONL file, or - for stdin (then --format is required)")
+        parser.add_argument('--format', choices=FORMATS, help="Default: from the file extension")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Rows per lookup/bulk write")
+        parser.add_argument('--image-workers', type=int, default=8, help="Concurrent image downloads")
+        parser.add_argument('--dry-run', action='store_true', help="Print what would change and write nothing")
+
+    def handle(self, *args, **options):
+        try:
+            format = detect_format(options['path'], options['format'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        importer = CatalogImporter(
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+            image_workers=options['image_workers'],
+            on_change=self.stdout.write if options['dry_run'] else None,
+        )
+        if options['path'] == '-':
+            report = importer.run(read_rows(sys.stdin, format))
+        else:
+            try:
+                with open(options['path'], newline='', encoding='utf-8') as stream:
+                    report = importer.run(read_rows(stream, format))
+            except OSError as e:
+                raise CommandError(e)
+
+        for line_number, message in report.errors:
+            self.stderr.write(f"line {line_number}: {message}")
+        if report.failed > len(report.errors):
+            self.stderr.write(f"... and {report.failed - len(report.errors)} more errors")
+        prefix = "Dry run, nothing written: " if options['dry_run'] else ""
+        self.stdout.write(self.style.SUCCESS(prefix + report.summary()))
+        if report.images and not options['dry_run']:
+            self.stdout.write("Run `manage.py build_renditions` to resize the new images")
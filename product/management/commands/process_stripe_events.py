@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from product.fulfilment import BATCH_SIZE, process_pending_events
+
+
+class Command(BaseCommand):
+    help = "Fulfil orders from recorded Stripe webhook events"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help="Keep polling for events instead of exiting when idle")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to sleep when there is nothing to do")
+
+    def handle(self, *args, **options):
+        total_processed = total_failed = 0
+        while True:
+            processed, failed = process_pending_events(options['batch_size'])
+            total_processed += processed
+            total_failed += failed
+            if processed or failed:
+                self.stdout.write(f"Processed {processed}, failed {failed}")
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f"Done: {total_processed} processed, {total_failed} failed"))
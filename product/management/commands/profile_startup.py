@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from product import benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure worker start-up in fresh interpreters under `python -X importtime`: time, peak RSS and the "
+        "packages that cost the most to import"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=list(benchmarks.STARTUP_TARGETS), default='ready',
+                            help="setup: django.setup(); wsgi: load the WSGI app; ready: also import every view")
+        parser.add_argument('--repeat', type=int, default=5, help="Interpreters to start; the median is reported")
+        parser.add_argument('--preload', action='store_true', help="With PRELOAD_APP=1 (see product/startup.py)")
+        parser.add_argument('--top', type=int, default=15, help="Packages to list")
+        parser.add_argument('--output', help="Write the results JSON here")
+
+    def handle(self, *args, **options):
+        result = benchmarks.profile_startup(options['target'], options['repeat'], options['preload'])
+        self.stdout.write(
+            f"{result['target']}{' (preload)' if result['preload'] else ''}: {result['process_ms']} ms process, "
+            f"{result['startup_ms']} ms start-up, {result['import_ms']} ms importing {result['modules']} modules, "
+            f"peak RSS {result['rss_kb']} KiB"
+        )
+        self.stdout.write(f"{'package':<32}{'ms':>8}")
+        for name, ms in list(result['packages_ms'].items())[:options['top']]:
+            self.stdout.write(f"{name:<32}{ms:>8.1f}")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
@@ -0,0 +1,47 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Sum
+
+from product.cart import CACHE_KEY
+from product.models import CartItem, CartSummary
+
+
+class Command(BaseCommand):
+    help = "Recompute every CartSummary from the CartItem rows and fix any that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without writing")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # One grouped aggregate over the cart table, streamed
+        actual = {
+            row['user_id']: (row['item_count'], row['total_amount'])
+            for row in CartItem.objects.filter(user__isnull=False)
+            .values('user_id')
+            .annotate(item_count=Sum('quantity'), total_amount=Sum(F('product__price') * F('quantity')))
+            .order_by()
+            .iterator(chunk_size=options['batch_size'])
+        }
+
+        to_update, to_create = [], []
+        for summary in CartSummary.objects.iterator(chunk_size=options['batch_size']):
+            item_count, total_amount = actual.pop(summary.pk, (0, Decimal('0.00')))
+            if summary.item_count != item_count or summary.total_amount != total_amount:
+                summary.item_count, summary.total_amount = item_count, total_amount
+                to_update.append(summary)
+        for user_id, (item_count, total_amount) in actual.items():
+            to_create.append(CartSummary(user_id=user_id, item_count=item_count, total_amount=total_amount))
+
+        self.stdout.write(f"{len(to_update)} summaries drifted, {len(to_create)} missing")
+        if options['dry_run'] or not (to_update or to_create):
+            return
+
+        with transaction.atomic():
+            CartSummary.objects.bulk_update(to_update, ['item_count', 'total_amount'], batch_size=options['batch_size'])
+            CartSummary.objects.bulk_create(to_create, batch_size=options['batch_size'])
+        cache.delete_many([CACHE_KEY.format(summary.pk) for summary in to_update + to_create])
+        self.stdout.write(self.style.SUCCESS("Cart summaries reconciled"))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from product.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Return stock held by expired checkout reservations"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_reservations(batch_size=options['batch_size'])
+            self.stdout.write(f"Released {released} expired reservations")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,112 @@
+import json
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.test import override_settings
+
+from product import benchmarks
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the storefront views (seed data with `seed_catalog` first). Stripe and SMTP are stubbed "
+        "in-process; for --base-url start the server with PAYMENT_GATEWAY=product.payments.FakeGateway "
+        "and EMAIL_BACKEND=django.core.mail.backends.locmem.EmailBackend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=list(benchmarks.SCENARIOS),
+                            help="Run only this scenario (repeatable; default: all)")
+        parser.add_argument('--requests', type=int, default=200, help="Measured requests per scenario")
+        parser.add_argument('--warmup', type=int, default=10, help="Unmeasured requests per scenario")
+        parser.add_argument('--users', type=int, default=10, help="Seeded shoppers to spread requests over")
+        parser.add_argument('--server', choices=['client', 'asgi', 'wsgi'], default='client',
+                            help="Django's WSGI or ASGI handler through the test client, or a threaded WSGI "
+                                 "server started in this process")
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help="Requests in flight: client threads for WSGI/HTTP, coroutines for ASGI")
+        parser.add_argument('--gateway-latency', type=float, default=0.0,
+                            help="Seconds the fake Stripe takes per call, to model the network wait")
+        parser.add_argument('--base-url', help="Benchmark an already running WSGI/ASGI server instead")
+        parser.add_argument('--output', help="Write the results JSON here")
+        parser.add_argument('--compare', help="Results JSON from an earlier run to compare p95 latency against")
+        parser.add_argument('--max-regression', type=float, default=None,
+                            help="Fail if any scenario's p95 is this many percent slower than --compare")
+
+    def handle(self, *args, **options):
+        stubs = override_settings(
+            DEBUG=False,  # Measure production behaviour, without DEBUG's per-query bookkeeping
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver', '127.0.0.1', 'localhost'],
+            PAYMENT_GATEWAY='product.payments.FakeGateway',
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            FAKE_GATEWAY_LATENCY=options['gateway_latency'],
+        )
+        if options['server'] == 'asgi' and not settings.ASYNC_VIEWS:
+            self.stderr.write("ASYNC_VIEWS is off: the ASGI handler will run the sync views in a thread")
+        with stubs, self.target(options) as base_url:
+            try:
+                results = benchmarks.run(
+                    scenarios=options['scenario'],
+                    requests=options['requests'],
+                    warmup=options['warmup'],
+                    users=options['users'],
+                    base_url=base_url,
+                    asgi=options['server'] == 'asgi' and not options['base_url'],
+                    concurrency=options['concurrency'],
+                )
+            except ValueError as e:
+                raise CommandError(e)
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['compare']:
+            self.compare(results, benchmarks.load(options['compare']), options['max_regression'])
+
+    @contextmanager
+    def target(self, options):
+        if options['base_url'] or options['server'] != 'wsgi':
+            yield options['base_url']
+            return
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+        server.set_app(get_wsgi_application())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield f'http://127.0.0.1:{server.server_port}'
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'scenario':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'queries':>9}{'errors':>8}"
+        )
+        for name, result in results['scenarios'].items():
+            queries = '-' if result['queries_mean'] is None else f"{result['queries_mean']:g}"
+            self.stdout.write(
+                f"{name:<16}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+                f"{result['throughput_rps']:>9}{queries:>9}{result['errors']:>8}"
+            )
+        self.stdout.write(f"Peak RSS: {max(r['peak_rss_kb'] for r in results['scenarios'].values())} KiB")
+
+    def compare(self, results, baseline, max_regression):
+        regressions = []
+        self.stdout.write(f"\n{'scenario':<16}{'was p95':>10}{'now p95':>10}{'change':>9}")
+        for name, before, after, change in benchmarks.compare(results, baseline):
+            self.stdout.write(f"{name:<16}{before:>10.2f}{after:>10.2f}{change:>+8.1f}%")
+            if max_regression is not None and change > max_regression:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"p95 regressed more than {max_regression}% in: {', '.join(regressions)}")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from product.benchmarks import seed
+
+
+class Command(BaseCommand):
+    help = "Add synthetic products, users, carts and orders for benchmarking (use a scratch DB_NAME)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10_000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--cart-lines', type=int, default=5, help="Cart items per user")
+        parser.add_argument('--orders', type=int, default=10, help="Past orders per user")
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, for repeatable datasets")
+
+    def handle(self, *args, **options):
+        counts = seed(
+            products=options['products'],
+            users=options['users'],
+            cart_lines=options['cart_lines'],
+            orders=options['orders'],
+            batch_size=options['batch_size'],
+            random_seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(', '.join(f"{count} {name}" for name, count in counts.items())))
@@ -0,0 +1,241 @@
+"""
+Per-request performance metrics, aggregated into Prometheus histograms.
+
+``product.middleware.PerformanceMiddleware`` opens a ``RequestMetrics`` for
+each request; database queries, template renders, cache lookups and calls
+to Stripe/SMTP (wrapped in ``timed()``) add to it.  When the response goes
+out the totals are folded into fixed-bucket histograms (a bisect and a few
+additions under one lock) and sent back as a Server-Timing header.
+``/metrics`` serves the histograms in the Prometheus text format.
+
+The registry lives in process memory: with several worker processes each
+one exposes its own numbers, so scrape every worker (or run one per pod).
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.template.backends.django import DjangoTemplates, Template
+
+# Seconds; roughly Prometheus' defaults with more resolution under 100ms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+    """ Cumulative-on-read bucket counts plus sum and count, like a Prometheus histogram """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = defaultdict(float)  # (name, labels) -> value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[(name, labels)] += amount
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        """ The Prometheus text exposition format """
+        with self.lock:
+            histograms = sorted((key, list(h.counts), h.sum, h.count, h.buckets) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+        declared = set()
+        for (name, labels), counts, total, count, buckets in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+            cumulative = 0
+            for bound, bucket_count in zip((*buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} counter']
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+HELP = {
+    'http_request_duration_seconds': 'Wall time per request, by view',
+    'db_queries_per_request': 'Database queries per request, by view',
+    'db_query_duration_seconds': 'Total database time per request, by view',
+    'template_render_duration_seconds': 'Total template render time per request, by view',
+    'external_call_duration_seconds': 'Time spent calling external services',
+    'cache_requests_total': 'Cache lookups, by view and result',
+}
+
+REGISTRY = Registry()
+
+
+class RequestMetrics:
+    """ What one request spent its time on """
+
+    __slots__ = ('queries', 'db_time', 'template_time', 'cache_hits', 'cache_misses', 'external')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.external = defaultdict(float)
+
+    def time_query(self, execute, sql, params, many, context):
+        """ A ``connection.execute_wrapper`` """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def server_timing(self, total):
+        """ Server-Timing header value; durations in milliseconds """
+        entries = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+        ]
+        entries += [f'{service};dur={elapsed * 1000:.1f}' for service, elapsed in self.external.items()]
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+    def record(self, view, method, status, total):
+        labels = (('view', view),)
+        REGISTRY.observe('http_request_duration_seconds',
+                         labels + (('method', method), ('status', f'{status // 100}xx')), total)
+        REGISTRY.observe('db_queries_per_request', labels, self.queries, QUERY_BUCKETS)
+        REGISTRY.observe('db_query_duration_seconds', labels, self.db_time)
+        if self.template_time:
+            REGISTRY.observe('template_render_duration_seconds', labels, self.template_time)
+        if self.cache_hits:
+            REGISTRY.inc('cache_requests_total', labels + (('result', 'hit'),), self.cache_hits)
+        if self.cache_misses:
+            REGISTRY.inc('cache_requests_total', labels + (('result', 'miss'),), self.cache_misses)
+
+
+def current():
+    """ The running request's RequestMetrics, or None outside a request """
+    return _current.get()
+
+
+@contextmanager
+def collect():
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed(service):
+    """ Time a call to an external service (works inside or outside a request) """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        REGISTRY.observe('external_call_duration_seconds', (('service', service),), elapsed)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.external[service] += elapsed
+
+
+class InstrumentedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """ The stock Django template backend, timing each top-level render """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
+
+
+_MISSING = object()
+
+
+class CacheMetricsMixin:
+    """ Count hits and misses on cache.get() against the running request """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version)
+        metrics = _current.get()
+        if metrics is not None:
+            if value is _MISSING:
+                metrics.cache_misses += 1
+            else:
+                metrics.cache_hits += 1
+        return default if value is _MISSING else value
+
+
+class InstrumentedLocMemCache(CacheMetricsMixin, LocMemCache):
+    pass
+
+
+class InstrumentedFileBasedCache(CacheMetricsMixin, FileBasedCache):
+    pass
+
+
+class InstrumentedRedisCache(CacheMetricsMixin, RedisCache):
+    pass
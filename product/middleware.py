@@ -0,0 +1,141 @@
+"""
+Request-level middleware for the storefront.
+"""
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from . import assets, metrics
+
+logger = logging.getLogger('product.requests')
+
+
+class PerformanceMiddleware:
+    """
+    Time every request and what it spent that time on.
+
+    Adds a Server-Timing header (visible in the browser's network panel),
+    records the totals in the ``/metrics`` histograms, and logs one line per
+    request at DEBUG (WARNING when it took longer than SLOW_REQUEST_SECONDS).
+    Keep it first in MIDDLEWARE so the total covers the other middleware too.
+    """
+
+    sync_capable = True
+    async_capable = True  # So async views under ASGI don't hop through a thread here
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'SERVER_TIMING', True)
+        self.slow_request = getattr(settings, 'SLOW_REQUEST_SECONDS', 1.0)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with metrics.collect() as collected, self.wrap_queries(collected):
+            response = self.get_response(request)
+        return self.finish(request, response, collected, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with metrics.collect() as collected, self.wrap_queries(collected):
+            response = await self.get_response(request)
+        return self.finish(request, response, collected, time.perf_counter() - start)
+
+    def wrap_queries(self, collected):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(collected.time_query))
+        return stack
+
+    def finish(self, request, response, collected, total):
+        match = request.resolver_match
+        view = (match.view_name or match._func_path) if match else 'unresolved'
+        collected.record(view, request.method, response.status_code, total)
+        if self.server_timing:
+            response['Server-Timing'] = collected.server_timing(total)
+
+        level = logging.WARNING if total >= self.slow_request else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(
+                level,
+                'request view=%s method=%s status=%s duration_ms=%.1f queries=%d db_ms=%.1f template_ms=%.1f '
+                'cache_hits=%d cache_misses=%d external=%s',
+                view, request.method, response.status_code, total * 1000, collected.queries,
+                collected.db_time * 1000, collected.template_time * 1000, collected.cache_hits,
+                collected.cache_misses, ','.join(f'{k}:{v * 1000:.1f}ms' for k, v in collected.external.items()) or '-',
+            )
+        return response
+
+
+class AssetMiddleware:
+    """
+    Serve STATIC_ROOT and MEDIA_ROOT from the app when SERVE_ASSETS is on.
+
+    Sits right after PerformanceMiddleware, so an image or stylesheet never
+    loads a session or the user.  See ``product.assets`` for the caching rules.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.mounts = []  # (URL prefix, directory, cache_control(name))
+        if getattr(settings, 'SERVE_ASSETS', False):
+            if settings.STATIC_URL and settings.STATIC_ROOT:
+                self.mounts.append((settings.STATIC_URL, settings.STATIC_ROOT, assets.static_cache_control))
+            if settings.MEDIA_URL and settings.MEDIA_ROOT:
+                self.mounts.append((settings.MEDIA_URL, settings.MEDIA_ROOT, assets.media_cache_control))
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def serve(self, request):
+        """ The asset's response, or None when the path isn't under a mount """
+        for prefix, root, cache_control in self.mounts:
+            if request.path.startswith(prefix):
+                name = request.path[len(prefix):]
+                return assets.serve_file(request, root, name, cache_control(name))
+        return None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.serve(request)
+        return response if response is not None else self.get_response(request)
+
+    async def __acall__(self, request):
+        response = self.serve(request)
+        return response if response is not None else await self.get_response(request)
+
+
+class AnonymousCartMiddleware:
+    """ Write a visitor's cookie cart back to the browser when a view changed it (see product.anonymous_cart) """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.finish(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.finish(request, await self.get_response(request))
+
+    def finish(self, request, response):
+        cart = getattr(request, '_anonymous_cart', None)
+        if cart is not None:
+            cart.save(response)
+        return response
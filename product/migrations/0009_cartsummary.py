@@ -0,0 +1,38 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def populate_cart_summaries(apps, schema_editor):
+    CartItem = apps.get_model('product', 'CartItem')
+    CartSummary = apps.get_model('product', 'CartSummary')
+    totals = (
+        CartItem.objects.filter(user__isnull=False)
+        .values('user_id')
+        .annotate(item_count=Sum('quantity'), total_amount=Sum(F('product__price') * F('quantity')))
+    )
+    CartSummary.objects.bulk_create(CartSummary(**row) for row in totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('product', '0008_product_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cart_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_cart_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def clamp_invalid_rows(apps, schema_editor):
+    # Existing rows must satisfy the new checks before they're added
+    Product = apps.get_model('product', 'Product')
+    CartItem = apps.get_model('product', 'CartItem')
+    Product.objects.filter(price__lt=0).update(price=0)
+    CartItem.objects.filter(quantity__lt=1).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0015_stock_reservations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(clamp_invalid_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.CheckConstraint(condition=models.Q(('quantity__gte', 1)), name='cartitem_quantity_positive'),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.CheckConstraint(condition=models.Q(('price__gte', 0)), name='product_price_non_negative'),
+        ),
+    ]
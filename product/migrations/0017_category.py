@@ -0,0 +1,85 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def link_categories(apps, schema_editor):
+    # One Category per distinct name; names differing only in case share one
+    Product = apps.get_model('product', 'Product')
+    Category = apps.get_model('product', 'Category')
+    for name in Product.objects.values_list('category', flat=True).distinct().order_by('category'):
+        slug = slugify(name) or 'uncategorized'
+        category, _ = Category.objects.get_or_create(slug=slug, defaults={'name': name.strip() or 'Uncategorized'})
+        Product.objects.filter(category=name).update(category_ref=category)
+
+
+def unlink_categories(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    Category = apps.get_model('product', 'Category')
+    for category in Category.objects.all():
+        Product.objects.filter(category_ref=category).update(category=category.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0016_integrity_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('slug', models.SlugField(unique=True)),
+            ],
+            options={
+                'verbose_name_plural': 'categories',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_category_price_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='product_category_name_idx',
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='category_ref',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='product.category'),
+        ),
+        migrations.RunPython(link_categories, unlink_categories),
+        migrations.AlterField(  # A default, so the column can be re-added when migrating backwards
+            model_name='product',
+            name='category',
+            field=models.CharField(default='', max_length=50),
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='category',
+        ),
+        migrations.RenameField(
+            model_name='product',
+            old_name='category_ref',
+            new_name='category',
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='category',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='products', to='product.category'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'name', 'id'], name='product_category_name_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:58
+
+from django.db import migrations, models
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat
+
+
+def backfill_skus(apps, schema_editor):
+    # Existing products get P<id>, so an export of today's catalog can be re-imported
+    Product = apps.get_model('product', 'Product')
+    Product.objects.filter(sku__isnull=True).update(sku=Concat(Value('P'), Cast('id', CharField())))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0017_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_skus, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def snapshot_categories(apps, schema_editor):
+    # The best record there is of past sales: the product's category now
+    OrderItem = apps.get_model('product', 'OrderItem')
+    Product = apps.get_model('product', 'Product')
+    OrderItem.objects.update(
+        category=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('category')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0022_reservation_unit_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='category',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='product.category'),
+        ),
+        migrations.RunPython(snapshot_categories, migrations.RunPython.noop),
+    ]
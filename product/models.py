@@ -1,13 +1,44 @@
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 from django.contrib.auth.models import User  # Import the User model
 
+class Category(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    slug = models.SlugField(max_length=50, unique=True)  # The catalog's ?category= value
+
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'categories'
+
+    def __str__(self):
+        return self.name
+
 class Product(models.Model):
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)  # The import/export key
     name = models.CharField(max_length=100)
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='products/')
-    category = models.CharField(max_length=50)
+    # No single-column index: the composite indexes below lead with category
+    category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name='products', db_index=False)
+    renditions = models.JSONField(default=dict, blank=True, editable=False)  # Resized copies, see product/images.py
+    updated_at = models.DateTimeField(auto_now=True)  # Part of the cached product card's key
+
+    class Meta:
+        # Composite keys for the catalog's keyset pagination and filters
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'name', 'id'], name='product_category_name_idx'),
+        ]
+        # PositiveIntegerField already makes the database reject negative stock, so the F() updates in
+        # inventory.py can't oversell past zero; price needs its own check
+        constraints = [
+            models.CheckConstraint(condition=Q(price__gte=0), name='product_price_non_negative'),
+        ]
 
     def __str__(self):
         return self.name
@@ -19,6 +50,13 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    class Meta:
+        # One row per product per user, so concurrent adds increment instead of duplicating
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='cartitem_unique_user_product'),
+            models.CheckConstraint(condition=Q(quantity__gte=1), name='cartitem_quantity_positive'),
+        ]
+
     def __str__(self):
         return f"{self.user.username}'s Cart: {self.quantity} x {self.product.name}" if self.user else f"{self.quantity} x {self.product.name}"
 
@@ -29,6 +67,15 @@ class Order(models.Model):
     email = models.EmailField()  # Optional for non-logged-in orders
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)  # Total cost of the order
     date = models.DateTimeField(auto_now_add=True)  # Date and time the order was placed
+    stripe_session_id = models.CharField(max_length=255, unique=True, null=True, blank=True)  # One order per Checkout Session
+
+    class Meta:
+        # Order history's keyset pagination: WHERE user_id = ? AND (date, id) < (?, ?) ORDER BY date DESC, id DESC
+        indexes = [
+            models.Index(fields=['user', '-date', '-id'], name='order_user_date_idx'),
+            # The admin's newest-first order list and its date filter
+            models.Index(fields=['-date', '-id'], name='order_date_idx'),
+        ]
 
     def __str__(self):
         return f"Order {self.id} - {self.customer_name or self.user.username}"
@@ -37,6 +84,201 @@ class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="items")  # Link to the parent order
     product = models.ForeignKey('Product', on_delete=models.CASCADE)  # Link to the product
     quantity = models.PositiveIntegerField()  # Quantity of the product
+    # Snapshotted at purchase so order history never has to join back to Product
+    product_name = models.CharField(max_length=100, default='')
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # The category the sale counts towards in the rollups, even if the product moves later
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                                 db_index=False)
+
+    @property
+    def line_total(self):
+        return self.unit_price * self.quantity
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_name} (Order {self.order_id})"
+
+class CartSummary(models.Model):
+    # Denormalized cart totals, kept in step with CartItem by product.cart.refresh_cart_summary
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='cart_summary')
+    item_count = models.PositiveIntegerField(default=0)  # Sum of quantities, shown in the navbar badge
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username}'s Cart: {self.item_count} items, ${self.total_amount}"
+
+
+class OutboundEmail(models.Model):
+    # Outbox row for an email; delivered later by the send_queued_mail worker
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    to = models.EmailField()
+    from_email = models.CharField(max_length=254, blank=True)  # Blank means DEFAULT_FROM_EMAIL
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Also used as a lease while a worker sends it
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx')]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.to} ({self.status})"
+
+
+class StripeEvent(models.Model):
+    # Idempotent log of verified Stripe webhook events, drained by process_stripe_events
+    PENDING = 'pending'
+    PROCESSED = 'processed'
+    IGNORED = 'ignored'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (PROCESSED, 'Processed'), (IGNORED, 'Ignored'), (FAILED, 'Failed')]
+
+    event_id = models.CharField(max_length=255, unique=True)  # Stripe's evt_... id; redeliveries hit this
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'], name='stripe_event_due_idx')]
+
+    def __str__(self):
+        return f"{self.type} {self.event_id} ({self.status})"
+
+
+class StockReservation(models.Model):
+    # Stock held for a Checkout Session; Product.stock is already decremented while this is active
+    ACTIVE = 'active'
+    COMMITTED = 'committed'  # Paid: the decrement is permanent
+    RELEASED = 'released'  # Expired or abandoned: the quantity went back to Product.stock
+    STATUS_CHOICES = [(ACTIVE, 'Active'), (COMMITTED, 'Committed'), (RELEASED, 'Released')]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    session_id = models.CharField(max_length=255, db_index=True)  # Stripe Checkout Session id
+    quantity = models.PositiveIntegerField()
+    # Price charged for the product in this session; the order is built from these rows, not the live cart
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=ACTIVE)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'expires_at'], name='reservation_expiry_idx')]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for {self.session_id} ({self.status})"
+
+
+class ProductPair(models.Model):
+    # How many orders contained both products, counted from OrderItem by `manage.py build_recommendations`.
+    # Stored in both directions; the diagonal (product == related) is the product's own order count.
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', db_index=False)
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', db_index=False)
+    orders = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'related'], name='productpair_unique')]
+        indexes = [models.Index(fields=['product', '-orders', 'related'], name='productpair_top_idx')]
+
+    def __str__(self):
+        return f"{self.product_id} + {self.related_id}: {self.orders} orders"
+
+
+class RelatedProduct(models.Model):
+    # The top ProductPair rows per product ("frequently bought together"), rank 1 first
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', db_index=False)
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    orders = models.PositiveIntegerField()  # Orders containing both
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'rank'], name='relatedproduct_unique_rank')]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} (#{self.rank})"
+
+
+class CategoryBestSeller(models.Model):
+    # The most-ordered products of each category, rank 1 first
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+', db_index=False)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField()
+    orders = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['category', 'rank'], name='bestseller_unique_rank')]
+
+    def __str__(self):
+        return f"{self.category_id} #{self.rank}: {self.product_id}"
+
+
+class RecommendationRun(models.Model):
+    # Progress of build_recommendations: orders up to last_order_id are counted in ProductPair
+    last_order_id = models.BigIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)  # Counted by this run
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Run {self.id}: up to order {self.last_order_id}"
+
+
+class DailySales(models.Model):
+    # Store-wide totals per day, kept up to date by product.analytics as orders are created
+    date = models.DateField(primary_key=True)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily sales'
+
+    def __str__(self):
+        return f"{self.date}: {self.orders} orders, ${self.revenue}"
+
+
+class ProductDailySales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    # The product's category when sold, so category reports don't join Product
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+', db_index=False)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'product daily sales'
+        constraints = [models.UniqueConstraint(fields=['date', 'product'], name='productdailysales_unique')]
+        indexes = [models.Index(fields=['category', 'date'], name='productdailysales_cat_idx')]
+
+    def __str__(self):
+        return f"{self.date} {self.product_id}: {self.units} units"
+
+
+class CategoryDailySales(models.Model):
+    date = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    orders = models.PositiveIntegerField(default=0)  # Orders with at least one product of the category
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'category daily sales'
+        constraints = [models.UniqueConstraint(fields=['date', 'category'], name='categorydailysales_unique')]
 
     def __str__(self):
-        return f"{self.quantity} x {self.product.name} (Order {self.order.id})"
\ No newline at end of file
+        return f"{self.date} {self.category_id}: {self.units} units"
@@ -0,0 +1,101 @@
+"""
+Turning a paid cart into an Order.
+
+``create_order_from_cart`` is the only place orders are materialized.  It runs
+as one transaction, inserts every line with a single ``bulk_create`` and is
+idempotent per Stripe Checkout Session, so refreshing the success page or
+retrying fulfilment never creates a second order.  The confirmation email is
+queued in the same transaction, so it exists if and only if the order does,
+and so is the order's contribution to the daily sales rollups.
+
+The lines come from the session's ``StockReservation`` rows, the snapshot of
+the cart (quantities and prices) taken when checkout started, so an order
+matches what was charged even if the cart changed before the webhook worker
+got to it.  Only reservations still holding stock count: a session whose hold
+was released (it expired, or the user started a newer checkout) falls back to
+the live cart, like one that reserved nothing, and ``commit_reservation``
+takes that stock again.
+"""
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+
+from .analytics import record_order
+from .cart import batched_summary_refresh, cart_lines
+from .inventory import commit_reservation
+from .mail import send_order_confirmation
+from .models import CartItem, Order, OrderItem, StockReservation
+from .payments import get_gateway
+
+Line = namedtuple('Line', ['product', 'product_id', 'quantity', 'unit_price'])
+
+
+def checkout_lines(user, session_id):
+    """ What the session charged for: the lines it still holds stock for, or the user's cart if none """
+    # Active rows still hold their stock until the sweeper releases them, even past expires_at
+    reserved = (
+        StockReservation.objects.filter(session_id=session_id,
+                                        status__in=[StockReservation.ACTIVE, StockReservation.COMMITTED])
+        .select_related('product').order_by('id')
+    )
+    lines = [
+        # Reservations made before unit_price was recorded fall back to the current price
+        Line(row.product, row.product_id, row.quantity, row.product.price if row.unit_price is None else row.unit_price)
+        for row in reserved
+    ]
+    if lines:
+        return lines
+    return [Line(item.product, item.product_id, item.quantity, item.product.price) for item in cart_lines(user)]
+
+
+def create_order_from_cart(user, session_id, email='', customer_name=''):
+    """ Return (order, created) for the Checkout Session `session_id` """
+    existing = Order.objects.filter(stripe_session_id=session_id).first()
+    if existing is not None:
+        return existing, False
+
+    with transaction.atomic():
+        lines = checkout_lines(user, session_id)
+        total_amount = sum(item.unit_price * item.quantity for item in lines)
+
+        try:
+            # Savepoint, so losing the race on the unique session id doesn't
+            # poison the outer transaction
+            with transaction.atomic():
+                order = Order.objects.create(
+                    user=user,
+                    email=email,
+                    customer_name=customer_name,
+                    total_amount=total_amount,
+                    stripe_session_id=session_id,
+                )
+        except IntegrityError:
+            return Order.objects.get(stripe_session_id=session_id), False
+
+        # Paid: the stock reserved for this session is now sold
+        commit_reservation(session_id, lines)
+
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=item.product,
+                product_name=item.product.name,
+                unit_price=item.unit_price,
+                category_id=item.product.category_id,
+                quantity=item.quantity,
+            ) for item in lines
+        ])
+        record_order(order, items)  # Daily sales rollups for the admin dashboard
+
+        # Take the bought products out of the user's cart; anything added since stays
+        with batched_summary_refresh():
+            CartItem.objects.filter(user=user, product_id__in=[item.product_id for item in lines]).delete()
+
+        if email:
+            send_order_confirmation(order)
+
+        # The paid session must not be handed out again for an identical cart
+        transaction.on_commit(lambda: get_gateway().forget_open_session(user.pk))
+
+    return order, True
+
@@ -0,0 +1,134 @@
+"""
+Keyset (cursor) pagination for the catalog.
+
+Each page is fetched with ``WHERE (sort_value, id) > (last_value, last_id)``
+against a composite index, so page 500 costs the same as page 1.  The cursor
+is an opaque url-safe token carrying the sort key and the last row's values.
+"""
+import base64
+import json
+import math
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+
+# sort parameter -> (field, descending)
+SORT_FIELDS = {
+    'price': ('price', False),
+    '-price': ('price', True),
+    'name': ('name', False),
+    '-name': ('name', True),
+    'relevance': ('search_rank', False),  # only when the queryset is a search result
+}
+# Order history: newest first, on the (user, -date, -id) index
+ORDER_SORT_FIELDS = {
+    '-date': ('date', True),
+}
+DEFAULT_SORT = 'name'
+
+
+def _decimal(value):
+    value = Decimal(value) if isinstance(value, str) else None
+    if value is None or not value.is_finite():
+        raise ValueError("not a decimal")
+    return value
+
+
+def _text(value):
+    if not isinstance(value, str):
+        raise ValueError("not a string")
+    return value
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError("not a number")
+    return float(value)
+
+
+# Sort field -> parser turning a cursor's JSON value back into the field's type (ValueError if it can't)
+CURSOR_VALUE_TYPES = {
+    'price': _decimal,
+    'name': _text,
+    'search_rank': _number,
+    'date': lambda value: datetime.fromisoformat(_text(value)),
+}
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor):
+        self.object_list = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(sort, value, pk):
+    if isinstance(value, Decimal):
+        value = str(value)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([sort, value, pk], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort, sort_fields=SORT_FIELDS):
+    """ Return (value, pk) for a cursor issued for `sort`, or None if it is missing or invalid """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, pk = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    if cursor_sort != sort or isinstance(pk, bool) or not isinstance(pk, int):
+        return None
+    # Cursors come from the client: anything that isn't a value of the sort field is rejected here,
+    # not left to fail as a lookup
+    try:
+        value = CURSOR_VALUE_TYPES[sort_fields[sort][0]](value)
+    except (ValueError, TypeError, InvalidOperation):
+        return None
+    return value, pk
+
+
+def resolve_sort(sort, searching=False):
+    if sort == 'relevance' and not searching:
+        return DEFAULT_SORT
+    if sort not in SORT_FIELDS:
+        return 'relevance' if searching else DEFAULT_SORT
+    return sort
+
+
+def paginate(queryset, sort, cursor=None, page_size=24, sort_fields=SORT_FIELDS):
+    field, descending = sort_fields[sort]
+    if descending:
+        queryset = queryset.order_by(f'-{field}', '-id')
+    else:
+        queryset = queryset.order_by(field, 'id')
+
+    position = decode_cursor(cursor, sort, sort_fields)
+    if position is not None:
+        value, pk = position
+        if descending:
+            queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+        else:
+            queryset = queryset.filter(Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk}))
+
+    # Fetch one extra row to know whether there is another page
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = encode_cursor(sort, getattr(last, field), last.pk)
+    return KeysetPage(items, next_cursor)
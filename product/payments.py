@@ -0,0 +1,397 @@
+"""
+Payment gateway used by the checkout views.
+
+Views never call Stripe directly; they go through ``get_gateway()``, which
+returns the class named by ``settings.PAYMENT_GATEWAY``:
+
+* ``StripeGateway`` talks to Stripe over one pooled HTTP client, caches
+  finished Checkout Sessions for ``STRIPE_SESSION_CACHE_TTL`` seconds and
+  hands back the user's still-open session when their cart hasn't changed.
+* ``FakeGateway`` completes every checkout immediately without the network,
+  so the whole flow can be run and load-tested offline.
+
+Both verify webhook signatures with ``parse_event`` for ``product.fulfilment``.
+"""
+import asyncio
+import hashlib
+import hmac
+import importlib.util
+import json
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .metrics import timed
+
+DEFAULT_GATEWAY = 'product.payments.StripeGateway'
+SESSION_CACHE_KEY = 'payments:session:{}'
+OPEN_SESSION_CACHE_KEY = 'payments:open-session:{}'
+# Don't hand out a reused session this close to Stripe expiring it
+REUSE_MARGIN_SECONDS = 5 * 60
+# Stripe rejects an expires_at less than 30 minutes after the session is created; the extra
+# minute covers clock skew and the time the request takes to reach Stripe
+MIN_SESSION_LIFETIME = 31 * 60
+# Webhook signatures older than this are rejected, so a captured payload can't be replayed
+# (stripe.Webhook.DEFAULT_TOLERANCE; both gateways use it)
+WEBHOOK_TOLERANCE = 300
+
+
+class PaymentError(Exception):
+    pass
+
+
+class SessionNotFound(PaymentError):
+    pass
+
+
+class InvalidWebhook(PaymentError):
+    pass
+
+
+@dataclass
+class CheckoutSession:
+    id: str
+    url: str
+    status: str = 'open'  # open, complete or expired
+    payment_status: str = 'unpaid'
+    customer_email: str = ''
+    client_reference_id: str = ''
+    expires_at: int = 0
+    metadata: dict = field(default_factory=dict)
+
+    @property
+    def is_finished(self):
+        return self.status in ('complete', 'expired')
+
+    def is_paid_by(self, user):
+        """ Paid for, and started by `user` (the checks fulfil_checkout_session makes) """
+        return self.payment_status == 'paid' and self.client_reference_id == str(user.pk)
+
+
+def build_line_items(lines):
+    """ Stripe `line_items` for a list of cart rows (with product joined) """
+    return [
+        {
+            'price_data': {
+                'currency': 'usd',
+                'product_data': {
+                    'name': item.product.name,  # Use the actual product name
+                },
+                'unit_amount': int(item.product.price * 100),  # Convert price to cents
+            },
+            'quantity': item.quantity,  # Ensure quantity is correctly set
+        } for item in lines
+    ]
+
+
+def cart_hash(lines):
+    """ Fingerprint of what would be charged; a changed cart needs a new session """
+    digest = hashlib.sha256()
+    for item in sorted(lines, key=lambda item: item.product_id):
+        digest.update(f'{item.product_id}:{item.quantity}:{item.product.price};'.encode())
+    return digest.hexdigest()
+
+
+class PaymentGateway:
+    session_cache_ttl = 300
+
+    def start_checkout(self, user, lines, success_url, cancel_url, expires_in=None):
+        """
+        Return (CheckoutSession, created) for the cart, reusing the user's
+        open session if the cart is unchanged.  `expires_in` is in seconds.
+        """
+        key = OPEN_SESSION_CACHE_KEY.format(user.pk)
+        fingerprint = cart_hash(lines)
+        session = self.reusable_session(cache.get(key), fingerprint)
+        if session is not None:
+            return session, False
+        with timed('stripe'):
+            session = self.create_session(**self.session_params(user, lines, success_url, cancel_url, expires_in))
+        cache.set(key, {'cart_hash': fingerprint, 'session': asdict(session)}, self.open_session_timeout(session))
+        return session, True
+
+    async def astart_checkout(self, user, lines, success_url, cancel_url, expires_in=None):
+        """ start_checkout() for async views """
+        key = OPEN_SESSION_CACHE_KEY.format(user.pk)
+        fingerprint = cart_hash(lines)
+        session = self.reusable_session(await cache.aget(key), fingerprint)
+        if session is not None:
+            return session, False
+        with timed('stripe'):
+            session = await self.acreate_session(**self.session_params(user, lines, success_url, cancel_url, expires_in))
+        await cache.aset(key, {'cart_hash': fingerprint, 'session': asdict(session)}, self.open_session_timeout(session))
+        return session, True
+
+    def reusable_session(self, cached, fingerprint):
+        if cached and cached['cart_hash'] == fingerprint \
+                and cached['session']['expires_at'] > time.time() + REUSE_MARGIN_SECONDS:
+            return CheckoutSession(**cached['session'])
+        return None
+
+    def session_params(self, user, lines, success_url, cancel_url, expires_in):
+        return {
+            'line_items': build_line_items(lines),
+            'success_url': success_url,
+            'cancel_url': cancel_url,
+            'client_reference_id': str(user.pk),
+            'customer_email': user.email or None,
+            'expires_at': int(time.time() + max(expires_in, MIN_SESSION_LIFETIME)) if expires_in else None,
+        }
+
+    def open_session_timeout(self, session):
+        return max(int(session.expires_at - time.time()), 1)
+
+    def forget_open_session(self, user_id):
+        cache.delete(OPEN_SESSION_CACHE_KEY.format(user_id))
+
+    async def aforget_open_session(self, user_id):
+        await cache.adelete(OPEN_SESSION_CACHE_KEY.format(user_id))
+
+    def get_session(self, session_id):
+        """ Retrieve a session, serving finished ones from the cache """
+        key = SESSION_CACHE_KEY.format(session_id)
+        cached = cache.get(key)
+        if cached is not None:
+            return CheckoutSession(**cached)
+        with timed('stripe'):
+            session = self.retrieve_session(session_id)
+        if session.is_finished:  # Open sessions still change, so only cache final states
+            cache.set(key, asdict(session), self.session_cache_ttl)
+        return session
+
+    async def aget_session(self, session_id):
+        """ get_session() for async views """
+        key = SESSION_CACHE_KEY.format(session_id)
+        cached = await cache.aget(key)
+        if cached is not None:
+            return CheckoutSession(**cached)
+        with timed('stripe'):
+            session = await self.aretrieve_session(session_id)
+        if session.is_finished:
+            await cache.aset(key, asdict(session), self.session_cache_ttl)
+        return session
+
+    def create_session(self, **params):
+        raise NotImplementedError
+
+    def retrieve_session(self, session_id):
+        raise NotImplementedError
+
+    # Gateways without a native async client block a pool thread instead of the event loop
+    async def acreate_session(self, **params):
+        return await sync_to_async(self.create_session, thread_sensitive=False)(**params)
+
+    async def aretrieve_session(self, session_id):
+        return await sync_to_async(self.retrieve_session, thread_sensitive=False)(session_id)
+
+    def parse_event(self, payload, signature):
+        """ Verify a webhook body against its signature header and return the event as a dict """
+        raise NotImplementedError
+
+    def webhook_secret(self):
+        secret = getattr(settings, 'STRIPE_WEBHOOK_SECRET', None)
+        if not secret:
+            raise InvalidWebhook("STRIPE_WEBHOOK_SECRET is not configured")
+        return secret
+
+    def load_event(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError as error:
+            raise InvalidWebhook("Webhook body is not valid JSON") from error
+        if not isinstance(event, dict) or 'id' not in event or 'type' not in event:
+            raise InvalidWebhook("Webhook body is not a Stripe event")
+        return event
+
+
+def stripe_sdk():
+    """
+    The stripe package, imported on first use.
+
+    It pulls in requests and urllib3, the heaviest imports in the project, so
+    workers, management commands and tests that never take a payment don't
+    load it (see ``manage.py profile_startup``).
+    """
+    import stripe
+    return stripe
+
+
+class StripeGateway(PaymentGateway):
+    def __init__(self):
+        import requests
+        stripe = stripe_sdk()
+
+        self.api_key = settings.STRIPE_SECRET_KEY
+        self.session_cache_ttl = getattr(settings, 'STRIPE_SESSION_CACHE_TTL', self.session_cache_ttl)
+        # One keep-alive connection pool shared by every request in the process
+        http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=getattr(settings, 'STRIPE_HTTP_POOL_SIZE', 10))
+        http.mount('https://', adapter)
+        timeout = getattr(settings, 'STRIPE_TIMEOUT', 30)
+        # Async views await Stripe over HTTPX when it's installed, holding no thread while they wait
+        self.native_async = importlib.util.find_spec('httpx') is not None  # Optional dependency
+        stripe.default_http_client = stripe.RequestsClient(
+            timeout=timeout, session=http,
+            async_fallback_client=stripe.HTTPXClient(timeout=timeout) if self.native_async else None,
+        )
+        stripe.max_network_retries = getattr(settings, 'STRIPE_MAX_NETWORK_RETRIES', 2)
+
+    def to_checkout_session(self, session):
+        details = session.get('customer_details')
+        return CheckoutSession(
+            id=session['id'],
+            url=session.get('url') or '',
+            status=session.get('status') or 'open',
+            payment_status=session.get('payment_status') or 'unpaid',
+            customer_email=(details.get('email') if details else None) or session.get('customer_email') or '',
+            client_reference_id=session.get('client_reference_id') or '',
+            expires_at=session.get('expires_at') or 0,
+            metadata=dict(session.get('metadata') or {}),
+        )
+
+    def create_params(self, line_items, success_url, cancel_url, client_reference_id, customer_email, expires_at):
+        params = {}
+        if customer_email:
+            params['customer_email'] = customer_email
+        if expires_at:
+            params['expires_at'] = expires_at
+        return dict(
+            api_key=self.api_key,
+            payment_method_types=['card'],
+            customer_creation='always',  # Ensures a customer is always created
+            billing_address_collection='required',  # Forces Stripe to collect email
+            line_items=line_items,
+            mode='payment',
+            client_reference_id=client_reference_id,
+            success_url=success_url,
+            cancel_url=cancel_url,
+            **params,
+        )
+
+    def create_session(self, *, line_items, success_url, cancel_url, client_reference_id, customer_email=None,
+                       expires_at=None):
+        params = self.create_params(line_items, success_url, cancel_url, client_reference_id, customer_email, expires_at)
+        return self.to_checkout_session(stripe_sdk().checkout.Session.create(**params))
+
+    async def acreate_session(self, *, line_items, success_url, cancel_url, client_reference_id, customer_email=None,
+                              expires_at=None):
+        if not self.native_async:
+            return await super().acreate_session(
+                line_items=line_items, success_url=success_url, cancel_url=cancel_url,
+                client_reference_id=client_reference_id, customer_email=customer_email, expires_at=expires_at,
+            )
+        params = self.create_params(line_items, success_url, cancel_url, client_reference_id, customer_email, expires_at)
+        return self.to_checkout_session(await stripe_sdk().checkout.Session.create_async(**params))
+
+    def retrieve_session(self, session_id):
+        stripe = stripe_sdk()
+        try:
+            session = stripe.checkout.Session.retrieve(session_id, api_key=self.api_key)
+        except stripe.error.InvalidRequestError as error:
+            raise SessionNotFound(str(error)) from error
+        return self.to_checkout_session(session)
+
+    async def aretrieve_session(self, session_id):
+        if not self.native_async:
+            return await super().aretrieve_session(session_id)
+        stripe = stripe_sdk()
+        try:
+            session = await stripe.checkout.Session.retrieve_async(session_id, api_key=self.api_key)
+        except stripe.error.InvalidRequestError as error:
+            raise SessionNotFound(str(error)) from error
+        return self.to_checkout_session(session)
+
+    def parse_event(self, payload, signature):
+        stripe = stripe_sdk()
+        try:
+            stripe.WebhookSignature.verify_header(
+                payload.decode(), signature or '', self.webhook_secret(), WEBHOOK_TOLERANCE,
+            )
+        except (stripe.error.SignatureVerificationError, UnicodeDecodeError) as error:
+            raise InvalidWebhook(str(error)) from error
+        return self.load_event(payload)
+
+
+class FakeGateway(PaymentGateway):
+    """ Offline stand-in: every session is paid the moment it is created """
+
+    def __init__(self):
+        self.latency = getattr(settings, 'FAKE_GATEWAY_LATENCY', 0)  # Seconds, to mimic Stripe round-trips
+
+    def create_session(self, *, line_items, success_url, cancel_url, client_reference_id, customer_email=None,
+                       expires_at=None):
+        time.sleep(self.latency)
+        session = self.new_session(success_url, client_reference_id, customer_email, expires_at)
+        # Kept in the cache so every worker process sharing it can see the session
+        cache.set(f'payments:fake:{session.id}', asdict(session), 24 * 60 * 60)
+        return session
+
+    async def acreate_session(self, *, line_items, success_url, cancel_url, client_reference_id, customer_email=None,
+                              expires_at=None):
+        await asyncio.sleep(self.latency)
+        session = self.new_session(success_url, client_reference_id, customer_email, expires_at)
+        await cache.aset(f'payments:fake:{session.id}', asdict(session), 24 * 60 * 60)
+        return session
+
+    def new_session(self, success_url, client_reference_id, customer_email, expires_at):
+        session_id = f'cs_fake_{uuid.uuid4().hex}'
+        return CheckoutSession(
+            id=session_id,
+            url=success_url.replace('{CHECKOUT_SESSION_ID}', session_id),
+            status='complete',
+            payment_status='paid',
+            customer_email=customer_email or 'customer@example.com',
+            client_reference_id=client_reference_id,
+            expires_at=expires_at or int(time.time()) + 24 * 60 * 60,
+        )
+
+    def retrieve_session(self, session_id):
+        time.sleep(self.latency)
+        return self.stored_session(cache.get(f'payments:fake:{session_id}'), session_id)
+
+    async def aretrieve_session(self, session_id):
+        await asyncio.sleep(self.latency)
+        return self.stored_session(await cache.aget(f'payments:fake:{session_id}'), session_id)
+
+    def stored_session(self, data, session_id):
+        if data is None:
+            raise SessionNotFound(f"No such checkout.session: '{session_id}'")
+        return CheckoutSession(**data)
+
+    # Same `t=...,v1=...` HMAC-SHA256 scheme as Stripe, implemented locally
+    def sign_payload(self, payload, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        signed = f'{timestamp}.'.encode() + payload
+        digest = hmac.new(self.webhook_secret().encode(), signed, hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={digest}'
+
+    def parse_event(self, payload, signature):
+        parts = dict(part.split('=', 1) for part in (signature or '').split(',') if '=' in part)
+        try:
+            timestamp = int(parts['t'])
+        except (KeyError, ValueError) as error:
+            raise InvalidWebhook("Signature has no valid timestamp") from error
+        if not hmac.compare_digest(self.sign_payload(payload, timestamp), signature):
+            raise InvalidWebhook("Signature does not match payload")
+        if timestamp < time.time() - WEBHOOK_TOLERANCE:  # Checked after the HMAC, as Stripe does
+            raise InvalidWebhook("Timestamp outside the tolerance zone")
+        return self.load_event(payload)
+
+
+@lru_cache(maxsize=None)
+def get_gateway():
+    return import_string(getattr(settings, 'PAYMENT_GATEWAY', DEFAULT_GATEWAY))()
+
+
+@receiver(setting_changed)
+def _reset_gateway(setting, **kwargs):
+    if setting in ('PAYMENT_GATEWAY', 'STRIPE_SECRET_KEY', 'STRIPE_SESSION_CACHE_TTL', 'FAKE_GATEWAY_LATENCY'):
+        get_gateway.cache_clear()
@@ -0,0 +1,193 @@
+"""
+"Frequently bought together" and best-seller recommendations.
+
+``manage.py build_recommendations`` turns the OrderItem history into a sparse
+product co-occurrence matrix, stored as ``ProductPair`` rows (orders that
+contained both products; the diagonal is each product's own order count).
+Runs are incremental: only orders placed since the last run are read, one
+chunk of orders at a time, and each chunk's counts are added to the matrix
+with a single upsert, so memory is bounded by the chunk size rather than the
+history.  With NumPy installed the pairs of a whole chunk are generated and
+counted with array operations; without it a Counter does the same work.
+
+The storefront never reads the matrix.  After counting, the top pairs of each
+touched product are copied into ``RelatedProduct`` and the top sellers of
+each category into ``CategoryBestSeller``, small tables that the home page
+and cart read with one indexed query.
+"""
+import logging
+from collections import Counter
+from datetime import timedelta
+from itertools import groupby, product as cartesian
+
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .caching import bump_catalog_version
+from .models import CategoryBestSeller, Order, OrderItem, Product, ProductPair, RecommendationRun, RelatedProduct
+
+try:
+    import numpy as np
+except ImportError:  # Optional: the pure-Python counter gives the same results, more slowly
+    np = None
+
+logger = logging.getLogger(__name__)
+
+TOP_RELATED = 10  # RelatedProduct rows kept per product
+TOP_SELLERS = 10  # CategoryBestSeller rows kept per category
+ORDER_CHUNK_SIZE = 20000
+# Baskets larger than this add to their products' order counts but not to the pairs,
+# so one bulk order can't add tens of thousands of pairs (and little signal)
+MAX_BASKET_SIZE = 50
+# Orders younger than this are left for the next run, so one still committing
+# with a lower id than a counted one is never skipped
+SETTLE_SECONDS = 60
+RANK_CHUNK_SIZE = 200  # Products whose RelatedProduct rows are rebuilt per statement
+
+
+def count_pairs_numpy(rows):
+    """ Count (product, related) pairs over baskets; `rows` are distinct (order_id, product_id), sorted """
+    # Each pair is packed into one int64 key (ids below 2**31), so np.unique counts them all at once
+    orders = np.fromiter((order_id for order_id, _ in rows), dtype=np.int64, count=len(rows))
+    products = np.fromiter((product_id for _, product_id in rows), dtype=np.int64, count=len(rows))
+    _, starts, sizes = np.unique(orders, return_index=True, return_counts=True)
+
+    # Each item pairs with every item of its basket, itself included (the diagonal);
+    # items of oversized baskets pair only with themselves
+    basket = np.repeat(np.arange(len(starts)), sizes)
+    partners = np.where(sizes[basket] <= MAX_BASKET_SIZE, sizes[basket], 1)
+    left = np.repeat(np.arange(len(rows)), partners)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(partners) - partners, partners)
+    right = np.where(partners[left] > 1, starts[basket[left]] + offsets, left)
+
+    keys, counts = np.unique((products[left] << 32) | products[right], return_counts=True)
+    return Counter(dict(zip(zip((keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist()), counts.tolist())))
+
+
+def count_pairs_python(rows):
+    counts = Counter()
+    for _, items in groupby(rows, key=lambda row: row[0]):
+        basket = [product_id for _, product_id in items]
+        if len(basket) > MAX_BASKET_SIZE:
+            counts.update((product_id, product_id) for product_id in basket)
+        else:
+            counts.update(cartesian(basket, repeat=2))
+    return counts
+
+
+def count_pairs(rows):
+    return count_pairs_numpy(rows) if np is not None and rows else count_pairs_python(rows)
+
+
+def add_pair_counts(counts):
+    """ Add `counts` to ProductPair: one INSERT ... ON CONFLICT DO UPDATE per pair, sent as one batch """
+    table = connection.ops.quote_name(ProductPair._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {table} (product_id, related_id, orders) VALUES (%s, %s, %s) "
+            f"ON CONFLICT (product_id, related_id) DO UPDATE SET orders = {table}.orders + excluded.orders",
+            [(product_id, related_id, orders) for (product_id, related_id), orders in counts.items()],
+        )
+
+
+def rank_related(product_ids, top=TOP_RELATED):
+    """ Rewrite the RelatedProduct rows of `product_ids` from the matrix """
+    product_ids = sorted(product_ids)
+    for start in range(0, len(product_ids), RANK_CHUNK_SIZE):
+        chunk = product_ids[start:start + RANK_CHUNK_SIZE]
+        ranked = (
+            ProductPair.objects.filter(product_id__in=chunk).exclude(related=F('product'))
+            .annotate(rank=Window(RowNumber(), partition_by=F('product'), order_by=[F('orders').desc(), F('related')]))
+            .filter(rank__lte=top)
+            .values_list('product_id', 'related_id', 'rank', 'orders')
+        )
+        rows = [RelatedProduct(product_id=product_id, related_id=related_id, rank=rank, orders=orders)
+                for product_id, related_id, rank, orders in ranked]
+        with transaction.atomic():
+            RelatedProduct.objects.filter(product_id__in=chunk).delete()
+            RelatedProduct.objects.bulk_create(rows)
+
+
+def rank_best_sellers(top=TOP_SELLERS):
+    """ Rewrite CategoryBestSeller from the matrix's diagonal (one row per product, so this stays cheap) """
+    ranked = (
+        ProductPair.objects.filter(related=F('product'))
+        .annotate(rank=Window(RowNumber(), partition_by=F('product__category'),
+                              order_by=[F('orders').desc(), F('product')]))
+        .filter(rank__lte=top)
+        .values_list('product__category_id', 'product_id', 'rank', 'orders')
+    )
+    rows = [CategoryBestSeller(category_id=category_id, product_id=product_id, rank=rank, orders=orders)
+            for category_id, product_id, rank, orders in ranked]
+    with transaction.atomic():
+        CategoryBestSeller.objects.all().delete()
+        CategoryBestSeller.objects.bulk_create(rows)
+
+
+def build_recommendations(full=False, chunk_size=ORDER_CHUNK_SIZE, settle_seconds=SETTLE_SECONDS):
+    """ Count the orders placed since the last run, then refresh the lookup tables; returns the run """
+    if full:
+        with transaction.atomic():
+            ProductPair.objects.all().delete()
+            # Only products in the replayed orders are re-ranked, so nobody else may keep old rows
+            RelatedProduct.objects.all().delete()
+            RecommendationRun.objects.all().delete()
+    last = RecommendationRun.objects.order_by('-last_order_id').values_list('last_order_id', flat=True).first() or 0
+    run = RecommendationRun.objects.create(last_order_id=last)
+    cutoff = timezone.now() - timedelta(seconds=settle_seconds)
+
+    touched = set()
+    while True:
+        order_ids = list(Order.objects.filter(id__gt=run.last_order_id, date__lt=cutoff)
+                         .order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not order_ids:
+            break
+        rows = list(
+            OrderItem.objects.filter(order_id__gte=order_ids[0], order_id__lte=order_ids[-1])
+            .order_by('order_id', 'product_id').values_list('order_id', 'product_id').distinct()
+        )
+        counts = count_pairs(rows)
+        # The counts and the watermark move together, so an interrupted run resumes without double counting
+        with transaction.atomic():
+            add_pair_counts(counts)
+            run.last_order_id, run.orders = order_ids[-1], run.orders + len(order_ids)
+            run.save(update_fields=['last_order_id', 'orders'])
+        touched.update(product_id for product_id, _ in counts)
+        logger.debug("recommendations_chunk orders=%d lines=%d pairs=%d", len(order_ids), len(rows), len(counts))
+
+    if touched or full:
+        rank_related(touched)
+        rank_best_sellers()
+        bump_catalog_version()  # The cached home page shows the best sellers
+    run.finished_at = timezone.now()
+    run.save(update_fields=['finished_at'])
+    logger.info("recommendations_built orders=%d products=%d last_order=%d", run.orders, len(touched), run.last_order_id)
+    return run
+
+
+def frequently_bought_with(product_ids, limit=4):
+    """ In-stock products most often ordered together with any of `product_ids`, in one indexed query """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return []
+    rows = (
+        RelatedProduct.objects.filter(product_id__in=product_ids, related__stock__gt=0)
+        .exclude(related_id__in=product_ids)
+        .select_related('related')
+        .order_by('-orders', 'rank', 'related_id')
+    )
+    related = {}
+    for row in rows:
+        related.setdefault(row.related_id, row.related)
+    return list(related.values())[:limit]
+
+
+def best_sellers(limit=3):
+    """ The top seller of each category, best first, topped up with other products (e.g. before the first build) """
+    products = [row.product for row in CategoryBestSeller.objects.filter(rank=1, product__stock__gt=0)
+                .select_related('product').order_by('-orders', 'product_id')[:limit]]
+    if len(products) < limit:
+        products += Product.objects.exclude(id__in=[product.id for product in products])[:limit - len(products)]
+    return products
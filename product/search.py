@@ -0,0 +1,140 @@
+"""
+Search backends behind the catalog's ``?search=`` parameter.
+
+The default backend keeps a SQLite FTS5 index of every product in sync through
+the signals in ``product.signals`` and returns ranked, prefix-matched results.
+``ORMSearchBackend`` is the original ``icontains`` scan and is used whenever the
+database is not SQLite.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+FTS_TABLE = 'product_search_index'
+DEFAULT_BACKEND = 'product.search.FTS5SearchBackend'
+INDEX_CHUNK_SIZE = 500  # Products per statement in index_products()
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+class ORMSearchBackend:
+    """ Unindexed LIKE scan over name and description, works on any database """
+
+    def search(self, queryset, query):
+        return queryset.filter(Q(name__icontains=query) | Q(description__icontains=query))
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def index_products(self, product_ids):
+        """ Re-index just these products, after a bulk write that skipped the signals """
+        pass
+
+    def rebuild(self):
+        return 0
+
+
+class FTS5SearchBackend(ORMSearchBackend):
+    """ SQLite FTS5 index with bm25 ranking, name hits weigh more than description hits """
+
+    # bm25() column weights, in the column order of the virtual table
+    weights = {'name': 10.0, 'description': 1.0, 'category': 2.0}
+
+    def is_available(self):
+        return connection.vendor == 'sqlite'
+
+    def build_match(self, query):
+        # Quote each word so user input can never be parsed as FTS syntax, and
+        # make the last one a prefix so results show up while the user types.
+        tokens = _TOKEN_RE.findall(query.lower())
+        if not tokens:
+            return ''
+        terms = [f'"{token}"' for token in tokens[:-1]]
+        terms.append(f'"{tokens[-1]}"*')
+        return ' '.join(terms)
+
+    def search(self, queryset, query):
+        match = self.build_match(query)
+        if not match or not self.is_available():
+            return super().search(queryset, query)
+
+        product_table = connection.ops.quote_name(queryset.model._meta.db_table)
+        weights = ', '.join(str(weight) for weight in self.weights.values())
+        # Join the index rather than ranking in a correlated subquery: bm25() gathers
+        # term statistics over every match, so per-row calls made searches O(n^2).
+        return (
+            queryset.extra(
+                tables=[FTS_TABLE],
+                where=[f'{FTS_TABLE}.rowid = {product_table}."id"', f'{FTS_TABLE} MATCH %s'],
+                params=[match],
+            )
+            .annotate(search_rank=RawSQL(f'bm25({FTS_TABLE}, {weights})', ()))
+            .order_by('search_rank', 'id')
+        )
+
+    def index_product(self, product):
+        if not self.is_available():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product.pk])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) VALUES (%s, %s, %s, %s)',
+                [product.pk, product.name, product.description, product.category.name],
+            )
+
+    def remove_product(self, product_id):
+        if not self.is_available():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+    # Copies products (with their category name) into the index; callers add the WHERE
+    index_sql = (
+        f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) '
+        f'SELECT p.id, p.name, p.description, c.name FROM product_product p '
+        f'JOIN product_category c ON c.id = p.category_id'
+    )
+
+    def index_products(self, product_ids):
+        if not self.is_available():
+            return
+        product_ids = list(product_ids)
+        with connection.cursor() as cursor:
+            for start in range(0, len(product_ids), INDEX_CHUNK_SIZE):
+                chunk = product_ids[start:start + INDEX_CHUNK_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', chunk)
+                cursor.execute(f'{self.index_sql} WHERE p.id IN ({placeholders})', chunk)
+
+    def rebuild(self):
+        if not self.is_available():
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(self.index_sql)
+            return cursor.rowcount
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    return import_string(getattr(settings, 'PRODUCT_SEARCH_BACKEND', DEFAULT_BACKEND))()
+
+
+@receiver(setting_changed)
+def _reset_search_backend(setting, **kwargs):
+    if setting == 'PRODUCT_SEARCH_BACKEND':
+        get_search_backend.cache_clear()
+
+
+def search_products(queryset, query):
+    return get_search_backend().search(queryset, query)
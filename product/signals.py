@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .anonymous_cart import get_anonymous_cart
+from .auth import invalidate_cached_user
+from .caching import bump_catalog_version
+from .cart import refresh_cart_summary
+from .images import PRODUCT_WIDTHS, available_formats, render_renditions
+from .models import CartItem, Category, Product
+from .search import get_search_backend
+
+
+# Keep the search index in step with the catalog
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    get_search_backend().remove_product(instance.pk)
+
+
+# Any catalog change invalidates the cached home/catalog pages
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog_pages(sender, instance, **kwargs):
+    bump_catalog_version()
+
+
+# Category names are in the search index and on every cached catalog page
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, created, **kwargs):
+    if not created:
+        get_search_backend().rebuild()  # Possibly a rename; rare enough to reindex in one statement
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_pages(sender, instance, **kwargs):
+    bump_catalog_version()
+
+
+# Keep CartSummary in step with the cart rows
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def update_cart_summary(sender, instance, **kwargs):
+    refresh_cart_summary(instance.user_id)
+
+
+# A price change moves the total of every cart holding the product
+@receiver(post_save, sender=Product)
+def reprice_carts(sender, instance, created, **kwargs):
+    if created:
+        return
+    user_ids = CartItem.objects.filter(product=instance, user__isnull=False).values_list('user_id', flat=True)
+    for user_id in user_ids.distinct():
+        refresh_cart_summary(user_id)
+
+
+# Drop the cached copy of a changed user (password, is_active, ...) used by CachedModelBackend
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    invalidate_cached_user(user_id)
+    # Again once committed, in case a request re-cached the old row in between
+    transaction.on_commit(lambda: invalidate_cached_user(user_id))
+
+
+# Move the cart a visitor filled before logging in into their account (one batch)
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is not None:
+        get_anonymous_cart(request).merge_into(user)
+
+
+# Build resized copies of newly uploaded product images
+@receiver(post_save, sender=Product)
+def build_product_renditions(sender, instance, **kwargs):
+    if not instance.image or instance.renditions.get('source') == instance.image.name:
+        return
+    product_id, name = instance.pk, instance.image.name
+    transaction.on_commit(lambda: update_product_renditions(product_id, name))
+
+
+def update_product_renditions(product_id, name):
+    try:
+        renditions = render_renditions(settings.MEDIA_ROOT, name, PRODUCT_WIDTHS, available_formats())
+    except (OSError, ValueError):
+        return  # Missing or unreadable upload; `manage.py build_renditions` will retry it
+    # update() rather than save(), so this doesn't re-trigger the post_save receivers
+    if Product.objects.filter(pk=product_id, image=name).update(renditions=renditions, updated_at=timezone.now()):
+        bump_catalog_version()
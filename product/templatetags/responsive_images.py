@@ -0,0 +1,50 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+
+from product.images import FORMATS, build_srcset, get_manifest
+
+register = template.Library()
+
+PLACEHOLDER = 'https://via.placeholder.com/300x200'
+
+
+def render_picture(src, renditions, alt, sizes, attrs):
+    img_attrs = {'alt': alt, 'loading': 'lazy', 'decoding': 'async', **attrs}
+    if not renditions or not renditions.get('formats'):
+        return format_html('<img src="{}"{}>', src, format_html_join('', ' {}="{}"', img_attrs.items()))
+
+    formats = renditions['formats']
+    fallback = 'jpeg' if 'jpeg' in formats else next(iter(formats))
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((FORMATS[fmt]['mime'], build_srcset(renditions, fmt), sizes) for fmt in formats if fmt != fallback),
+    )
+    largest = formats[fallback][-1][1]
+    img_attrs.update(width=renditions['width'], height=renditions['height'])
+    return format_html(
+        '<picture>{}<img src="{}{}" srcset="{}" sizes="{}"{}></picture>',
+        sources, settings.MEDIA_URL, largest, build_srcset(renditions, fallback), sizes,
+        format_html_join('', ' {}="{}"', img_attrs.items()),
+    )
+
+
+@register.simple_tag
+def product_picture(product, sizes='(min-width: 768px) 33vw, 100vw', **attrs):
+    """ <picture> for a product image: {% product_picture product class="card-img-top" %} """
+    if not product.image:
+        return render_picture(PLACEHOLDER, None, product.name, sizes, attrs)
+    renditions = product.renditions if product.renditions.get('source') == product.image.name else None  # Not stale
+    return render_picture(product.image.url, renditions, product.name, sizes, attrs)
+
+
+@register.simple_tag
+def media_picture(name, alt='', sizes='100vw', **attrs):
+    """ <picture> for any file under MEDIA_ROOT that build_renditions has processed """
+    return render_picture(f'{settings.MEDIA_URL}{name}', get_manifest().get(name), alt, sizes, attrs)
+
+
+@register.simple_tag
+def srcset(renditions, fmt='jpeg'):
+    """ Just the srcset attribute value, for hand-written markup """
+    return build_srcset(renditions, fmt) if renditions else ''
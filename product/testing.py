@@ -0,0 +1,44 @@
+"""
+Test helpers shared by the product app's test suite.
+"""
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+@contextmanager
+def query_budget(max_queries, using=DEFAULT_DB_ALIAS):
+    """
+    Fail if the block runs more than `max_queries` queries.
+
+    Unlike ``assertNumQueries`` this is an upper bound, so a view can get
+    cheaper without breaking its test, and the error lists every query so an
+    N+1 regression is obvious from the failure alone.
+    """
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    executed = len(context.captured_queries)
+    if executed > max_queries:
+        queries = '\n'.join(f"{index}. {query['sql']}" for index, query in enumerate(context.captured_queries, 1))
+        raise AssertionError(f"{executed} queries executed, budget is {max_queries}:\n{queries}")
+
+
+class QueryBudgetMixin:
+    """ TestCase mixin: assert a callable stays within budget regardless of how much data it sees """
+
+    def assertFlatQueries(self, budget, func, grow, sizes=(1, 10)):
+        """
+        Call grow(size) then func() for each size: every run must stay within
+        `budget` and all of them must run the same number of queries, so a
+        query per row fails even while the total is under budget.
+        """
+        counts = []
+        for size in sizes:
+            grow(size)
+            cache.clear()  # Every run starts cold
+            with query_budget(budget) as context:
+                func()
+            counts.append(len(context.captured_queries))
+        self.assertEqual(len(set(counts)), 1, f"query count grew with data: {counts}")
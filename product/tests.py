@@ -1,3 +1,1584 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import BytesIO, StringIO
+import threading
+import time
+from dataclasses import asdict
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, close_old_connections, connection
+from django.http import QueryDict
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
+from PIL import Image
+
+from . import async_views, recommendations
+from .anonymous_cart import COOKIE_NAME
+from .assets import accepted_encodings
+from .benchmarks import SCENARIOS, import_costs, parse_importtime, profile_startup
+from .cart import get_cart_summary
+from .context_processors import cart_count
+from .mail import MAX_ATTEMPTS, deliver_batch, enqueue_email
+from .facets import get_facets
+from .fulfilment import process_pending_events
+from .images import get_manifest, render_renditions
+from .metrics import REGISTRY
+from .inventory import OutOfStock, add_to_cart, release_expired_reservations, reservation_ttl, reserve_stock
+from .models import (
+    CartItem, CartSummary, Category, CategoryBestSeller, CategoryDailySales, DailySales, Order, OrderItem, OutboundEmail,
+    Product, ProductDailySales, ProductPair, RelatedProduct, StockReservation, StripeEvent,
+)
+from .orders import create_order_from_cart
+from .pagination import encode_cursor
+from .payments import FakeGateway, InvalidWebhook, get_gateway
+from .recommendations import MAX_BASKET_SIZE, build_recommendations, count_pairs_python
+from .search import get_search_backend, search_products
+from .startup import preload
+from .testing import QueryBudgetMixin
+
+
+def make_product(name, description='', price='10.00', category='Electronics', stock=10):
+    category, _ = Category.objects.get_or_create(slug=slugify(category), defaults={'name': category})
+    return Product.objects.create(
+        name=name, description=description, price=price, stock=stock,
+        image='products/test.jpg', category=category,
+    )
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.watch = make_product('Apple Watch', 'Smart watch with fitness tracking')
+        self.phone = make_product('iPhone', 'Phone that pairs with your watch')
+        self.coat = make_product('Trench Coat', 'Classic beige coat', category='Clothing')
+
+    def search(self, query):
+        response = self.client.get(reverse('product_list'), {'search': query})
+        return list(response.context['products'])
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('watch'), [self.watch, self.phone])
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.search('tren'), [self.coat])
+
+    def test_fts_syntax_in_query_is_treated_as_text(self):
+        self.assertEqual(self.search('coat*) "'), [self.coat])
+
+    def test_index_follows_save_and_delete(self):
+        self.coat.name = 'Rain Jacket'
+        self.coat.save()
+        self.assertEqual(self.search('jacket'), [self.coat])
+        self.coat.delete()
+        self.assertEqual(self.search('jacket'), [])
+
+    def test_rebuild(self):
+        self.assertEqual(get_search_backend().rebuild(), 3)
+        self.assertEqual(self.search('iphone'), [self.phone])
+
+    @override_settings(PRODUCT_SEARCH_BACKEND='product.search.ORMSearchBackend')
+    def test_orm_fallback(self):
+        self.assertEqual(set(self.search('watch')), {self.watch, self.phone})
+
+
+def fake_session(user):
+    """ A paid Checkout Session from FakeGateway (PAYMENT_GATEWAY must point at it) """
+    return get_gateway().create_session(
+        line_items=[], success_url='/products/success/?session_id={CHECKOUT_SESSION_ID}', cancel_url='/',
+        client_reference_id=str(user.pk), customer_email='shopper@example.com',
+    )
+
+
+@override_settings(PRODUCT_PAGE_SIZE=2)
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        # Duplicate prices make the id tiebreaker matter
+        for index, price in enumerate(['5.00', '5.00', '3.00', '9.00', '5.00']):
+            make_product(f'Product {index}', price=price, category='Clothing' if index % 2 else 'Electronics')
+
+    def walk(self, params):
+        seen, cursor = [], None
+        while True:
+            response = self.client.get(reverse('product_list_json'), {**params, **({'cursor': cursor} if cursor else {})})
+            data = response.json()
+            seen.extend(item['id'] for item in data['results'])
+            cursor = data['next_cursor']
+            if not cursor:
+                return seen
+
+    def test_pages_follow_sort_order_without_gaps_or_repeats(self):
+        for sort, ordering in [('price', ('price', 'id')), ('-price', ('-price', '-id')),
+                               ('name', ('name', 'id')), ('-name', ('-name', '-id'))]:
+            expected = list(Product.objects.order_by(*ordering).values_list('id', flat=True))
+            self.assertEqual(self.walk({'sort': sort}), expected, sort)
+
+    def test_filters_apply_to_every_page(self):
+        expected = list(Product.objects.filter(category__name='Electronics', price__gte=4).order_by('price', 'id')
+                        .values_list('id', flat=True))
+        self.assertEqual(self.walk({'sort': 'price', 'category': 'electronics', 'min_price': '4'}), expected)
+
+    def test_html_page_links_to_next_cursor(self):
+        response = self.client.get(reverse('product_list'), {'sort': 'price'})
+        self.assertEqual(len(response.context['products']), 2)
+        self.assertIn('cursor=', response.context['next_query'])
+
+    def test_invalid_cursor_starts_from_first_page(self):
+        response = self.client.get(reverse('product_list_json'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(len(response.json()['results']), 2)
+
+    def test_search_results_paginate_by_relevance(self):
+        self.assertEqual(sorted(self.walk({'search': 'product'})), sorted(Product.objects.values_list('id', flat=True)))
+
+    def test_tampered_cursor_restarts_from_the_first_page(self):
+        first = self.client.get(reverse('product_list_json'), {'sort': 'price'}).json()['results']
+        for sort, value in [('price', 'abc'), ('price', 'NaN'), ('price', [1]), ('price', {'a': 1}), ('name', None),
+                            ('name', 5), ('-name', ['x'])]:
+            cursor = encode_cursor(sort, value, 1)
+            for name in ('product_list', 'product_list_json'):
+                response = self.client.get(reverse(name), {'sort': sort, 'cursor': cursor})
+                self.assertEqual(response.status_code, 200, (sort, value, name))
+            if sort == 'price':
+                self.assertEqual(response.json()['results'], first)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        make_product('Apple Watch', price='100.00')
+        make_product('Pocket Watch', price='20.00')
+        make_product('Trench Coat', price='45.00', category='Clothing')
+        make_product('Garden Hose', price='24.99', category='Garden')
+
+    def facets(self, **params):
+        return self.client.get(reverse('product_list'), params).context['facets']
+
+    def test_counts_ignore_their_own_filter(self):
+        facets = self.facets(category='electronics', min_price='25', max_price='49.99')
+        self.assertEqual([(facet.name, facet.count, facet.selected) for facet in facets['categories']],
+                         [('Clothing', 1, False), ('Electronics', 0, True)])
+        self.assertEqual([(facet.label, facet.count, facet.selected) for facet in facets['price']], [
+            ('Under $25', 1, False), ('$25 – $50', 0, True), ('$50 – $100', 0, False),
+            ('$100 – $250', 1, False), ('$250 and up', 0, False),
+        ])
+        self.assertNotIn('min_price=25', facets['price'][1].query)  # The chosen bucket links back to all prices
+
+    def test_options_come_from_data(self):
+        response = self.client.get(reverse('product_list'), {'search': 'watch'})
+        self.assertContains(response, '<option value="electronics" >Electronics (2)</option>', html=True)
+        self.assertNotContains(response, 'value="garden"')
+        self.assertContains(response, 'href="?search=watch&amp;min_price=&amp;max_price=24.99"')
+
+    def test_one_cached_query(self):
+        products = Product.objects.all()
+        filters = {'query': '', 'category': '', 'min_price': '', 'max_price': ''}
+        with self.assertNumQueries(1):
+            get_facets(products, filters, QueryDict())
+        with self.assertNumQueries(0):
+            get_facets(products, filters, QueryDict())
+        make_product('Sun Hat', category='Hats')
+        self.assertIn('Hats', [facet.name for facet in get_facets(products, filters, QueryDict())['categories']])
+
+    def test_category_rename_reaches_search_and_json(self):
+        Category.objects.filter(slug='garden').update(name='Outdoor')
+        category = Category.objects.get(slug='garden')
+        category.save()
+        results = self.client.get(reverse('product_list_json'), {'search': 'outdoor'}).json()['results']
+        self.assertEqual([(result['name'], result['category']) for result in results], [('Garden Hose', 'Outdoor')])
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.coat = make_product('Trench Coat', price='25.50')
+
+    def summary(self):
+        return CartSummary.objects.get(user=self.user)
+
+    def test_summary_follows_cart_writes(self):
+        self.client.post(reverse('add_to_cart', args=[self.watch.id]))
+        response = self.client.post(reverse('add_to_cart', args=[self.coat.id]))
+        self.assertEqual(response.json()['cart_count'], 2)
+        self.assertEqual((self.summary().item_count, self.summary().total_amount), (2, Decimal('125.50')))
+
+        item = CartItem.objects.get(user=self.user, product=self.coat)
+        response = self.client.post(reverse('update_cart'), {'cart_item_id': item.id, 'quantity': 3})
+        self.assertEqual(response.json()['total_amount'], 176.5)
+
+        self.client.get(reverse('remove_from_cart', args=[item.id]))
+        self.assertEqual((self.summary().item_count, self.summary().total_amount), (1, Decimal('100.00')))
+
+    def test_price_change_reprices_cart(self):
+        CartItem.objects.create(user=self.user, product=self.coat, quantity=2)
+        self.coat.price = Decimal('30.00')
+        self.coat.save()
+        self.assertEqual(self.summary().total_amount, Decimal('60.00'))
+
+    def test_badge_is_one_query(self):
+        for product in [self.watch, self.coat]:
+            CartItem.objects.create(user=self.user, product=product, quantity=4)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_cart_summary(self.user).item_count, 8)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_summary(self.user).item_count, 8)
+
+    def test_reconcile_fixes_drift(self):
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=2)
+        CartSummary.objects.filter(user=self.user).update(item_count=99)
+        call_command('reconcile_cart_summaries', stdout=StringIO())
+        self.assertEqual(self.summary().item_count, 2)
+
+
+class CartBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.coat = make_product('Trench Coat', price='25.50')
+        self.hat = make_product('Sun Hat', price='5.00')
+
+    def batch(self, operations):
+        return self.client.post(reverse('cart_batch'), {'operations': operations}, content_type='application/json')
+
+    def test_mixed_operations(self):
+        watch = CartItem.objects.create(user=self.user, product=self.watch, quantity=1)
+        coat = CartItem.objects.create(user=self.user, product=self.coat, quantity=4)
+        response = self.batch([
+            {'cart_item_id': watch.id, 'quantity': 3},
+            {'cart_item_id': coat.id, 'quantity': 0},
+            {'product_id': self.hat.id, 'add': 1},
+            {'product_id': self.hat.id, 'add': 1},
+        ])
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual({line['product_id']: line['quantity'] for line in data['lines']},
+                         {self.watch.id: 3, self.hat.id: 2})
+        self.assertEqual(data['cart_total'], 310.0)
+        self.assertEqual(data['cart_count'], 5)
+        self.assertFalse(CartItem.objects.filter(id=coat.id).exists())
+        summary = CartSummary.objects.get(user=self.user)
+        self.assertEqual((summary.item_count, summary.total_amount), (5, Decimal('310.00')))
+
+    def test_foreign_cart_item_rejects_whole_batch(self):
+        other = User.objects.create_user('other', password='secret')
+        theirs = CartItem.objects.create(user=other, product=self.watch, quantity=1)
+        mine = CartItem.objects.create(user=self.user, product=self.coat, quantity=1)
+        response = self.batch([{'cart_item_id': mine.id, 'quantity': 5}, {'cart_item_id': theirs.id, 'quantity': 9}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CartItem.objects.get(id=mine.id).quantity, 1)
+        self.assertEqual(CartItem.objects.get(id=theirs.id).quantity, 1)
+
+    def test_malformed_requests(self):
+        self.assertEqual(self.client.post(reverse('cart_batch'), 'nope', content_type='application/json').status_code, 400)
+        self.assertEqual(self.batch({'product_id': self.hat.id}).status_code, 400)
+        self.assertEqual(self.batch([{'product_id': self.hat.id, 'quantity': -1}]).status_code, 400)
+        self.assertEqual(self.batch([{'cart_item_id': 1, 'add': 1}]).status_code, 400)
+
+    def test_out_of_stock_increase_is_skipped(self):
+        Product.objects.filter(id=self.hat.id).update(stock=0)
+        data = self.batch([{'product_id': self.hat.id, 'add': 2}, {'product_id': self.coat.id, 'quantity': 1}]).json()
+        self.assertEqual(data['unavailable'], [self.hat.id])
+        self.assertEqual([line['product_id'] for line in data['lines']], [self.coat.id])
+
+
+class AnonymousCartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.coat = make_product('Trench Coat', price='25.50')
+
+    def batch(self, operations):
+        return self.client.post(reverse('cart_batch'), {'operations': operations}, content_type='application/json')
+
+    def test_cart_lives_in_a_cookie(self):
+        with self.assertNumQueries(1):  # The product lookup; no cart writes
+            response = self.client.post(reverse('add_to_cart', args=[self.watch.id]))
+        self.assertEqual(response.json()['cart_count'], 1)
+        self.assertIn(COOKIE_NAME, response.cookies)
+
+        data = self.batch([{'product_id': self.watch.id, 'add': 1}, {'product_id': self.coat.id, 'quantity': 2}]).json()
+        self.assertEqual((data['cart_count'], data['cart_total']), (4, 251.0))
+        self.assertFalse(CartItem.objects.exists())
+
+        response = self.client.get(reverse('view_cart'))
+        self.assertContains(response, 'Trench Coat')
+        self.assertEqual(response.context['total_cart_quantity'], 4)
+
+    def test_badge_needs_no_query(self):
+        self.batch([{'product_id': self.watch.id, 'quantity': 3}])
+        request = RequestFactory().get('/')
+        request.COOKIES[COOKIE_NAME] = self.client.cookies[COOKIE_NAME].value
+        request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_count(request), {'total_cart_quantity': 3})
+
+    def test_tampered_cookie_is_an_empty_cart(self):
+        self.client.cookies[COOKIE_NAME] = 'not-signed'
+        response = self.client.get(reverse('view_cart'))
+        self.assertContains(response, 'Your cart is empty')
+        self.assertEqual(response.cookies[COOKIE_NAME].value, '')
+
+    def test_cart_items_cannot_be_addressed(self):
+        item = CartItem.objects.create(user=User.objects.create_user('other'), product=self.watch, quantity=1)
+        self.assertEqual(self.batch([{'cart_item_id': item.id, 'quantity': 0}]).status_code, 400)
+        self.assertEqual(self.client.get(reverse('remove_from_cart', args=[item.id])).status_code, 302)
+        self.assertTrue(CartItem.objects.filter(id=item.id).exists())
+
+    def test_cart_pages_are_not_shared(self):
+        self.client.get(reverse('product_list'))
+        self.batch([{'product_id': self.watch.id, 'quantity': 2}])
+        response = self.client.get(reverse('product_list'))
+        self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertEqual(response.context['total_cart_quantity'], 2)
+
+    def test_login_merges_cart(self):
+        user = User.objects.create_user('shopper', password='secret')
+        CartItem.objects.create(user=user, product=self.watch, quantity=1)
+        self.batch([{'product_id': self.watch.id, 'quantity': 2}, {'product_id': self.coat.id, 'quantity': 1}])
+
+        response = self.client.post(reverse('login'), {'username': 'shopper', 'password': 'secret'})
+        self.assertEqual(response.cookies[COOKIE_NAME].value, '')
+        self.assertEqual(dict(CartItem.objects.filter(user=user).values_list('product_id', 'quantity')),
+                         {self.watch.id: 3, self.coat.id: 1})
+        self.assertEqual(get_cart_summary(user).item_count, 4)
+
+    def test_remove_is_scoped_to_owner(self):
+        owner, other = User.objects.create_user('owner'), User.objects.create_user('other')
+        item = CartItem.objects.create(user=owner, product=self.watch, quantity=1)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(reverse('remove_from_cart', args=[item.id])).status_code, 404)
+        self.client.force_login(owner)
+        self.client.get(reverse('remove_from_cart', args=[item.id]))
+        self.assertFalse(CartItem.objects.filter(id=item.id).exists())
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """ Each cart/order view must run a fixed number of queries however many lines there are """
+
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.products = [make_product(f'Product {index}', price='2.50') for index in range(12)]
+
+    def fill_cart(self, lines):
+        CartItem.objects.filter(user=self.user).delete()
+        for product in self.products[:lines]:
+            CartItem.objects.create(user=self.user, product=product, quantity=2)
+
+    def place_orders(self, count, lines):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, total_amount=Decimal('5.00') * lines)
+            for product in self.products[:lines]:
+                OrderItem.objects.create(order=order, product=product, product_name=product.name,
+                                         unit_price=product.price, quantity=2)
+
+    def test_view_cart(self):
+        self.assertFlatQueries(5, lambda: self.client.get(reverse('view_cart')), self.fill_cart)
+
+    def test_checkout_page(self):
+        self.assertFlatQueries(5, lambda: self.client.get(reverse('checkout')), self.fill_cart)
+
+    def test_update_cart(self):
+        def update():
+            item = CartItem.objects.filter(user=self.user).first()
+            self.client.post(reverse('update_cart'), {'cart_item_id': item.id, 'quantity': 3})
+        self.assertFlatQueries(12, update, self.fill_cart)
+
+    def test_cart_batch(self):
+        def update():
+            operations = [{'cart_item_id': item.id, 'quantity': 3} for item in CartItem.objects.filter(user=self.user)]
+            operations.append({'product_id': self.products[-1].id, 'add': 1})
+            self.client.post(reverse('cart_batch'), {'operations': operations}, content_type='application/json')
+        self.assertFlatQueries(16, update, self.fill_cart)
+
+    def test_order_history(self):
+        def grow(size):
+            Order.objects.all().delete()
+            self.place_orders(size, size)
+        self.assertFlatQueries(6, lambda: self.client.get(reverse('order_history')), grow)
+
+    def test_create_checkout_session(self):
+        def grow(size):
+            StockReservation.objects.all().delete()
+            self.fill_cart(size)
+        self.assertFlatQueries(11, lambda: self.client.post(reverse('create_checkout_session')), grow)
+
+    def test_payment_success(self):
+        def grow(size):
+            Order.objects.all().delete()
+            self.fill_cart(size)
+        # Includes one sales rollup upsert per table (three), however many lines
+        self.assertFlatQueries(
+            27, lambda: self.client.get(reverse('payment_success'), {'session_id': fake_session(self.user).id}), grow,
+        )
+
+
+class CachedAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.client.login(username='shopper', password='secret')
+        self.item = CartItem.objects.create(user=self.user, product=make_product('Shoe'), quantity=1)
+
+    def update(self, quantity):
+        return self.client.post(reverse('update_cart'), {'cart_item_id': self.item.id, 'quantity': quantity})
+
+    def test_cart_click_skips_session_and_user_queries(self):
+        self.update(2)  # Warms the session and user caches
+        with CaptureQueriesContext(connection) as context:
+            response = self.update(3)
+        self.assertEqual(response.json()['total_amount'], 30.0)
+        tables = ' '.join(query['sql'] for query in context.captured_queries)
+        self.assertNotIn('django_session', tables)
+        self.assertNotIn('auth_user', tables)
+
+    def test_saving_the_user_invalidates_the_cache(self):
+        self.update(2)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.update(3).status_code, 302)  # login_required: now anonymous
+
+    def test_failed_login_hashes_the_password_once(self):
+        with mock.patch('django.contrib.auth.base_user.make_password', wraps=make_password) as hash_password:
+            self.assertIsNone(authenticate(username='nobody', password='secret'))
+        self.assertEqual(hash_password.call_count, 1)
+        with mock.patch('django.contrib.auth.base_user.check_password', wraps=check_password) as check:
+            self.assertIsNone(authenticate(username='shopper', password='wrong'))
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(authenticate(username='shopper', password='secret'), self.user)
+
+    def test_password_change_logs_out_other_sessions(self):
+        self.update(2)
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEqual(self.update(3).status_code, 302)
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class OrderMaterializationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.coat = make_product('Trench Coat', price='25.50')
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=1)
+        CartItem.objects.create(user=self.user, product=self.coat, quantity=2)
+
+    def test_order_snapshots_lines_and_clears_cart(self):
+        order, created = create_order_from_cart(self.user, 'cs_1', email='shopper@example.com')
+        self.assertTrue(created)
+        self.assertEqual(order.total_amount, Decimal('151.00'))
+        self.assertEqual(
+            sorted(order.items.values_list('product_name', 'unit_price', 'quantity')),
+            [('Apple Watch', Decimal('100.00'), 1), ('Trench Coat', Decimal('25.50'), 2)],
+        )
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+        self.assertEqual(get_cart_summary(self.user).item_count, 0)
+
+        # Later price changes don't rewrite history
+        self.coat.price = Decimal('99.00')
+        self.coat.save()
+        self.assertEqual(order.items.get(product=self.coat).line_total, Decimal('51.00'))
+
+    def test_same_session_creates_one_order(self):
+        first, _ = create_order_from_cart(self.user, 'cs_1')
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=1)
+        second, created = create_order_from_cart(self.user, 'cs_1')
+        self.assertFalse(created)
+        self.assertEqual(first, second)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+    def test_failure_leaves_no_partial_order(self):
+        with mock.patch('product.orders.OrderItem.objects.bulk_create', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                create_order_from_cart(self.user, 'cs_1')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.filter(user=self.user).count(), 2)
+
+    def test_refreshing_success_page_queues_one_email(self):
+        session = fake_session(self.user)
+        self.client.force_login(self.user)
+        for _ in range(2):
+            response = self.client.get(reverse('payment_success'), {'session_id': session.id})
+            self.assertEqual(response.context['order'].stripe_session_id, session.id)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OutboundEmail.objects.get().to, 'shopper@example.com')
+        self.assertEqual(len(mail.outbox), 0)  # Nothing is sent on the request path
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.strap = make_product('Watch Strap', price='20.00')
+        self.coat = make_product('Trench Coat', price='25.50', category='Clothing')
+
+    def buy(self, session_id, *lines):
+        for product, quantity in lines:
+            CartItem.objects.create(user=self.user, product=product, quantity=quantity)
+        return create_order_from_cart(self.user, session_id)[0]
+
+    def rollups(self):
+        return (
+            list(DailySales.objects.values_list('date', 'orders', 'units', 'revenue')),
+            sorted(ProductDailySales.objects.values_list('product__name', 'category__name', 'orders', 'units', 'revenue')),
+            sorted(CategoryDailySales.objects.values_list('category__name', 'orders', 'units', 'revenue')),
+        )
+
+    def test_orders_are_added_as_they_are_created(self):
+        self.buy('cs_1', (self.watch, 1), (self.strap, 2))
+        self.buy('cs_2', (self.watch, 1), (self.coat, 2))
+        create_order_from_cart(self.user, 'cs_2')  # Already materialized: not counted twice
+
+        daily, products, categories = self.rollups()
+        self.assertEqual(daily, [(timezone.localdate(), 2, 6, Decimal('291.00'))])
+        self.assertEqual(products, [
+            ('Apple Watch', 'Electronics', 2, 2, Decimal('200.00')),
+            ('Trench Coat', 'Clothing', 1, 2, Decimal('51.00')),
+            ('Watch Strap', 'Electronics', 1, 2, Decimal('40.00')),
+        ])
+        self.assertEqual(categories, [('Clothing', 1, 2, Decimal('51.00')), ('Electronics', 2, 4, Decimal('240.00'))])
+
+    def test_backfill_matches_the_live_rollups(self):
+        self.buy('cs_1', (self.watch, 1), (self.strap, 2))
+        old = self.buy('cs_2', (self.coat, 3))
+        Order.objects.filter(pk=old.pk).update(date=timezone.now() - timedelta(days=40))
+        DailySales.objects.all().delete()
+        ProductDailySales.objects.all().delete()
+        CategoryDailySales.objects.all().delete()
+
+        call_command('backfill_sales_rollups', days_per_batch=7, stdout=StringIO())
+        daily, products, categories = self.rollups()
+        self.assertEqual(daily, [
+            (timezone.localdate() - timedelta(days=40), 1, 3, Decimal('76.50')),
+            (timezone.localdate(), 1, 3, Decimal('140.00')),
+        ])
+        self.assertIn(('Watch Strap', 'Electronics', 1, 2, Decimal('40.00')), products)
+        self.assertEqual(categories, [('Clothing', 1, 3, Decimal('76.50')), ('Electronics', 1, 3, Decimal('140.00'))])
+        call_command('backfill_sales_rollups', stdout=StringIO())  # Rebuilding is idempotent
+        self.assertEqual(self.rollups(), (daily, products, categories))
+
+    def test_backfill_keeps_the_category_at_sale_time(self):
+        self.buy('cs_1', (self.strap, 2))
+        live = self.rollups()
+        self.strap.category = self.coat.category  # Moved after the sale
+        self.strap.save()
+        call_command('backfill_sales_rollups', stdout=StringIO())
+        self.assertEqual(self.rollups(), live)
+        self.assertEqual(live[2], [('Electronics', 1, 2, Decimal('40.00'))])
+
+    def test_dashboard_reads_only_the_rollups(self):
+        self.buy('cs_1', (self.watch, 1), (self.strap, 2))
+        self.buy('cs_2', (self.coat, 2))
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('sales_dashboard'), {'days': 7})
+        self.assertEqual(response.context['summary'], {'orders': 2, 'units': 5, 'revenue': Decimal('191.00')})
+        self.assertEqual(response.context['average_order'], Decimal('95.50'))
+        self.assertEqual([row['product__name'] for row in response.context['products']],
+                         ['Apple Watch', 'Trench Coat', 'Watch Strap'])
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        self.assertNotIn('product_orderitem', sql)
+        self.assertNotIn('"product_order"', sql)
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('sales_dashboard')).status_code, 302)  # Staff only
+
+    def test_admin_changelists(self):
+        self.buy('cs_1', (self.watch, 1))
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+        for model in ('product', 'order', 'dailysales', 'productdailysales', 'categorydailysales', 'stripeevent'):
+            self.assertEqual(self.client.get(reverse(f'admin:product_{model}_changelist')).status_code, 200, model)
+        self.assertContains(self.client.get(reverse('admin:index')), reverse('sales_dashboard'))
+
+
+@override_settings(ORDER_PAGE_SIZE=2)
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.client.force_login(self.user)
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.coat = make_product('Trench Coat', price='25.50')
+        same_time = timezone.now()
+        self.orders = []
+        for index in range(5):
+            order = Order.objects.create(user=self.user, total_amount=Decimal('151.00'))
+            Order.objects.filter(pk=order.pk).update(date=same_time - timedelta(days=index // 2))  # Ties on date
+            OrderItem.objects.create(order=order, product=self.watch, product_name='Apple Watch',
+                                     unit_price=Decimal('100.00'), quantity=1)
+            OrderItem.objects.create(order=order, product=self.coat, product_name='Trench Coat',
+                                     unit_price=Decimal('25.50'), quantity=2)
+            self.orders.append(order)
+        Order.objects.create(user=User.objects.create_user('other'), total_amount=Decimal('1.00'))
+
+    def test_pages_walk_every_order_newest_first(self):
+        seen, cursor = [], ''
+        while True:
+            response = self.client.get(reverse('order_history'), {'cursor': cursor} if cursor else {})
+            seen += [(order.id, order.line_count, order.item_count) for order in response.context['orders']]
+            cursor = response.context['next_cursor']
+            if not cursor:
+                break
+        expected_ids = list(Order.objects.filter(user=self.user).order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, [(order_id, 2, 3) for order_id in expected_ids])
+        self.assertEqual(response.context['summary'], {'order_count': 5, 'total_spent': Decimal('755.00')})
+
+    def test_csv_export_streams_every_line(self):
+        response = self.client.get(reverse('order_history_export'))
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['order_id', 'date', 'order_total', 'product', 'quantity', 'unit_price', 'line_total'])
+        self.assertEqual(len(rows), 1 + 5 * 2)
+        self.assertEqual(rows[2][3:], ['Trench Coat', '2', '25.50', '51.00'])
+
+    def test_json_export(self):
+        response = self.client.get(reverse('order_history_export'), {'format': 'json'})
+        orders = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(orders), 5)
+        self.assertEqual(orders[0]['items'][0], {'product': 'Apple Watch', 'quantity': 1, 'unit_price': '100.00'})
+        self.assertEqual(self.client.get(reverse('order_history_export'), {'format': 'xml'}).status_code, 400)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        self.watch = make_product('Apple Watch', price='100.00')
+        self.strap = make_product('Watch Strap', price='20.00')
+        self.charger = make_product('Charger', price='15.00')
+        self.coat = make_product('Trench Coat', price='80.00', category='Clothing')
+
+    def place_order(self, *products):
+        order = Order.objects.create(user=self.user, total_amount=Decimal('1.00'))
+        Order.objects.filter(pk=order.pk).update(date=timezone.now() - timedelta(hours=1))
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=1) for product in products])
+        return order
+
+    def related(self, product):
+        return list(RelatedProduct.objects.filter(product=product).order_by('rank').values_list('related__name', 'orders'))
+
+    def test_counts_pairs_and_ranks_related_products(self):
+        self.place_order(self.watch, self.strap)
+        self.place_order(self.watch, self.strap, self.charger)
+        self.place_order(self.watch, self.charger, self.charger)  # Duplicate lines count once
+        self.place_order(self.coat)
+
+        run = build_recommendations(settle_seconds=0)
+        self.assertEqual((run.orders, run.last_order_id), (4, Order.objects.latest('id').id))
+        self.assertEqual(self.related(self.watch), [('Watch Strap', 2), ('Charger', 2)])
+        self.assertEqual(self.related(self.strap), [('Apple Watch', 2), ('Charger', 1)])
+        self.assertEqual(ProductPair.objects.get(product=self.watch, related=self.watch).orders, 3)
+        self.assertEqual(list(CategoryBestSeller.objects.filter(rank=1).order_by('-orders').values_list('product__name', flat=True)),
+                         ['Apple Watch', 'Trench Coat'])
+        # A second run with no new orders changes nothing
+        self.assertEqual(build_recommendations(settle_seconds=0).orders, 0)
+        self.assertEqual(self.related(self.watch), [('Watch Strap', 2), ('Charger', 2)])
+
+    def test_runs_are_incremental(self):
+        self.place_order(self.watch, self.strap)
+        build_recommendations(settle_seconds=0)
+        self.place_order(self.watch, self.strap)
+        self.place_order(self.coat, self.strap)
+        self.place_order(self.charger)
+        self.assertEqual(build_recommendations(settle_seconds=0, chunk_size=2).orders, 3)
+        self.assertEqual(self.related(self.strap), [('Apple Watch', 2), ('Trench Coat', 1)])
+        self.assertEqual(self.related(self.charger), [])
+
+        build_recommendations(full=True, settle_seconds=0)
+        self.assertEqual(self.related(self.strap), [('Apple Watch', 2), ('Trench Coat', 1)])
+        self.assertEqual(ProductPair.objects.get(product=self.strap, related=self.strap).orders, 3)
+
+    def test_full_rebuild_drops_products_without_orders(self):
+        order = self.place_order(self.coat, self.charger)
+        self.place_order(self.watch, self.strap)
+        build_recommendations(settle_seconds=0)
+        self.assertEqual(self.related(self.coat), [('Charger', 1)])
+
+        order.delete()
+        build_recommendations(full=True, settle_seconds=0)
+        self.assertEqual(self.related(self.coat), [])
+        self.assertEqual(self.related(self.charger), [])
+        self.assertEqual(self.related(self.watch), [('Watch Strap', 1)])
+
+    def test_recent_orders_wait_for_the_next_run(self):
+        order = self.place_order(self.watch, self.strap)
+        Order.objects.filter(pk=order.pk).update(date=timezone.now())
+        self.assertEqual(build_recommendations().orders, 0)
+        self.assertEqual(build_recommendations(settle_seconds=0).orders, 1)
+
+    def test_oversized_baskets_only_count_towards_best_sellers(self):
+        rows = [(1, product_id) for product_id in range(1, MAX_BASKET_SIZE + 2)] + [(2, 1), (2, 2)]
+        counts = count_pairs_python(rows)
+        self.assertEqual(counts[(1, 1)], 2)
+        self.assertEqual(counts[(1, 2)], 1)
+        self.assertEqual(counts[(2, 3)], 0)
+
+    @skipUnless(recommendations.np is not None, "NumPy is not installed")
+    def test_numpy_counts_match_python(self):
+        rows = sorted({(order_id, (order_id * product_id) % 17 + 1) for order_id in range(1, 300)
+                       for product_id in range(order_id % 7)})
+        rows += [(400, product_id) for product_id in range(1, MAX_BASKET_SIZE + 5)]
+        self.assertEqual(recommendations.count_pairs_numpy(rows), count_pairs_python(rows))
+
+    def test_cart_and_home_page_read_the_tables(self):
+        self.place_order(self.watch, self.strap)
+        self.place_order(self.watch, self.strap)
+        self.place_order(self.coat)
+        build_recommendations(settle_seconds=0)
+
+        self.client.force_login(self.user)
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=1)
+        response = self.client.get(reverse('view_cart'))
+        self.assertEqual([product.name for product in response.context['recommended_products']], ['Watch Strap'])
+        Product.objects.filter(pk=self.strap.pk).update(stock=0)
+        self.assertEqual(self.client.get(reverse('view_cart')).context['recommended_products'], [])
+
+        self.client.logout()
+        featured = self.client.get(reverse('home')).context['featured_products']
+        self.assertEqual([product.name for product in featured], ['Apple Watch', 'Trench Coat', 'Watch Strap'])
+
+
+class OutboundEmailTests(TestCase):
+    def test_batch_is_sent_over_one_connection(self):
+        for index in range(3):
+            enqueue_email(f'customer{index}@example.com', 'Subject', 'Body')
+        connection = get_connection()
+        with mock.patch.object(connection, 'open', wraps=connection.open) as opened:
+            self.assertEqual(deliver_batch(connection=connection), (3, 0))
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         [f'customer{index}@example.com' for index in range(3)])
+        self.assertFalse(OutboundEmail.objects.exclude(status=OutboundEmail.SENT).exists())
+        self.assertEqual(deliver_batch(), (0, 0))
+
+    def test_failures_back_off_then_give_up(self):
+        message = enqueue_email('customer@example.com', 'Subject', 'Body')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.assertEqual(deliver_batch(), (0, 1))
+            message.refresh_from_db()
+            self.assertEqual((message.status, message.attempts, message.last_error), (OutboundEmail.PENDING, 1, 'down'))
+            self.assertGreater(message.next_attempt_at, timezone.now())
+            self.assertEqual(deliver_batch(), (0, 0))  # Not due yet
+
+            for _ in range(MAX_ATTEMPTS - 1):
+                OutboundEmail.objects.update(next_attempt_at=timezone.now())
+                deliver_batch()
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (OutboundEmail.FAILED, MAX_ATTEMPTS))
+
+    def test_connection_failure_backs_off_the_batch(self):
+        message = enqueue_email('customer@example.com', 'Subject', 'Body')
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('refused')):
+            self.assertEqual(deliver_batch(), (0, 1))
+            output = StringIO()
+            with mock.patch('product.management.commands.send_queued_mail.time.sleep', side_effect=KeyboardInterrupt):
+                OutboundEmail.objects.update(next_attempt_at=timezone.now())
+                with self.assertRaises(KeyboardInterrupt):
+                    call_command('send_queued_mail', loop=True, stdout=output)
+        self.assertIn('Sent 0, failed 1', output.getvalue())  # Logged, then the worker polls on instead of dying
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.last_error), (OutboundEmail.PENDING, 2, 'refused'))
+        self.assertGreater(message.next_attempt_at, timezone.now())
+
+    def test_failing_batch_doesnt_stop_the_ones_behind_it(self):
+        poison = enqueue_email('broken@example.com', 'Subject', 'Body')
+        enqueue_email('customer@example.com', 'Subject', 'Body')
+        send = mail.backends.locmem.EmailBackend.send_messages
+
+        def send_messages(backend, messages):
+            if messages[0].to == ['broken@example.com']:
+                raise OSError('rejected')
+            return send(backend, messages)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', send_messages):
+            call_command('send_queued_mail', batch_size=1, stdout=StringIO())
+        self.assertEqual([message.to for message in mail.outbox], [['customer@example.com']])
+        poison.refresh_from_db()
+        self.assertEqual((poison.status, poison.attempts), (OutboundEmail.PENDING, 1))
+
+    def test_worker_command_drains_queue(self):
+        enqueue_email('customer@example.com', 'Subject', 'Body')
+        call_command('send_queued_mail', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class PaymentGatewayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', email='shopper@example.com', password='secret')
+        self.client.force_login(self.user)
+        self.watch = make_product('Apple Watch', price='100.00')
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=1)
+
+    def test_open_session_is_reused_until_cart_changes(self):
+        with mock.patch.object(FakeGateway, 'create_session', wraps=get_gateway().create_session) as create:
+            first = self.client.post(reverse('create_checkout_session'))
+            second = self.client.post(reverse('checkout'))
+            self.assertEqual(first['Location'], second['Location'])
+            self.assertEqual(create.call_count, 1)
+
+            CartItem.objects.filter(user=self.user).update(quantity=2)
+            third = self.client.post(reverse('create_checkout_session'))
+            self.assertNotEqual(first['Location'], third['Location'])
+            self.assertEqual(create.call_count, 2)
+
+    def test_finished_sessions_are_cached(self):
+        session = fake_session(self.user)
+        with mock.patch.object(FakeGateway, 'retrieve_session', wraps=get_gateway().retrieve_session) as retrieve:
+            for _ in range(3):
+                self.assertEqual(get_gateway().get_session(session.id).customer_email, 'shopper@example.com')
+        self.assertEqual(retrieve.call_count, 1)
+
+    def test_offline_checkout_flow(self):
+        response = self.client.post(reverse('create_checkout_session'))
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.context['order'].total_amount, Decimal('100.00'))
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+
+    def test_unknown_session(self):
+        response = self.client.get(reverse('payment_success'), {'session_id': 'cs_missing'})
+        self.assertEqual(response.context['message'], 'Invalid Stripe session')
+
+    def test_unpaid_or_foreign_session_creates_no_order(self):
+        other = User.objects.create_user('other')
+        session = fake_session(self.user)
+        for changes in ({'status': 'open', 'payment_status': 'unpaid'}, {'client_reference_id': str(other.pk)}):
+            cache.set(f'payments:fake:{session.id}', {**asdict(session), **changes})
+            cache.delete(f'payments:session:{session.id}')
+            response = self.client.get(reverse('payment_success'), {'session_id': session.id})
+            self.assertTemplateUsed(response, 'payment_pending.html')
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(CartItem.objects.filter(user=self.user).count(), 1)
+        self.assertFalse(OutboundEmail.objects.exists())
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.StripeGateway', STRIPE_SECRET_KEY='sk_test')
+class StripeGatewayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', email='shopper@example.com', password='secret')
+        CartItem.objects.create(user=self.user, product=make_product('Apple Watch', price='100.00'), quantity=2)
+
+    def start_checkout(self, expires_in):
+        def create(**params):
+            return {'id': 'cs_1', 'url': 'https://checkout.stripe.com/cs_1', 'expires_at': params['expires_at']}
+        with mock.patch('stripe.checkout.Session.create', side_effect=create) as stripe_create:
+            get_gateway().start_checkout(self.user, list(CartItem.objects.select_related('product')),
+                                         '/success/?session_id={CHECKOUT_SESSION_ID}', '/cancel/', expires_in)
+        cache.clear()  # Don't reuse the open session
+        return stripe_create.call_args.kwargs
+
+    def test_session_parameters(self):
+        params = self.start_checkout(reservation_ttl())
+        self.assertEqual(params['line_items'], [{'price_data': {
+            'currency': 'usd', 'product_data': {'name': 'Apple Watch'}, 'unit_amount': 10000,
+        }, 'quantity': 2}])
+        self.assertEqual((params['api_key'], params['mode'], params['client_reference_id'], params['customer_email']),
+                         ('sk_test', 'payment', str(self.user.pk), 'shopper@example.com'))
+        self.assertGreaterEqual(params['expires_at'] - time.time(), 30 * 60 + 59)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_both_gateways_verify_webhooks_alike(self):
+        payload = json.dumps({'id': 'evt_1', 'type': 'customer.created'}).encode()
+        for age, valid in ((0, True), (299, True), (301, False)):
+            signature = FakeGateway().sign_payload(payload, time.time() - age)
+            for gateway in (get_gateway(), FakeGateway()):
+                if valid:
+                    self.assertEqual(gateway.parse_event(payload, signature)['id'], 'evt_1')
+                else:
+                    with self.assertRaises(InvalidWebhook):
+                        gateway.parse_event(payload, signature)
+
+    def test_expiry_is_never_below_stripes_minimum(self):
+        for expires_in in (60, 30 * 60):
+            self.assertGreaterEqual(self.start_checkout(expires_in)['expires_at'] - time.time(), 30 * 60 + 59)
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway', STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='secret')
+        CartItem.objects.create(user=self.user, product=make_product('Apple Watch', price='100.00'), quantity=2)
+
+    def send(self, event, signature=None):
+        payload = json.dumps(event).encode()
+        signature = signature or get_gateway().sign_payload(payload)
+        return self.client.post(reverse('stripe_webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature)
+
+    def completed_event(self, event_id='evt_1', session_id='cs_1', payment_status='paid'):
+        return {'id': event_id, 'type': 'checkout.session.completed', 'data': {'object': {
+            'id': session_id, 'payment_status': payment_status, 'client_reference_id': str(self.user.pk),
+            'customer_details': {'email': 'shopper@example.com', 'name': 'Shopper'},
+        }}}
+
+    def test_bad_signature_is_rejected(self):
+        for signature in ('t=1,v1=bad', 't=abc,v1=bad', 'v1=bad', 't=,v1=bad'):
+            self.assertEqual(self.send(self.completed_event(), signature=signature).status_code, 400)
+        payload = json.dumps(self.completed_event()).encode()
+        replayed = get_gateway().sign_payload(payload, time.time() - 301)  # Validly signed, but too old
+        self.assertEqual(self.send(self.completed_event(), signature=replayed).status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_redelivered_event_is_recorded_once(self):
+        for _ in range(2):
+            self.assertEqual(self.send(self.completed_event()).status_code, 200)
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PENDING)
+        self.assertFalse(Order.objects.exists())  # Nothing happens on the request path
+
+    def test_worker_fulfils_and_success_page_reads_order(self):
+        self.send(self.completed_event())
+        self.send({'id': 'evt_2', 'type': 'customer.created', 'data': {'object': {}}})
+        call_command('process_stripe_events', stdout=StringIO())
+
+        order = Order.objects.get(stripe_session_id='cs_1')
+        self.assertEqual((order.user, order.email, order.total_amount), (self.user, 'shopper@example.com', Decimal('200.00')))
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+        self.assertEqual(dict(StripeEvent.objects.values_list('event_id', 'status')),
+                         {'evt_1': StripeEvent.PROCESSED, 'evt_2': StripeEvent.IGNORED})
+
+        self.client.force_login(self.user)
+        with mock.patch.object(FakeGateway, 'retrieve_session') as retrieve:
+            response = self.client.get(reverse('payment_success'), {'session_id': 'cs_1'})
+        self.assertEqual(response.context['order'], order)
+        retrieve.assert_not_called()
+
+    def test_order_matches_what_the_session_charged(self):
+        watch = Product.objects.get()
+        reserve_stock(self.user, list(CartItem.objects.select_related('product')), 'cs_1', timezone.now())
+        self.send(self.completed_event())
+        # The cart and price change after paying, before the worker runs
+        CartItem.objects.update(quantity=5)
+        CartItem.objects.create(user=self.user, product=make_product('Trench Coat'), quantity=1)
+        Product.objects.filter(pk=watch.pk).update(price='150.00')
+        process_pending_events()
+
+        order = Order.objects.get()
+        self.assertEqual(order.total_amount, Decimal('200.00'))
+        self.assertEqual(list(order.items.values_list('product_id', 'unit_price', 'quantity')),
+                         [(watch.pk, Decimal('100.00'), 2)])
+        self.assertEqual(list(CartItem.objects.values_list('product__name', flat=True)), ['Trench Coat'])
+
+    def test_released_reservation_is_not_an_order_line(self):
+        watch = Product.objects.get()
+        reserve_stock(self.user, list(CartItem.objects.select_related('product')), 'cs_1', timezone.now())
+        release_expired_reservations(now=timezone.now() + timedelta(hours=1))
+        self.assertEqual(Product.objects.get().stock, 10)
+        CartItem.objects.update(quantity=1)
+        self.send(self.completed_event())
+        process_pending_events()
+
+        order = Order.objects.get()
+        self.assertEqual(list(order.items.values_list('product_id', 'quantity')), [(watch.pk, 1)])
+        self.assertEqual(Product.objects.get().stock, 9)  # Taken again for the cart line, not the released hold
+
+    def test_unpaid_session_waits_for_async_payment(self):
+        self.send(self.completed_event(payment_status='unpaid'))
+        process_pending_events()
+        self.assertFalse(Order.objects.exists())
+
+    def test_failures_are_retried(self):
+        event = self.completed_event()
+        event['data']['object']['client_reference_id'] = 'nobody'
+        self.send(event)
+        self.assertEqual(process_pending_events(), (0, 1))
+        stored = StripeEvent.objects.get()
+        self.assertEqual((stored.status, stored.attempts), (StripeEvent.PENDING, 1))
+        self.assertIn('client_reference_id', stored.last_error)
+
+
+class ImageRenditionTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        os.makedirs(os.path.join(self.media.name, 'products'))
+
+    def save_image(self, name, size=(800, 400), color='red'):
+        Image.new('RGB', size, color).save(os.path.join(self.media.name, name))
+
+    def test_renditions_are_resized_and_content_hashed(self):
+        self.save_image('products/shoe.jpg')
+        renditions = render_renditions(self.media.name, 'products/shoe.jpg', (320, 640, 1200), ['webp', 'jpeg'])
+        # Never upscaled past the 800px original
+        self.assertEqual([width for width, _ in renditions['formats']['jpeg']], [320, 640, 800])
+        for width, name in renditions['formats']['webp']:
+            with Image.open(os.path.join(self.media.name, name)) as image:
+                self.assertEqual((image.format, image.width), ('WEBP', width))
+
+        self.save_image('products/shoe.jpg', color='blue')
+        changed = render_renditions(self.media.name, 'products/shoe.jpg', (320,), ['jpeg'])
+        self.assertNotEqual(changed['formats']['jpeg'][0][1], renditions['formats']['jpeg'][0][1])
+
+    def test_upload_builds_renditions_and_template_uses_them(self):
+        self.save_image('products/shoe.jpg')
+        with self.captureOnCommitCallbacks(execute=True):
+            product = make_product('Shoe')
+            product.image = 'products/shoe.jpg'
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.renditions['source'], 'products/shoe.jpg')
+
+        html = Template('{% load responsive_images %}{% product_picture product class="card-img-top" %}').render(
+            Context({'product': product}))
+        self.assertIn('<picture>', html)
+        self.assertIn(' 320w', html)
+        self.assertIn('class="card-img-top"', html)
+
+    def test_missing_renditions_fall_back_to_plain_img(self):
+        html = Template("{% load responsive_images %}{% media_picture 'carousel/none.jpg' alt='Banner' %}").render(Context())
+        self.assertTrue(html.startswith('<img src="/media/carousel/none.jpg"'))
+
+    def test_command_builds_media_manifest(self):
+        os.makedirs(os.path.join(self.media.name, 'carousel'))
+        self.save_image('carousel/banner.jpg', size=(2000, 600))
+        call_command('build_renditions', workers=1, stdout=StringIO())
+        self.assertEqual(get_manifest()['carousel/banner.jpg']['width'], 2000)
+
+
+class AssetServingTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        static_root, media_root = os.path.join(self.root.name, 'static'), os.path.join(self.root.name, 'media')
+        os.makedirs(os.path.join(media_root, 'renditions'))
+        os.makedirs(os.path.join(media_root, 'products'))
+        serving = override_settings(SERVE_ASSETS=True, STATIC_ROOT=static_root, MEDIA_ROOT=media_root)
+        serving.enable()
+        self.addCleanup(serving.disable)
+        self.media = media_root
+        Image.new('RGB', (10, 10), 'red').save(os.path.join(media_root, 'products', 'shoe.jpg'))
+        Image.new('RGB', (10, 10), 'red').save(os.path.join(media_root, 'renditions', 'shoe.0123456789ab.320w.jpg'))
+
+    def test_conditional_get_returns_304(self):
+        response = self.client.get('/media/products/shoe.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertFalse(response.cookies)
+
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get('/media/products/shoe.jpg', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        not_modified = self.client.get('/media/products/shoe.jpg', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], etag)
+
+    def test_renditions_are_immutable(self):
+        response = self.client.get('/media/renditions/shoe.0123456789ab.320w.jpg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        with open(os.path.join(self.media, 'renditions', 'manifest.json'), 'w') as f:
+            f.write('{}')
+        response = self.client.get('/media/renditions/manifest.json')  # Rewritten by every build
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+    def test_accept_encoding_q_values(self):
+        factory = RequestFactory()
+        for header, expected in [
+            ('br;q=0, gzip', {'gzip', 'identity'}),
+            ('gzip;q=0.5, br;q=1.0', {'gzip', 'br', 'identity'}),
+            ('*', {'gzip', 'br', 'identity'}),
+            ('gzip;q=0, *', {'br', 'identity'}),
+            ('br, identity;q=0', {'br'}),
+            ('*;q=0', set()),
+            ('gzip;q=abc', {'identity'}),
+            ('', {'identity'}),
+        ]:
+            self.assertEqual(accepted_encodings(factory.get('/', HTTP_ACCEPT_ENCODING=header)), expected, header)
+
+    def test_missing_and_traversal_paths_are_404(self):
+        self.assertEqual(self.client.get('/media/products/none.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/media/../static/x.css').status_code, 404)
+        self.assertEqual(self.client.get('/media/%2e%2e/%2e%2e/manage.py').status_code, 404)
+        self.assertEqual(self.client.post('/media/products/shoe.jpg').status_code, 405)
+
+    def test_collectstatic_writes_hashed_and_compressed_files(self):
+        source = os.path.join(self.root.name, 'assets')
+        os.makedirs(source)
+        with open(os.path.join(source, 'site.css'), 'w') as f:
+            f.write('body { margin: 0; }\n' * 100)
+        storages = {**settings.STORAGES, 'staticfiles': {'BACKEND': 'product.assets.CompressedManifestStaticFilesStorage'}}
+        with override_settings(STATICFILES_DIRS=[source], STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            hashed = staticfiles_storage.stored_name('site.css')
+        self.assertRegex(hashed, r'^site\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(settings.STATIC_ROOT, hashed + '.gz')))
+
+        response = self.client.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b'body { margin: 0; }\n' * 100)
+        self.assertNotIn('Content-Encoding', self.client.get(f'/static/{hashed}'))
+        self.assertNotIn('Content-Encoding', self.client.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip;q=0'))
+        self.assertEqual(self.client.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='br, identity;q=0').status_code, 406)
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.watch = make_product('Apple Watch', price='100.00')
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        first = self.client.get(reverse('product_list'), {'sort': 'price'})
+        self.assertEqual(first['X-Page-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('product_list'), {'sort': 'price'})
+        self.assertEqual(second['X-Page-Cache'], 'HIT')
+        self.assertEqual(first.content, second.content)
+        self.assertIn('csrftoken', second.cookies)
+
+        # A different filter is a different page
+        self.assertEqual(self.client.get(reverse('product_list'), {'sort': '-price'})['X-Page-Cache'], 'MISS')
+
+    def test_product_changes_invalidate_pages(self):
+        self.client.get(reverse('home'))
+        self.watch.name = 'Pocket Watch'
+        self.watch.save()
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        self.assertContains(response, 'Pocket Watch')
+
+        self.watch.delete()
+        self.assertNotContains(self.client.get(reverse('home')), 'Pocket Watch')
+
+    def test_logged_in_pages_are_never_shared(self):
+        user = User.objects.create_user('shopper', password='secret')
+        CartItem.objects.create(user=user, product=self.watch, quantity=7)
+        self.client.get(reverse('product_list'))
+        self.client.force_login(user)
+        response = self.client.get(reverse('product_list'))
+        self.assertFalse(response.has_header('X-Page-Cache'))
+        self.assertEqual(response.context['total_cart_quantity'], 7)
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class StockReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', email='shopper@example.com', password='secret')
+        self.client.force_login(self.user)
+        self.watch = make_product('Apple Watch', price='100.00', stock=3)
+        CartItem.objects.create(user=self.user, product=self.watch, quantity=2)
+
+    def stock(self):
+        return Product.objects.get(pk=self.watch.pk).stock
+
+    def test_checkout_reserves_and_payment_commits(self):
+        response = self.client.post(reverse('checkout'))
+        self.assertEqual(self.stock(), 1)
+        self.client.post(reverse('checkout'))  # Reused session: nothing reserved twice
+        self.assertEqual(self.stock(), 1)
+
+        self.client.get(response['Location'])
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(StockReservation.objects.get().status, StockReservation.COMMITTED)
+
+    def test_out_of_stock(self):
+        Product.objects.filter(pk=self.watch.pk).update(stock=1)
+        response = self.client.post(reverse('checkout'))
+        self.assertEqual(response.status_code, 409)
+        self.assertContains(response, 'Not enough stock for Apple Watch', status_code=409)
+        self.assertEqual(self.stock(), 1)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_changed_cart_releases_previous_session(self):
+        self.client.post(reverse('checkout'))
+        CartItem.objects.filter(user=self.user).update(quantity=1)
+        self.client.post(reverse('checkout'))
+        self.assertEqual(self.stock(), 2)
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.ACTIVE).count(), 1)
+
+    def test_expired_reservations_are_released(self):
+        lines = list(CartItem.objects.select_related('product').filter(user=self.user))
+        reserve_stock(self.user, lines, 'cs_abandoned', timezone.now())
+        self.assertEqual(self.stock(), 1)
+        self.assertEqual(release_expired_reservations(), 0)  # Still inside the grace period
+
+        self.assertEqual(release_expired_reservations(now=timezone.now() + timedelta(minutes=10)), 1)
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(release_expired_reservations(now=timezone.now() + timedelta(minutes=10)), 0)
+
+    def test_reservation_is_all_or_nothing(self):
+        phone = make_product('iPhone', stock=0)
+        CartItem.objects.create(user=self.user, product=phone, quantity=1)
+        lines = list(CartItem.objects.select_related('product').filter(user=self.user))
+        with self.assertRaises(OutOfStock):
+            reserve_stock(self.user, lines, 'cs_test', timezone.now())
+        self.assertEqual(self.stock(), 3)
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class ConcurrencyTests(TransactionTestCase):
+    """ Hammer the cart and stock from several threads (each thread gets its own DB connection) """
+
+    THREADS = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("threads can't share an in-memory SQLite database")
+        cache.clear()
+        self.watch = make_product('Apple Watch', stock=5)
+
+    def run_threads(self, target):
+        errors = []
+        barrier = threading.Barrier(self.THREADS)
+
+        def worker(index):
+            try:
+                barrier.wait()
+                target(index)
+            except Exception as e:  # Surface failures in the main thread
+                errors.append(e)
+            finally:
+                close_old_connections()
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_no_lost_cart_increments(self):
+        user = User.objects.create_user('shopper', password='secret')
+        errors = self.run_threads(lambda index: [add_to_cart(user, self.watch) for _ in range(5)])
+        self.assertEqual(errors, [])
+        self.assertEqual(CartItem.objects.get(user=user).quantity, self.THREADS * 5)
+        self.assertEqual(CartSummary.objects.get(user=user).item_count, self.THREADS * 5)
+
+    def test_no_oversell(self):
+        users = [User.objects.create_user(f'shopper{index}', password='secret') for index in range(self.THREADS)]
+        for user in users:
+            CartItem.objects.create(user=user, product=self.watch, quantity=1)
+
+        def checkout(index):
+            lines = list(CartItem.objects.select_related('product').filter(user=users[index]))
+            try:
+                reserve_stock(users[index], lines, f'cs_{index}', timezone.now())
+            except OutOfStock:
+                pass
+
+        self.assertEqual(self.run_threads(checkout), [])
+        self.assertEqual(Product.objects.get(pk=self.watch.pk).stock, 0)
+        self.assertEqual(StockReservation.objects.count(), 5)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_pragmas(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def test_stock_cannot_go_negative(self):
+        watch = make_product('Apple Watch', stock=1)
+        with self.assertRaises(IntegrityError):
+            Product.objects.filter(pk=watch.pk).update(stock=-1)
+
+    def test_cart_quantity_must_be_positive(self):
+        user = User.objects.create_user('shopper', password='secret')
+        with self.assertRaises(IntegrityError):
+            CartItem.objects.create(user=user, product=make_product('Apple Watch'), quantity=0)
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        call_command('seed_catalog', products=40, users=2, cart_lines=2, orders=2, stdout=StringIO())
+
+    def test_seeded_data(self):
+        self.assertEqual(Product.objects.count(), 40)
+        self.assertEqual(Order.objects.count(), 4)
+        self.assertEqual(CartSummary.objects.count(), 2)
+        self.assertEqual(get_search_backend().search(Product.objects.all(), 'watch').exists(),
+                         Product.objects.filter(name__icontains='watch').exists())
+
+    def test_every_scenario_runs_and_writes_results(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command('run_benchmarks', requests=3, warmup=1, users=2, output=output, stdout=StringIO())
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(set(results['scenarios']), set(SCENARIOS))
+        for name, result in results['scenarios'].items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertIsNotNone(result['queries_max'])
+
+    def test_regressions_fail_the_comparison(self):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            with open(baseline, 'w') as f:
+                json.dump({'scenarios': {'view_cart': {'p95_ms': 0.0001}}}, f)
+            with self.assertRaises(CommandError):
+                call_command('run_benchmarks', scenario=['view_cart'], requests=3, warmup=0, compare=baseline,
+                             max_regression=50, stdout=StringIO())
+
+
+class StartupTests(TestCase):
+    def test_app_loads_without_stripe_or_pillow(self):
+        result = profile_startup('ready', repeat=1)
+        self.assertNotIn('stripe', result['packages_ms'])
+        self.assertNotIn('requests', result['packages_ms'])
+        self.assertNotIn('PIL', result['packages_ms'])
+        self.assertIn('product', result['packages_ms'])
+        self.assertGreater(result['rss_kb'], 0)
+
+    def test_parse_importtime(self):
+        modules = parse_importtime(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |     stripe._api\n"
+            "import time:       300 |        420 |   stripe\n"
+            "import time:        50 |        470 | product.payments\n"
+        )
+        self.assertEqual(modules[1], ('stripe', 300, 420, 1))
+        self.assertEqual(import_costs(modules), {'stripe': 420, 'product': 50})
+
+    @override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+    def test_preload_freezes_the_warmed_heap(self):
+        with mock.patch('product.startup.gc.freeze') as freeze, \
+                mock.patch('product.startup.connections.close_all') as close_all:  # Keep the test transaction
+            preload()
+        freeze.assert_called_once()
+        close_all.assert_called_once()
+
+
+class CatalogImportTests(TestCase):
+    HEADER = 'sku,name,description,price,stock,category,image\n'
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def write(self, name, content):
+        path = os.path.join(self.media.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def import_csv(self, rows, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_products', self.write('catalog.csv', self.HEADER + rows), *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_create_then_update_by_sku(self):
+        out, _ = self.import_csv('W1,Apple Watch,Smart watch,100.00,5,Electronics,\nC1,Trench Coat,Beige,25.50,2,Clothing,\n')
+        self.assertIn('2 created', out)
+        self.assertEqual(Product.objects.get(sku='W1').category.name, 'Electronics')
+        self.assertEqual(list(search_products(Product.objects.all(), 'trench')), [Product.objects.get(sku='C1')])
+
+        watch_id = Product.objects.get(sku='W1').id
+        out, _ = self.import_csv('W1,Apple Watch,Smart watch,90.00,5,Electronics,\nC1,Trench Coat,Beige,25.50,2,Clothing,\n')
+        self.assertIn('0 created, 1 updated, 1 unchanged', out)
+        self.assertEqual(Product.objects.values_list('id', 'price').get(sku='W1'), (watch_id, Decimal('90.00')))
+
+    def test_only_written_products_are_reindexed(self):
+        self.import_csv('W1,Apple Watch,Smart watch,100.00,5,Electronics,\nC1,Trench Coat,Beige,25.50,2,Clothing,\n')
+        with mock.patch('product.search.FTS5SearchBackend.rebuild') as rebuild, \
+                mock.patch('product.search.FTS5SearchBackend.index_products',
+                           wraps=get_search_backend().index_products) as index_products:
+            self.import_csv('W1,Pocket Watch,Smart watch,100.00,5,Electronics,\nC1,Trench Coat,Beige,25.50,2,Clothing,\n')
+        rebuild.assert_not_called()
+        self.assertEqual(list(index_products.call_args.args[0]), [Product.objects.get(sku='W1').id])
+        self.assertEqual(list(search_products(Product.objects.all(), 'pocket')), [Product.objects.get(sku='W1')])
+        self.assertEqual(list(search_products(Product.objects.all(), 'apple')), [])
+
+    def test_stock_is_on_hand_less_active_reservations(self):
+        self.import_csv('W1,Apple Watch,,100.00,5,Electronics,\n')
+        watch = Product.objects.get(sku='W1')
+        user = User.objects.create_user('shopper')
+        reserve_stock(user, [CartItem(product=watch, quantity=2)], 'cs_1', timezone.now() + timedelta(hours=1))
+        self.assertEqual(Product.objects.get(sku='W1').stock, 3)
+
+        self.import_csv('W1,Apple Watch,,100.00,10,Electronics,\n')  # A recount: 10 on the shelf
+        self.assertEqual(Product.objects.get(sku='W1').stock, 8)
+        out = StringIO()
+        call_command('export_products', format='jsonl', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['stock'], 10)
+
+        self.import_csv('W1,Apple Watch,,100.00,1,Electronics,\n')  # Fewer than are held
+        self.assertEqual(Product.objects.get(sku='W1').stock, 0)
+
+    def test_dry_run_prints_diff_and_writes_nothing(self):
+        make_product('Apple Watch', price='100.00')
+        Product.objects.update(sku='W1')
+        out, err = self.import_csv('W1,Apple Watch,,80.00,10,Electronics,\nN1,New Thing,,5.00,1,Gadgets,\n'
+                                   'bad,No Price,,abc,1,Gadgets,\n', '--dry-run')
+        self.assertIn('~ W1 price: 100.00 -> 80.00', out)
+        self.assertIn('+ N1 New Thing', out)
+        self.assertIn('line 4: price must be a decimal', err)
+        self.assertEqual(Product.objects.get(sku='W1').price, Decimal('100.00'))
+        self.assertFalse(Product.objects.filter(sku='N1').exists())
+        self.assertFalse(Category.objects.filter(name='Gadgets').exists())
+
+    def test_queries_per_chunk_are_flat(self):
+        counts = []
+        for size in (3, 30):
+            rows = ''.join(f'S{size}-{index},Thing {index},,1.00,1,Things {size},\n' for index in range(size))
+            with CaptureQueriesContext(connection) as context:
+                self.import_csv(rows)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_images_are_downloaded_once(self):
+        png = BytesIO()
+        Image.new('RGB', (10, 10)).save(png, 'PNG')
+        with mock.patch('product.catalog.urllib.request.urlopen', return_value=BytesIO(png.getvalue())) as urlopen:
+            out, _ = self.import_csv('W1,Watch,,1.00,1,Watches,https://cdn.example.com/img/watch.png\n')
+            self.assertEqual(Product.objects.get(sku='W1').image.name, 'products/w1-watch.png')
+            self.assertIn('1 images attached', out)
+            out, _ = self.import_csv('W1,Watch,,1.00,1,Watches,https://cdn.example.com/img/watch.png\n')
+            self.assertIn('1 unchanged', out)
+        self.assertEqual(urlopen.call_count, 1)
+
+    def test_changing_the_image_drops_its_renditions(self):
+        self.import_csv('W1,Watch,,1.00,1,Watches,products/old.jpg\nC1,Coat,,1.00,1,Coats,products/coat.jpg\n')
+        for sku, name in (('W1', 'products/old.jpg'), ('C1', 'products/coat.jpg')):
+            Product.objects.filter(sku=sku).update(renditions={'source': name, 'width': 10, 'height': 10,
+                                                               'formats': {'jpeg': [[10, f'renditions/{sku}.jpg']]}})
+        self.import_csv('W1,Watch,,1.00,1,Watches,products/new.jpg\nC1,Coat,,2.00,1,Coats,products/coat.jpg\n')
+        self.assertEqual(Product.objects.get(sku='W1').renditions, {})
+        self.assertEqual(Product.objects.get(sku='C1').renditions['source'], 'products/coat.jpg')  # Only repriced
+
+        # Renditions left over from another image are never served
+        Product.objects.filter(sku='W1').update(renditions=Product.objects.get(sku='C1').renditions)
+        html = Template('{% load responsive_images %}{% product_picture product %}').render(
+            Context({'product': Product.objects.get(sku='W1')}))
+        self.assertNotIn('renditions/', html)
+        self.assertIn('products/new.jpg', html)
+
+    def test_export_round_trips(self):
+        self.import_csv('W1,Apple Watch,"Smart, ""new""",100.00,5,Electronics,products/w.jpg\n')
+        out = StringIO()
+        call_command('export_products', format='jsonl', stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {
+            'sku': 'W1', 'name': 'Apple Watch', 'description': 'Smart, "new"', 'price': '100.00', 'stock': 5,
+            'category': 'Electronics', 'image': 'products/w.jpg',
+        })
+        path = self.write('export.jsonl', out.getvalue())
+        result = StringIO()
+        call_command('import_products', path, stdout=result)
+        self.assertIn('1 unchanged', result.getvalue())
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        REGISTRY.clear()
+        make_product('Apple Watch', price='100.00')
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('product_list'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        self.assertIn('cache;desc=', timing)
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+    @override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+    def test_external_calls_are_timed(self):
+        user = User.objects.create_user('shopper', password='secret')
+        CartItem.objects.create(user=user, product=Product.objects.get(), quantity=1)
+        self.client.force_login(user)
+        self.assertIn('stripe;dur=', self.client.post(reverse('checkout'))['Server-Timing'])
+
+    def test_prometheus_endpoint(self):
+        self.client.get(reverse('product_list'))
+        self.client.get(reverse('product_list'))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{view="product_list",method="GET",status="2xx"} 2', body)
+        self.assertIn('http_request_duration_seconds_bucket{view="product_list",method="GET",status="2xx",le="+Inf"} 2',
+                      body)
+        self.assertIn('cache_requests_total{view="product_list",result="hit"}', body)
+        self.assertIn('db_queries_per_request_bucket{view="product_list"', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_are_logged(self):
+        with self.assertLogs('product.requests', 'WARNING') as logs:
+            self.client.get(reverse('product_list'))
+        self.assertIn('view=product_list', logs.output[0])
+
+
+@override_settings(PAYMENT_GATEWAY='product.payments.FakeGateway')
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('shopper', email='shopper@example.com', password='secret')
+        self.watch = make_product('Apple Watch', price='100.00', stock=5)
+        self.factory = AsyncRequestFactory()
+
+    def request(self, method, path, data=None):
+        request = getattr(self.factory, method)(path, data or {})
+        user = self.user
+
+        async def auser():
+            return user
+        request.user, request.auser = user, auser
+        return request
+
+    async def test_add_to_cart_and_update(self):
+        response = await async_views.add_to_cart(self.request('post', '/'), self.watch.id)
+        response = await async_views.add_to_cart(self.request('post', '/'), self.watch.id)
+        self.assertEqual(json.loads(response.content)['cart_count'], 2)
+
+        item = await CartItem.objects.aget(user=self.user)
+        response = await async_views.update_cart(self.request('post', '/', {'cart_item_id': item.id, 'quantity': 4}))
+        self.assertEqual(json.loads(response.content)['total_amount'], 400.0)
+        self.assertEqual((await CartSummary.objects.aget(pk=self.user.pk)).item_count, 4)
+
+    async def test_checkout_and_payment_success(self):
+        await CartItem.objects.acreate(user=self.user, product=self.watch, quantity=2)
+        response = await async_views.create_checkout_session(self.request('post', '/'))
+        self.assertEqual(response.status_code, 303)
+        self.assertEqual((await Product.objects.aget(pk=self.watch.pk)).stock, 3)
+
+        session_id = response['Location'].split('session_id=')[1]
+        response = await async_views.payment_success(self.request('get', '/', {'session_id': session_id}))
+        self.assertContains(response, 'Thank You for Your Purchase')
+        order = await Order.objects.aget(stripe_session_id=session_id)
+        self.assertEqual(order.total_amount, Decimal('200.00'))
+
+    async def test_unknown_session(self):
+        response = await async_views.payment_success(self.request('get', '/', {'session_id': 'cs_missing'}))
+        self.assertContains(response, 'Invalid Stripe session')
+
+    def test_benchmark_through_the_asgi_handler(self):
+        call_command('seed_catalog', products=10, users=2, cart_lines=1, orders=1, stdout=StringIO())
+        output = StringIO()
+        call_command('run_benchmarks', server='asgi', concurrency=4, requests=8, warmup=1, users=2,
+                     scenario=['product_list', 'add_to_cart', 'checkout_new_session'], stdout=output, stderr=StringIO())
+        self.assertRegex(output.getvalue(), r'checkout_new_session\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+[\d.]+\s+-\s+0')
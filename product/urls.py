@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.urls import path
-from .views import product_list, view_cart, add_to_cart, remove_from_cart, checkout, payment_success, payment_cancel, order_history, register, update_cart, create_checkout_session
+from .views import product_list, view_cart, add_to_cart, remove_from_cart, checkout, payment_success, payment_cancel, order_history, register, update_cart, create_checkout_session, product_list_json, stripe_webhook, cart_batch, order_history_export
+
+if settings.ASYNC_VIEWS:  # ASGI deployments: the cart API and Stripe-bound views run on the event loop
+    from .async_views import add_to_cart, update_cart, payment_success, create_checkout_session
 
 urlpatterns = [
     path('', product_list, name='product_list'),
+    path('api/products/', product_list_json, name='product_list_json'),  # Cursor-paginated JSON for infinite scroll
     path('cart/', view_cart, name='view_cart'),
     path('cart/add/<int:product_id>/', add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:cart_item_id>/', remove_from_cart, name='remove_from_cart'),
@@ -10,8 +15,11 @@ urlpatterns = [
     path('success/', payment_success, name='payment_success'),  # Add success URL
     path('cancel/', payment_cancel, name='payment_cancel'),  # Add cancel URL
     path('orders/', order_history, name='order_history'),
+    path('orders/export/', order_history_export, name='order_history_export'),  # ?format=csv|json, streamed
     path('register/', register, name='register'),
     path('create-checkout-session/', create_checkout_session, name='create_checkout_session'),
     path('cart/', view_cart, name='view_cart'),
     path('cart/update/', update_cart, name='update_cart'),  # AJAX update route
+    path('cart/batch/', cart_batch, name='cart_batch'),  # Several quantity changes in one JSON request
+    path('webhooks/stripe/', stripe_webhook, name='stripe_webhook'),  # Stripe checkout.session.* events
 ]
\ No newline at end of file
@@ -1,41 +1,114 @@
-import stripe
+import json
+import logging
+
 from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
+from .anonymous_cart import get_anonymous_cart
+from .caching import cache_anonymous_page
+from .facets import get_facets, price_range
+from .cart import CartOperationError, apply_cart_operations, cart_lines, get_cart_summary
 from .models import Product, CartItem
+from .orders import create_order_from_cart
+from .order_history import export_orders, order_history_page, order_summary, stream_csv, stream_json
+from .fulfilment import record_event
+from .images import build_srcset
+from .metrics import REGISTRY
+from .inventory import OutOfStock, add_to_cart as add_product_to_cart, hold_stock_for_session, reservation_ttl
+from .payments import InvalidWebhook, SessionNotFound, get_gateway
+from .pagination import paginate, resolve_sort
+from .recommendations import best_sellers, frequently_bought_with
+from .search import search_products
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
-from django.core.mail import send_mail
+from django.utils.text import slugify
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-# Set Stripe's secret key
-stripe.api_key = settings.STRIPE_SECRET_KEY
+logger = logging.getLogger(__name__)
 
+@cache_anonymous_page('home')
 def home(request):
-    featured_products = Product.objects.all()[:3]  # Get the first 3 products as featured
+    featured_products = best_sellers(3)  # Each category's top seller (see `manage.py build_recommendations`)
     return render(request, 'home.html', {'featured_products': featured_products})
 
-def product_list(request):
+def filter_products(request):
+    """ Apply the catalog's search/category/price filters from the query string; also returns the unfiltered search """
     query = request.GET.get('search', '')
     category = request.GET.get('category', '')
     min_price = request.GET.get('min_price', '')
     max_price = request.GET.get('max_price', '')
 
-    products = Product.objects.all()
+    matches = Product.objects.all()
 
     if query:
-        products = products.filter(name__icontains=query) | products.filter(description__icontains=query)
+        matches = search_products(matches, query)  # Ranked full-text search (see product/search.py)
+    products = matches
     if category:
-        products = products.filter(category__iexact=category)  # Exact match for category
-    if min_price:
-        products = products.filter(price__gte=min_price)  # Minimum price
-    if max_price:
-        products = products.filter(price__lte=max_price)  # Maximum price
+        # Slugs, so older ?category=Electronics links keep working
+        products = products.filter(category__slug=slugify(category))
+    products = products.filter(price_range(min_price, max_price))
+
+    filters = {'query': query, 'category': category, 'min_price': min_price, 'max_price': max_price}
+    return products, filters, matches
+
+
+def paginate_products(request, products):
+    # Relevance ordering is only possible when the search backend ranked the results
+    searching = 'search_rank' in products.query.annotations
+    sort = resolve_sort(request.GET.get('sort', ''), searching=searching)
+    page = paginate(products, sort, request.GET.get('cursor'), settings.PRODUCT_PAGE_SIZE)
+    return page, sort
+
+
+@cache_anonymous_page('product_list')
+def product_list(request):
+    products, filters, matches = filter_products(request)
+    page, sort = paginate_products(request, products)
+
+    next_query = ''
+    if page.has_next:
+        params = request.GET.copy()
+        params['cursor'] = page.next_cursor
+        next_query = params.urlencode()
+
+    return render(request, 'product_list.html', {
+        'products': page, 'sort': sort, 'next_cursor': page.next_cursor, 'next_query': next_query,
+        'facets': get_facets(matches, filters, request.GET), **filters,
+    })
+
+
+# JSON variant of product_list for infinite scroll
+@cache_anonymous_page('product_list_json')
+def product_list_json(request):
+    products, filters, matches = filter_products(request)
+    page, sort = paginate_products(request, products.select_related('category'))
+
+    results = [{
+        'id': product.id,
+        'name': product.name,
+        'description': product.description,
+        'price': str(product.price),
+        'category': product.category.name,
+        'image': product.image.url if product.image else None,
+        'image_srcset': build_srcset(product.renditions, 'jpeg') if product.renditions else '',
+    } for product in page]
 
-    return render(request, 'product_list.html', {'products': products, 'query': query, 'category': category, 'min_price': min_price, 'max_price': max_price})
+    facets = get_facets(matches, filters, request.GET)
+    return JsonResponse({
+        'results': results, 'sort': sort, 'next_cursor': page.next_cursor,
+        'facets': {
+            'categories': [facet._asdict() for facet in facets['categories']],
+            'price': [facet._asdict() for facet in facets['price']],
+        },
+    })
 
 # View the shopping cart
-@login_required
 def view_cart(request):
-    cart_items = CartItem.objects.filter(user=request.user)
+    if request.user.is_authenticated:
+        cart_items = cart_lines(request.user)  # Products are joined in, so no query per line
+    else:
+        cart_items = get_anonymous_cart(request).lines()  # Visitors' carts live in a cookie until they log in
 
     # Calculate total price for each item and store it in a list of dictionaries
     cart_data = []
@@ -51,7 +124,9 @@ def view_cart(request):
             "item_total": item_total  # This stores the total price per item
         })
 
-    return render(request, "cart.html", {"cart_items": cart_data, "total_amount": total_amount})
+    recommended = frequently_bought_with([item["product"].id for item in cart_data])
+    return render(request, "cart.html", {"cart_items": cart_data, "total_amount": total_amount,
+                                         "recommended_products": recommended})
 
 
 from django.http import JsonResponse
@@ -63,7 +138,7 @@ def update_cart(request):
         new_quantity = int(request.POST.get("quantity", 1))
 
         try:
-            cart_item = CartItem.objects.get(id=cart_item_id, user=request.user)
+            cart_item = CartItem.objects.select_related('product').get(id=cart_item_id, user=request.user)
 
             if new_quantity > 0:
                 cart_item.quantity = new_quantity
@@ -72,13 +147,12 @@ def update_cart(request):
                 cart_item.delete()  # Remove item if quantity is set to 0
 
             # Ensure total_amount is always a valid number
-            total_amount = sum(item.product.price * item.quantity for item in CartItem.objects.filter(user=request.user))
-            total_amount = float(total_amount)  # Convert to float just in case
+            total_amount = float(get_cart_summary(request.user).total_amount)
 
             # Ensure item_total_price is also a valid number
             item_total_price = float(cart_item.product.price * cart_item.quantity) if new_quantity > 0 else 0
 
-            print(f"✅ Cart Updated: Item {cart_item_id} -> New Quantity: {new_quantity}, Total: {total_amount}")
+            logger.debug("cart_updated item=%s quantity=%s total=%s", cart_item_id, new_quantity, total_amount)
 
             return JsonResponse({
                 "success": True,
@@ -88,25 +162,66 @@ def update_cart(request):
             })
 
         except CartItem.DoesNotExist:
-            print(f"❌ Error: Cart item {cart_item_id} not found.")
+            logger.warning("cart_item_not_found item=%s user=%s", cart_item_id, request.user.pk)
             return JsonResponse({"success": False, "error": "Item not found"}, status=400)
 
     return JsonResponse({"success": False, "error": "Invalid request"}, status=400)
 
+@require_POST
+def cart_batch(request):
+    """ Apply several cart changes in one request: {"operations": [...]}, see cart.apply_cart_operations """
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"success": False, "error": "Body must be JSON"}, status=400)
+    try:
+        operations = payload.get('operations') if isinstance(payload, dict) else None
+        if request.user.is_authenticated:
+            lines, totals, unavailable = apply_cart_operations(request.user, operations)
+        else:
+            cart = get_anonymous_cart(request)
+            unavailable = cart.apply(operations)
+            lines = cart.lines()
+            totals = cart.totals(lines)
+    except CartOperationError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+
+    return JsonResponse({
+        "success": True,
+        "lines": [
+            {
+                "cart_item_id": item.id,
+                "product_id": item.product_id,
+                "quantity": item.quantity,
+                "line_total": float(item.product.price * item.quantity),
+            }
+            for item in lines
+        ],
+        "cart_total": float(totals.total_amount),
+        "cart_count": totals.item_count,
+        "unavailable": unavailable,
+    })
+
 # Add an item to the cart
 from django.http import JsonResponse
 
-@login_required
 def add_to_cart(request, product_id):
     product = get_object_or_404(Product, id=product_id)
-    cart_item, created = CartItem.objects.get_or_create(user=request.user, product=product)
+    if product.stock < 1:
+        return JsonResponse({"success": False, "error": f"{product.name} is out of stock"}, status=409)
+
+    if not request.user.is_authenticated:
+        cart = get_anonymous_cart(request)
+        try:
+            cart.add(product.id)
+        except CartOperationError as e:
+            return JsonResponse({"success": False, "error": str(e)}, status=409)
+        return JsonResponse({"success": True, "cart_count": cart.item_count})
 
-    if not created:
-        cart_item.quantity += 1  # Increment quantity if item already exists
-    cart_item.save()
+    add_product_to_cart(request.user, product)  # Atomic increment, safe against concurrent clicks
 
     # Get total quantity of all items in the cart (not just unique items)
-    total_cart_quantity = sum(item.quantity for item in CartItem.objects.filter(user=request.user))
+    total_cart_quantity = get_cart_summary(request.user).item_count
 
     return JsonResponse({
         "success": True,
@@ -114,36 +229,19 @@ def add_to_cart(request, product_id):
     })
 
 # Remove an item from the cart
+@login_required
 def remove_from_cart(request, cart_item_id):
-    cart_item = get_object_or_404(CartItem, id=cart_item_id)
+    cart_item = get_object_or_404(CartItem, id=cart_item_id, user=request.user)  # Only from your own cart
     cart_item.delete()
     return redirect('view_cart')
 
 @login_required
 def checkout(request):
-    cart_items = CartItem.objects.filter(user=request.user)
+    cart_items = list(cart_lines(request.user))
     total_amount = sum(item.product.price * item.quantity for item in cart_items)
 
     if request.method == "POST":
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[
-                {
-                    'price_data': {
-                        'currency': 'usd',
-                        'product_data': {
-                            'name': item.product.name,
-                        },
-                        'unit_amount': int(item.product.price * 100),
-                    },
-                    'quantity': item.quantity,
-                } for item in cart_items
-            ],
-            mode='payment',
-            success_url=request.build_absolute_uri('/products/success/'),
-            cancel_url=request.build_absolute_uri('/products/cancel/'),
-        )
-        return redirect(session.url, code=303)
+        return start_checkout(request, cart_items)
 
     return render(request, 'checkout.html', {'cart_items': cart_items, 'total_amount': total_amount})
 
@@ -155,118 +253,130 @@ from .models import Order, OrderItem, CartItem
 def payment_success(request):
     session_id = request.GET.get('session_id')
 
-    # Debugging: Print session ID
-    print(f"Received session ID: {session_id}")
+    logger.debug("payment_success session=%s user=%s", session_id, request.user.pk)
 
     if not session_id:
         return render(request, 'error.html', {'message': 'Session ID not found'})
 
-    stripe.api_key = settings.STRIPE_SECRET_KEY
+    # Normally the webhook worker has already created the order: a local read
+    order = Order.objects.filter(stripe_session_id=session_id, user=request.user).first()
+    if order is not None:
+        return render(request, 'success.html', {'order': order})
+
+    # Otherwise the webhook hasn't been processed yet, so fulfil here (idempotent either way)
     try:
-        session = stripe.checkout.Session.retrieve(session_id)
-        print(f"Stripe session retrieved: {session}")  # Debugging log
-    except stripe.error.InvalidRequestError as e:
-        print(f"Stripe session retrieval failed: {e}")
+        session = get_gateway().get_session(session_id)  # Finished sessions are served from cache
+        logger.debug("stripe_session_retrieved session=%s status=%s", session.id, session.status)
+    except SessionNotFound as e:
+        logger.warning("stripe_session_not_found session=%s error=%s", session_id, e)
         return render(request, 'error.html', {'message': 'Invalid Stripe session'})
 
+    # Unpaid (delayed payment methods) or someone else's session: nothing to fulfil from here
+    if not session.is_paid_by(request.user):
+        logger.info("payment_pending session=%s user=%s status=%s", session_id, request.user.pk, session.payment_status)
+        return render(request, 'payment_pending.html')
+
     # ✅ Fix: Get email from customer_details instead of customer_email
-    customer_email = session.customer_details.email if session.customer_details else None
+    customer_email = session.customer_email
     if not customer_email:
         return render(request, 'error.html', {'message': 'Customer email not found in Stripe session'})
 
-    # Get cart items and calculate total amount
-    cart_items = CartItem.objects.filter(user=request.user)
-    total_amount = sum(item.product.price * item.quantity for item in cart_items)
-
-    # Create an order
-    order = Order.objects.create(
-        user=request.user,
-        total_amount=total_amount
-    )
+    # Create the order (atomic, and only once per Stripe session); this also queues the confirmation email
+    order, created = create_order_from_cart(request.user, session_id, email=customer_email)
+    if order.user_id != request.user.id:
+        return render(request, 'error.html', {'message': 'Invalid Stripe session'})
 
-    # Add order items
-    order_items_details = ""
-    for item in cart_items:
-        OrderItem.objects.create(
-            order=order,
-            product=item.product,
-            quantity=item.quantity
-        )
-        order_items_details += f"{item.quantity} x {item.product.name} - ${item.product.price * item.quantity}\n"
+    if created:
+        logger.info("order_created order=%s user=%s session=%s", order.id, request.user.pk, session_id)
+    return render(request, 'success.html', {'order': order})
 
-    # Clear the user's cart
-    cart_items.delete()
 
-    # Debugging logs
-    print(f"✅ Sending email to: {customer_email}")
-    print(f"🛒 Order details:\n{order_items_details}")
+def start_checkout(request, cart_items):
+    """ Reserve stock and send the user to a Checkout Session (reused while the cart is unchanged) """
+    if not cart_items:
+        return redirect('view_cart')
 
-    # Send Order Confirmation Email
-    subject = "Your Order Confirmation - E-CommercePY"
-    message = f"""
-    Thank you for your purchase!
+    gateway = get_gateway()
+    session, created = gateway.start_checkout(
+        request.user,
+        cart_items,
+        success_url=request.build_absolute_uri('/products/success/') + '?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url=request.build_absolute_uri('/products/cancel/'),
+        expires_in=reservation_ttl(),
+    )
 
-    Your Order Details:
-    {order_items_details}
+    try:
+        hold_stock_for_session(request.user, cart_items, session, created)
+    except OutOfStock as e:
+        gateway.forget_open_session(request.user.pk)
+        return render_out_of_stock(request, cart_items, e)
 
-    Total Amount: ${total_amount}
+    return see_other(session.url)
 
-    We will notify you once your order is shipped.
-    """
 
-    try:
-        send_mail(
-            subject,
-            message,
-            settings.EMAIL_HOST_USER,  # Ensure this is configured correctly
-            [customer_email],  # Use the email from Stripe customer_details
-            fail_silently=False,
-        )
-        print("✅ Email sent successfully!")
-    except Exception as e:
-        print(f"❌ Email sending failed: {e}")
+def see_other(url):
+    """ 303 redirect: the browser follows a POST with a GET (Stripe's recommendation for Checkout) """
+    response = HttpResponseRedirect(url)
+    response.status_code = 303
+    return response
 
-    return render(request, 'success.html', {'order': order})
 
+def render_out_of_stock(request, cart_items, error):
+    total_amount = sum(item.product.price * item.quantity for item in cart_items)
+    return render(request, 'checkout.html', {'cart_items': cart_items, 'total_amount': total_amount,
+                                             'error': str(error)}, status=409)
 
 
+@login_required
 def create_checkout_session(request):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
+    return start_checkout(request, list(cart_lines(request.user)))
 
-    # Calculate the total amount based on cart items
-    cart_items = CartItem.objects.filter(user=request.user)
-    total_price = sum(item.product.price * item.quantity for item in cart_items) * 100  # Convert to cents
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """ Verify and record a Stripe event; fulfilment happens in `manage.py process_stripe_events` """
+    try:
+        event = get_gateway().parse_event(request.body, request.headers.get('Stripe-Signature'))
+    except InvalidWebhook as e:
+        logger.warning("stripe_webhook_rejected error=%s", e)
+        return HttpResponse(status=400)
+
+    record_event(event)
+    return HttpResponse(status=200)
 
-    session = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        customer_creation='always',  # Ensures a customer is always created
-        billing_address_collection='required',  # Forces Stripe to collect email
-        line_items=[
-            {
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': item.product.name,  # Use the actual product name
-                    },
-                    'unit_amount': int(item.product.price * 100),  # Convert price to cents
-                },
-                'quantity': item.quantity,  # Ensure quantity is correctly set
-            } for item in cart_items  # Loop through all cart items
-        ],
-        mode='payment',
-        success_url=request.build_absolute_uri('/products/success/') + '?session_id={CHECKOUT_SESSION_ID}',
-        cancel_url=request.build_absolute_uri('/products/cancel/'),
-    )
 
-    return redirect(session.url)
+def prometheus_metrics(request):
+    """ Request metrics for this process in the Prometheus text format; set METRICS_TOKEN to require a bearer token """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=403)
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 def payment_cancel(request):
     return render(request, 'cancel.html')
 
 @login_required
 def order_history(request):
-    orders = Order.objects.filter(user=request.user).order_by('-date')  # Get all orders for the user
-    return render(request, 'order_history.html', {'orders': orders})
+    # One keyset page of orders (annotated totals, items prefetched in one query) plus the lifetime summary
+    page = order_history_page(request.user, request.GET.get('cursor'), settings.ORDER_PAGE_SIZE)
+    return render(request, 'order_history.html', {
+        'orders': page, 'next_cursor': page.next_cursor, 'summary': order_summary(request.user),
+    })
+
+@login_required
+def order_history_export(request):
+    """ The user's whole order history as CSV (one row per line) or JSON, streamed in chunks """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in ('csv', 'json'):
+        return HttpResponse("format must be csv or json", status=400)
+    orders = export_orders(request.user)
+    if export_format == 'json':
+        response = StreamingHttpResponse(stream_json(orders), content_type='application/json')
+    else:
+        response = StreamingHttpResponse(stream_csv(orders), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+    return response
 
 def register(request):
     if request.method == 'POST':
@@ -279,19 +389,3 @@ def register(request):
 
     return render(request, 'register.html', {'form': form})
 
-
-from django.core.mail import send_mail
-from django.conf import settings
-
-
-def send_order_confirmation(email, order_details):
-    subject = "Your Order Confirmation - E-CommercePY"
-    message = f"Thank you for your order!\n\nOrder Details:\n{order_details}\n\nWe will notify you once your order is shipped."
-
-    send_mail(
-        subject,
-        message,
-        settings.EMAIL_HOST_USER,
-        [email],
-        fail_silently=False,
-    )